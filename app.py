@@ -1,24 +1,54 @@
 # app.py
-import os, uuid, json, re, time, threading
+import os, uuid, json, re, time, queue, threading
 from datetime import datetime
-from typing import List, Dict, Any, Generator
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Generator, Tuple
 from flask import Flask, request, jsonify, render_template_string, Response
 from werkzeug.utils import secure_filename
 from dotenv import load_dotenv
 from flask_cors import CORS
 
-from graph_llm_ingredients import run_pipeline
+from graph_llm_ingredients import (run_pipeline, VARIANTS, needs_images, warm_variants, record_variant, variant_stats,
+                                   run_speculative_stage, speculation_stats)
 from gemini_recognize import gemini_recognize_dish
 from gemini_ingredients import ingredients_from_image
-from gemini_calories import calories_from_ingredients
+from calorie_engine import estimate_calories, calorie_engine_stats
+from density_memo import memo_stats
+from gemini_cascade import cascaded, cascade_stats
+from single_flight import Flight, flight_key, join, run_shared, produce, single_flight_stats
+from heartbeat import HEARTBEATS, record_gap, heartbeat_stats
+from job_queue import QueueFull, admit, submit, run_job, current_wait_ms, queue_stats
+from cancellation import CancelToken, Cancelled, cancel_scope, cancel_stats, count as count_cancel
+from gemini_fused import recognize_and_quantify, split_fused
+from gemini_client import make_client, client_pool_stats, file_cache_stats, json_pass_stats, usage_stats, summarize_usage
+from gemini_policy import call_policy_stats
+from llm_cache import cache_stats
+from gemini_fake import fake_stats
+from image_prep import normalize_images, image_prep_stats
+from meal_batch import run_batch, batch_stats, BATCH_MAX_MEALS
+from history_store import record_history, delete_history, query_history, query_rollups, history_stats
 
 # --- config ---
 load_dotenv()
 UPLOAD_DIR = os.path.abspath(os.getenv("UPLOAD_DIR", "./uploads"))
 ALLOWED_EXT = {"jpg", "jpeg", "png", "webp"}
+STREAM_STAGES = os.getenv("SSE_STREAM_STAGES", "1") != "0"   # token-stream recognize/ing_quant into SSE
+DEFAULT_MODEL = os.getenv("GEMINI_DEFAULT_MODEL", "cascade")   # "cascade" = flash first, pro when unsure
+# /upload queues the analysis itself. Runs are found again by the process that queued
+# them (_RUNS), so with several server processes /analyze_sse can land on another one
+# and queue (and bill) the same analysis twice: default off when WEB_CONCURRENCY > 1.
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "1"))
+START_ON_UPLOAD = os.getenv("JOB_START_ON_UPLOAD", "1" if WEB_CONCURRENCY <= 1 else "0") != "0"
 
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 
+# Build the pooled Gemini client at startup so the first request doesn't pay for it.
+try:
+    make_client(os.getenv("GOOGLE_CLOUD_PROJECT"), os.getenv("GOOGLE_CLOUD_LOCATION", "global"))
+except Exception as e:
+    print(f"[startup] Gemini client not ready: {e}")
+warm_variants()
+
 app = Flask(__name__)
 app.config["MAX_CONTENT_LENGTH"] = 25 * 1024 * 1024  # 25MB per request
 CORS(app)
@@ -30,7 +60,7 @@ INDEX_HTML = """<!doctype html>
     <h1>Food Analyzer (LLM-only)</h1>
     <form method="POST" action="/analyze" enctype="multipart/form-data" style="border:1px solid #eee; padding:16px; border-radius:10px">
       <div><input type="file" name="image" accept="image/*" multiple required></div>
-      <div style="margin-top:8px">Model: <input name="model" value="gemini-2.5-pro" style="width:220px"></div>
+      <div style="margin-top:8px">Model: <input name="model" value="cascade" style="width:220px"></div>
       <div style="margin-top:8px"><button type="submit">Analyze (non-streaming)</button></div>
     </form>
     <p style="margin-top:16px;color:#666">For streaming UI, the Angular app uses /upload + /analyze_sse.</p>
@@ -58,6 +88,67 @@ def index():
 def health():
     return {"ok": True}, 200
 
+@app.get("/stats")
+def stats():
+    return jsonify({
+        "client_pool": client_pool_stats(),
+        "file_cache": file_cache_stats(),
+        "image_prep": image_prep_stats(),
+        "call_policy": call_policy_stats(),
+        "llm_cache": cache_stats(),
+        "history": history_stats(),
+        "json_passes": json_pass_stats(),
+        "usage": usage_stats(),
+        "variants": variant_stats(),
+        "speculation": speculation_stats(),
+        "calorie_engine": calorie_engine_stats(),
+        "density_memo": memo_stats(),
+        "cascade": cascade_stats(),
+        "single_flight": single_flight_stats(),
+        "cancellation": cancel_stats(),
+        "job_queue": queue_stats(),
+        "heartbeat": heartbeat_stats(),
+        "batch": batch_stats(),
+        "fake_backend": fake_stats(),   # empty unless GEMINI_BACKEND=fake / stand-in in-process
+    }), 200
+
+def _use_cache() -> bool:
+    # ?nocache=1 forces fresh Gemini calls (results still refresh the cache)
+    return (request.values.get("nocache") or "").lower() not in ("1", "true", "yes")
+
+def _variant() -> str:
+    return (request.values.get("variant") or "full").strip().lower()
+
+def _user() -> str:
+    # optional owner of the record (per-user history and rollups): X-User-Id header or `user` field
+    body = request.get_json(silent=True) or {}
+    return str(request.headers.get("X-User-Id") or body.get("user") or request.values.get("user") or "").strip()[:64]
+
+def _variant_inputs() -> Dict[str, Any]:
+    """dish / ingredients / items supplied by the caller for partial variants (form, query or JSON body)."""
+    body = request.get_json(silent=True) or {}
+    def val(k):
+        v = body.get(k) if k in body else request.values.get(k)
+        if isinstance(v, str) and v.strip()[:1] in ("[", "{"):
+            try:
+                return json.loads(v)
+            except ValueError:
+                return None
+        return v
+    out: Dict[str, Any] = {}
+    if val("dish"):
+        out["dish"] = str(val("dish")).strip().lower()
+    ing = val("ingredients")
+    if isinstance(ing, str):
+        ing = [x for x in ing.split(",")]
+    if isinstance(ing, list):
+        out["ingredients"] = [str(x).strip().lower() for x in ing if str(x).strip()]
+    items = val("items")
+    if isinstance(items, list):
+        out["items"] = [{"name": str(it.get("name") or "").strip().lower(), "grams": fnum(it.get("grams"))}
+                        for it in items if isinstance(it, dict) and it.get("name")]
+    return out
+
 def _gather_images() -> List:
     if "images[]" in request.files:
         imgs = request.files.getlist("images[]")
@@ -83,31 +174,71 @@ def _save_uploads(files_in) -> List[str]:
 # ------------------------------
 @app.post("/analyze")
 def analyze():
-    files_in = _gather_images()
-    if not files_in:
-        return jsonify({"error": "missing_file", "msg": "form field 'image' or 'images[]' required"}), 400
-    try:
-        save_paths = _save_uploads(files_in)
-    except ValueError as ve:
-        return jsonify({"error": "bad_extension", "msg": str(ve)}), 400
+    """
+    Multipart images (+ model). Optional `variant` (see /stats → variants):
+    full (default) | fused | speculative | recognize | quantify | calories; `calories` takes `items`
+    ([{name, grams}] as JSON) instead of images, `quantify` may take `dish`/`ingredients`.
+    """
+    variant = _variant()
+    if variant not in VARIANTS:
+        return jsonify({"error": "unknown_variant", "msg": f"variant must be one of {list(VARIANTS)}"}), 400
+    inputs = _variant_inputs()
+    save_paths: List[str] = []
+    model_paths: List[str] = []
+    norm_timings: Dict[str, float] = {}
+    if needs_images(variant):
+        files_in = _gather_images()
+        if not files_in:
+            return jsonify({"error": "missing_file", "msg": "form field 'image' or 'images[]' required"}), 400
+        try:
+            admit("interactive")   # before touching the disk
+            save_paths = _save_uploads(files_in)
+        except QueueFull as qf:
+            return _busy(qf)
+        except ValueError as ve:
+            return jsonify({"error": "bad_extension", "msg": str(ve)}), 400
+        model_paths, norm_timings = normalize_images(save_paths)
+    elif not inputs.get("items"):
+        return jsonify({"error": "missing_items", "msg": "variant 'calories' needs items=[{name, grams}]"}), 400
 
     project  = os.getenv("GOOGLE_CLOUD_PROJECT")
     location = os.getenv("GOOGLE_CLOUD_LOCATION", "global")
-    model    = request.form.get("model") or request.args.get("model") or "gemini-2.5-pro"
+    model    = request.form.get("model") or request.args.get("model") or DEFAULT_MODEL
 
+    use_cache = _use_cache()
+
+    def run() -> Dict[str, Any]:
+        res = run_pipeline(model_paths, project, location, model, use_cache=use_cache,
+                           variant=variant, inputs=inputs)
+        res["timings"] = {**norm_timings, **(res.get("timings") or {}), "queue_wait_ms": current_wait_ms()}
+        if res.get("error"):
+            return {"error": res["error"], "dish": res.get("dish")}
+        return _finalize_payload(res, save_paths)
+
+    # identical request already running (double submit, second tab): share its result;
+    # otherwise run on the job queue (this thread only waits)
+    key = flight_key(save_paths, model, variant, inputs, use_cache)
     try:
-        res = run_pipeline(save_paths, project, location, model)
+        data, coalesced = run_shared(key, lambda: run_job("interactive", run, name="analyze"))
+    except QueueFull as qf:
+        return _busy(qf)
     except Exception as e:
         return jsonify({"error": "pipeline_exception", "msg": str(e)}), 500
 
-    if res.get("error"):
-        return jsonify({"error": res["error"], "dish": res.get("dish")}), 400
+    if data.get("error"):
+        return jsonify({"error": data["error"], "dish": data.get("dish")}), 400
+    if coalesced:
+        data["coalesced"] = True
+        return jsonify(data), 200
 
-    data = _finalize_payload(res, save_paths)
-    _persist_history(data, save_paths[0])
+    _persist_history(data, save_paths[0] if save_paths else _history_stub(variant), _user())
     print(f"[api] ⏱ total {data.get('total_ms')} ms  → timings: {data.get('timings')}")
     return jsonify(data), 200
 
+def _history_stub(variant: str) -> str:
+    # history file name for image-less variants
+    return f"{variant}-{datetime.utcnow().strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+
 # ------------------------------
 # Streaming flow (SSE)
 # 1) POST /upload  -> {job_id}
@@ -115,69 +246,174 @@ def analyze():
 # ------------------------------
 @app.post("/upload")
 def upload_only():
+    """
+    Save + normalize the images and queue their analysis right away (model / variant /
+    nocache from the form, `lane=batch` for reprocessing); /analyze_sse?job_id= then
+    subscribes to it. 429 + Retry-After when the lane's queue is full.
+    """
+    lane = "batch" if (request.form.get("lane") or "").lower() == "batch" else "interactive"
+    variant = _variant()
+    if variant not in VARIANTS or not needs_images(variant):
+        return jsonify({"error": "unknown_variant", "msg": f"variant must be an image variant of {list(VARIANTS)}"}), 400
     files_in = _gather_images()
     if not files_in:
         return jsonify({"error": "missing_file", "msg": "form field 'image' or 'images[]' required"}), 400
+    if START_ON_UPLOAD:
+        try:
+            admit(lane)   # before touching the disk
+        except QueueFull as qf:
+            return _busy(qf)
     try:
         save_paths = _save_uploads(files_in)
     except ValueError as ve:
         return jsonify({"error": "bad_extension", "msg": str(ve)}), 400
+    model_paths, norm_timings = normalize_images(save_paths)
 
     job_id = uuid.uuid4().hex
-    manifest = {"paths": save_paths, "created_at": datetime.utcnow().isoformat()}
+    model = request.form.get("model") or DEFAULT_MODEL
+    manifest = {
+        "paths": model_paths,          # normalized images every stage sends to Gemini
+        "originals": save_paths,
+        "normalize": norm_timings,
+        "created_at": datetime.utcnow().isoformat(),
+        **({"run": [model, variant]} if START_ON_UPLOAD else {}),
+        **({"user": _user()} if _user() else {}),
+    }
     with open(os.path.join(UPLOAD_DIR, f"{job_id}.job.json"), "w", encoding="utf-8") as f:
         json.dump(manifest, f)
-    return jsonify({"job_id": job_id}), 200
+    if START_ON_UPLOAD:
+        try:
+            _sse_flight(job_id, manifest, model, variant, _variant_inputs(), _use_cache(), lane)
+        except QueueFull as qf:
+            return _busy(qf)
+    return jsonify({"job_id": job_id, **({"queued": lane} if START_ON_UPLOAD else {})}), 200
 
-def _load_job_paths(job_id: str) -> List[str]:
-    p = os.path.join(UPLOAD_DIR, f"{job_id}.job.json")
+def _load_job(job_id: str) -> Dict[str, Any]:
+    p = os.path.join(UPLOAD_DIR, f"{secure_filename(job_id)}.job.json")
     if not os.path.exists(p):
-        return []
+        return {}
     with open(p, "r", encoding="utf-8") as f:
-        data = json.load(f)
-    return data.get("paths", [])
+        return json.load(f)
+
+# Stage checkpoints: each finished stage's events + pipeline state, per job_id, so a
+# reconnecting EventSource (Last-Event-ID) gets finished stages replayed and only the
+# unfinished ones run again.
+def _checkpoint_path(job_id: str) -> str:
+    return os.path.join(UPLOAD_DIR, f"{secure_filename(job_id)}.ckpt.json")
+
+def _load_checkpoint(job_id: str, model: str, variant: str) -> Dict[str, Any]:
+    p = _checkpoint_path(job_id)
+    try:
+        with open(p, "r", encoding="utf-8") as f:
+            ckpt = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    # a different model/variant on the same upload is a different analysis
+    return ckpt if (ckpt.get("model"), ckpt.get("variant")) == (model, variant) else {}
+
+def _save_checkpoint(job_id: str, ckpt: Dict[str, Any]):
+    p = _checkpoint_path(job_id)
+    tmp = f"{p}.{uuid.uuid4().hex[:6]}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(ckpt, f, ensure_ascii=False)
+    os.replace(tmp, p)
+
+def _last_event_id() -> int:
+    # EventSource resends the last id it saw as a header; ?last_event_id= for manual resumes
+    raw = request.headers.get("Last-Event-ID") or request.args.get("last_event_id") or ""
+    try:
+        return int(raw)
+    except ValueError:
+        return 0
+
+def _event_id(chunk: str) -> int:
+    return int(chunk[4:chunk.index("\n")]) if chunk.startswith("id: ") else 0
+
+def _resume_filter(last_id: int):
+    """Predicate over outgoing chunks dropping what the client already has: everything up to
+    event `last_id` (partials included). One per stream; comments, errors and 'done' always pass."""
+    passed = [last_id <= 0]
+    def keep(chunk: str) -> bool:
+        if passed[0] or chunk.startswith((":", "event: error", "event: done")):
+            return True
+        eid = _event_id(chunk)
+        if eid < last_id:
+            return False
+        passed[0] = True
+        return eid != last_id
+    return keep
+
+def _after_event_id(chunks, last_id: int) -> Generator[str, None, None]:
+    keep = _resume_filter(last_id)
+    try:
+        for chunk in chunks:
+            if keep(chunk):
+                yield chunk
+    finally:
+        # pass the server's close() on (client gone -> the stream cancels its run)
+        close = getattr(chunks, "close", None)
+        if close:
+            close()
 
 # ---------- SSE helpers (heartbeats keep Cloudflared happy) ----------
-def _sse_pack(event: str, obj: Dict[str, Any]) -> str:
-    return f"event: {event}\n" + "data: " + json.dumps(obj, ensure_ascii=False) + "\n\n"
+def _sse_pack(event: str, obj: Dict[str, Any], eid: "int | None" = None) -> str:
+    # only stage results get an id: it is the resume point after a reconnect
+    head = f"id: {eid}\n" if eid is not None else ""
+    return head + f"event: {event}\n" + "data: " + json.dumps(obj, ensure_ascii=False) + "\n\n"
 
 def _hb_line(txt: str = "hb") -> str:
     # Comment line per SSE spec; browsers ignore, proxies keep the TCP alive.
     return f": {txt}\n\n"
 
-def _call_with_heartbeat(fn, *args, interval: float = 15.0):
+_STAGE_POOL = ThreadPoolExecutor(max_workers=int(os.getenv("SSE_STAGE_WORKERS", "64")), thread_name_prefix="sse-stage")
+_HB = object()   # heartbeat tick put on a stream's inbox by HEARTBEATS
+
+def _call_with_heartbeat(fn, *args, interval: float = 15.0, events: "queue.Queue | None" = None,
+                         cancel: "CancelToken | None" = None, timings: "Dict[str, float] | None" = None):
     """
-    Run a blocking function in a thread, yielding heartbeat comments every `interval` seconds.
+    Run a blocking function on the stage pool, yielding heartbeat comments every `interval` seconds.
+    Anything the function puts on `events` as (event, obj) is forwarded as an SSE event right away.
+    The stream sleeps on that one queue: partials, the shared scheduler's heartbeats and the
+    function's completion all wake it, so the result comes back as soon as it exists
+    (the gap is added to timings['emit_gap_ms']).
+    `cancel` is the current token inside the worker, so Gemini calls stop when it fires.
     Usage inside a generator:   res = yield from _call_with_heartbeat(lambda: fn(...))
     """
     def _gen():
-        box = {"done": False, "res": None, "err": None}
+        inbox = events if events is not None else queue.Queue()
+        done = object()
+        box: Dict[str, float] = {}
 
         def worker():
-            try:
-                box["res"] = fn(*args)
-            except Exception as e:
-                box["err"] = e
-            finally:
-                box["done"] = True
+            with cancel_scope(cancel):
+                return fn(*args)
 
-        t = threading.Thread(target=worker, daemon=True)
-        t.start()
+        def on_done(_):
+            box["t"] = time.perf_counter()
+            inbox.put(done)
 
-        # Opening padding so intermediaries start streaming immediately
-        yield _hb_line("open")
-
-        last = 0.0
-        while not box["done"]:
-            now = time.time()
-            if now - last >= interval:
-                yield _hb_line()  # keepalive
-                last = now
-            time.sleep(0.25)
+        fut = _STAGE_POOL.submit(worker)
+        fut.add_done_callback(on_done)
+        hb = HEARTBEATS.register(inbox, interval, _HB)
+        try:
+            # Opening padding so intermediaries start streaming immediately
+            yield _hb_line("open")
+            while True:
+                item = inbox.get()
+                if item is done:
+                    break
+                if item is _HB:
+                    yield _hb_line()  # keepalive
+                    continue
+                yield _sse_pack(*item)
+        finally:
+            HEARTBEATS.unregister(hb)
 
-        if box["err"]:
-            raise box["err"]
-        return box["res"]  # captured by 'yield from'
+        gap_ms = (time.perf_counter() - box["t"]) * 1000.0
+        record_gap(gap_ms)
+        if timings is not None:
+            timings["emit_gap_ms"] = round(timings.get("emit_gap_ms", 0.0) + gap_ms, 3)
+        return fut.result()  # captured by 'yield from'; re-raises the function's error
 
     return _gen()
 
@@ -252,75 +488,126 @@ def _finalize_payload(res: Dict[str, Any], save_paths: List[str]) -> Dict[str, A
 
         "notes": res.get("kcal_notes") or res.get("ing_notes"),
         "angles_used": len(save_paths),
+        "variant": res.get("variant") or "full",
 
         "timings": res.get("timings", {}),
         "total_ms": res.get("total_ms", 0.0),
+
+        # one record per Gemini pass (tokens + cost); empty for cached stages
+        "usage": res.get("usage") or [],
+        "usage_total": summarize_usage(res.get("usage") or []),
     }
 
-def _persist_history(data: Dict[str, Any], first_path: str):
-    hist_path = os.path.join(UPLOAD_DIR, os.path.basename(first_path) + ".json")
-    with open(hist_path, "w", encoding="utf-8") as hf:
-        json.dump({**data, "created_at": datetime.utcnow().isoformat()}, hf, ensure_ascii=False)
+def _persist_history(data: Dict[str, Any], first_path: str, user: str = ""):
+    rec_id = os.path.basename(first_path) + ".json"
+    rec = {**data, "created_at": datetime.utcnow().isoformat(), **({"user": user} if user else {})}
+    with open(os.path.join(UPLOAD_DIR, rec_id), "w", encoding="utf-8") as hf:
+        json.dump(rec, hf, ensure_ascii=False)
+    record_history(rec_id, rec)   # the index /history reads
 
-@app.get("/analyze_sse")
-def analyze_sse():
+def _sse_pipeline(job_id: str, job: Dict[str, Any], model: str, variant: str, inputs: Dict[str, Any],
+                  use_cache: bool, cancel: CancelToken, last_id: int = 0):
     """
-    SSE stream: emits events 'recognize', 'ing_quant', 'calories', 'done' (and possibly 'error').
-    Query: job_id, model(optional)
+    The SSE event stream of one analysis, as (generator, outcome) for a job_queue worker
+    to drive into a flight: stage events ('recognize', 'ing_quant', 'calories', 'done',
+    possibly 'error') plus 'dish_partial' / 'ing_item' partials, checkpointed per job.
+    Needs no request context.
     """
-    job_id = request.args.get("job_id", "")
-    if not job_id:
-        return jsonify({"error": "missing_job_id"}), 400
-    image_paths = _load_job_paths(job_id)
-    if not image_paths:
-        return jsonify({"error": "invalid_job_id"}), 404
-
     project  = os.getenv("GOOGLE_CLOUD_PROJECT")
     location = os.getenv("GOOGLE_CLOUD_LOCATION", "global")
-    model    = request.args.get("model") or "gemini-2.5-pro"
+    image_paths: List[str] = job.get("paths", [])
+    history_path = (job.get("originals") or image_paths or [_history_stub(variant)])[0]
 
-    def event_stream() -> Generator[str, None, None]:
-        timings: Dict[str, float] = {}
-        state: Dict[str, Any] = {"timings": timings}
-        t_total = time.perf_counter()
+    timings: Dict[str, float] = dict(job.get("normalize") or {})
+    state: Dict[str, Any] = {
+        "timings": timings, "stage": VARIANTS[variant][0],
+        "dish": inputs.get("dish", ""), "ingredients_detected": inputs.get("ingredients", []),
+        "items": inputs.get("items", []),
+    }
+    usage: List[Dict[str, Any]] = []
 
-        # -------- recognize --------
-        t0 = time.perf_counter()
-        rec = yield from _call_with_heartbeat(
-            lambda: gemini_recognize_dish(project, location, model, image_paths)
-        )
-        timings["recognize_ms"] = round((time.perf_counter() - t0) * 1000.0, 2)
+    # checkpoint of finished stages (events + state) for this job; nocache without a
+    # Last-Event-ID asks for a fresh run, unless /upload already started this very run
+    fresh = not (last_id or use_cache or job.get("run") == [model, variant])
+    ckpt = (_load_checkpoint(job_id, model, variant) if job_id and not fresh else {}) \
+        or {"model": model, "variant": variant, "stages": [], "events": [], "usage": []}
+    if ckpt.get("state"):
+        saved = dict(ckpt["state"])
+        timings.update(saved.pop("timings", {}))
+        state.update(saved)
+        usage.extend(ckpt.get("usage") or [])
 
-        if "error" in rec:
-            yield _sse_pack("error", {"stage": "recognize", "msg": rec.get("error")})
-            yield _sse_pack("done", {"error": "recognition_failed"})
+    def stage_event(event: str, obj: Dict[str, Any], completes: bool = True) -> str:
+        # checkpoint before the event goes out: a client that drops right after it
+        # reconnects with this id and must find the stage finished
+        chunk = _sse_pack(event, obj, eid=len(ckpt["events"]) + 1)
+        ckpt["events"].append(chunk)
+        if completes and job_id:
+            if state["stage"] not in ckpt["stages"]:
+                ckpt["stages"].append(state["stage"])
+            ckpt["state"] = {k: v for k, v in state.items() if k != "final"}
+            ckpt["usage"] = usage
+            _save_checkpoint(job_id, ckpt)
+        return chunk
+
+    # Partial results streamed out of the model while a stage is still running.
+    events: "queue.Queue[tuple]" = queue.Queue()
+    partial: Dict[str, Any] = {"dish": "", "ingredients_detected": []}
+
+    def on_recognize_partial(path: tuple, value: Any):
+        if path == ("dish",) and isinstance(value, str):
+            partial["dish"] = value.lower().strip()
+        elif len(path) == 2 and path[0] == "ingredients" and isinstance(value, str):
+            partial["ingredients_detected"].append(value.lower().strip())
+        else:
             return
+        events.put(("dish_partial", {"dish": partial["dish"],
+                                     "ingredients_detected": list(partial["ingredients_detected"])}))
+
+    def on_ing_partial(path: tuple, value: Any):
+        if len(path) == 2 and path[0] == "items" and isinstance(value, dict):
+            events.put(("ing_item", {
+                "index": path[1],
+                "name": str(value.get("name") or "").strip().lower(),
+                "grams": fnum(value.get("grams")),
+                **({"note": value["note"]} if value.get("note") else {})
+            }))
+
+    def pipeline_result(total_ms: float = 0.0) -> Dict[str, Any]:
+        # same shape run_pipeline returns, so the payload matches /analyze
+        return {
+            "dish": state["dish"],
+            "ingredients": state["ingredients_detected"],
+            "gemini_conf": state.get("dish_confidence"),
+            "items": state["items"],
+            "total_grams": state.get("total_grams"),
+            "ing_conf": state.get("grams_confidence"),
+            "ing_notes": state.get("ing_notes"),
+            "nutr_items": state.get("nutr_items", []),
+            "total_kcal": state.get("total_kcal"),
+            "total_protein_g": state.get("total_protein_g"),
+            "total_carbs_g": state.get("total_carbs_g"),
+            "total_fat_g": state.get("total_fat_g"),
+            "kcal_conf": state.get("kcal_conf"),
+            "kcal_notes": state.get("kcal_notes"),
+            "timings": timings,
+            "total_ms": total_ms,
+            "usage": usage,
+            "variant": variant,
+        }
 
+    def emit_recognize(rec: Dict[str, Any]) -> str:
         state["dish"] = rec.get("dish","")
         state["ingredients_detected"] = [str(x) for x in (rec.get("ingredients") or [])]
         state["dish_confidence"] = round(fnum(rec.get("confidence")), 2)
-        yield _sse_pack("recognize", {
+        return stage_event("recognize", {
             "dish": state["dish"],
             "dish_confidence": state["dish_confidence"],
             "ingredients_detected": state["ingredients_detected"],
             "timings": timings
-        })
-
-        # -------- ing_quant --------
-        t0 = time.perf_counter()
-        ing = yield from _call_with_heartbeat(
-            lambda: ingredients_from_image(
-                project, location, model, image_paths,
-                dish_hint=state["dish"], ing_hint=state["ingredients_detected"]
-            )
-        )
-        timings["ing_quant_ms"] = round((time.perf_counter() - t0) * 1000.0, 2)
-
-        if "error" in ing:
-            yield _sse_pack("error", {"stage": "ing_quant", "msg": ing.get("error")})
-            yield _sse_pack("done", {"error": "ingredients_failed"})
-            return
+        }, completes=state["stage"] == "recognize")   # fused/speculate finish on ing_quant
 
+    def emit_ing_quant(ing: Dict[str, Any]) -> str:
         items_grams = []
         for it in (ing.get("items") or []):
             items_grams.append({
@@ -332,8 +619,7 @@ def analyze_sse():
         state["total_grams"] = fnum(ing.get("total_grams"))
         state["grams_confidence"] = round(fnum(ing.get("confidence")), 2)
         state["ing_notes"] = ing.get("notes")
-
-        yield _sse_pack("ing_quant", {
+        return stage_event("ing_quant", {
             "items_grams": items_grams,
             "total_grams": state["total_grams"],
             "grams_confidence": state["grams_confidence"],
@@ -341,19 +627,107 @@ def analyze_sse():
             "timings": timings
         })
 
-        # -------- calories --------
+    # Each stage: run under heartbeats, emit its event(s), return False after 'error' + 'done'.
+    def run_recognize() -> Generator[str, None, bool]:
+        t0 = time.perf_counter()
+        rec = yield from _call_with_heartbeat(
+            lambda: cascaded("recognize", model, lambda m: gemini_recognize_dish(
+                project, location, m, image_paths, timings=timings, usage=usage, use_cache=use_cache,
+                on_partial=on_recognize_partial if STREAM_STAGES else None), timings),
+            events=events, cancel=cancel, timings=timings,
+        )
+        timings["recognize_ms"] = round((time.perf_counter() - t0) * 1000.0, 2)
+
+        if "error" in rec:
+            yield _sse_pack("error", {"stage": "recognize", "msg": rec.get("error")})
+            yield _sse_pack("done", {"error": "recognition_failed"})
+            return False
+
+        yield emit_recognize(rec)
+        return True
+
+    def run_ing_quant() -> Generator[str, None, bool]:
+        t0 = time.perf_counter()
+        ing = yield from _call_with_heartbeat(
+            lambda: cascaded("ing_quant", model, lambda m: ingredients_from_image(
+                project, location, m, image_paths,
+                dish_hint=state["dish"], ing_hint=state["ingredients_detected"],
+                timings=timings, usage=usage, use_cache=use_cache,
+                on_partial=on_ing_partial if STREAM_STAGES else None,
+            ), timings),
+            events=events, cancel=cancel, timings=timings,
+        )
+        timings["ing_quant_ms"] = round((time.perf_counter() - t0) * 1000.0, 2)
+
+        if "error" in ing:
+            yield _sse_pack("error", {"stage": "ing_quant", "msg": ing.get("error")})
+            yield _sse_pack("done", {"error": "ingredients_failed"})
+            return False
+
+        yield emit_ing_quant(ing)
+        return True
+
+    def on_fused_partial(path: tuple, value: Any):
+        (on_ing_partial if path[:1] == ("items",) else on_recognize_partial)(path, value)
+
+    def run_fused() -> Generator[str, None, bool]:
+        # one call, but the client still sees 'recognize' then 'ing_quant'
+        t0 = time.perf_counter()
+        res = yield from _call_with_heartbeat(
+            lambda: cascaded("fused", model, lambda m: recognize_and_quantify(
+                project, location, m, image_paths, timings=timings, usage=usage, use_cache=use_cache,
+                on_partial=on_fused_partial if STREAM_STAGES else None), timings),
+            events=events, cancel=cancel, timings=timings,
+        )
+        timings["fused_ms"] = round((time.perf_counter() - t0) * 1000.0, 2)
+
+        if "error" in res:
+            yield _sse_pack("error", {"stage": "fused", "msg": res.get("error")})
+            yield _sse_pack("done", {"error": "fused_failed"})
+            return False
+
+        rec, ing = split_fused(res)
+        yield emit_recognize(rec)
+        yield emit_ing_quant(ing)
+        return True
+
+    def run_speculate() -> Generator[str, None, bool]:
+        # recognize ‖ unhinted ing_quant; only a re-run (disagreement) streams item partials
+        rec, ing, spec_timings = yield from _call_with_heartbeat(
+            lambda: run_speculative_stage(project, location, model, image_paths, timings, usage, use_cache=use_cache,
+                                          on_recognize_partial=on_recognize_partial if STREAM_STAGES else None,
+                                          on_ing_partial=on_ing_partial if STREAM_STAGES else None),
+            events=events, cancel=cancel, timings=timings,
+        )
+        timings.update(spec_timings)
+
+        if "error" in rec:
+            yield _sse_pack("error", {"stage": "recognize", "msg": rec.get("error")})
+            yield _sse_pack("done", {"error": "recognition_failed"})
+            return False
+        yield emit_recognize(rec)
+
+        if "error" in ing:
+            yield _sse_pack("error", {"stage": "ing_quant", "msg": ing.get("error")})
+            yield _sse_pack("done", {"error": "ingredients_failed"})
+            return False
+        yield emit_ing_quant(ing)
+        return True
+
+    def run_calories() -> Generator[str, None, bool]:
         t0 = time.perf_counter()
         cal = yield from _call_with_heartbeat(
-            lambda: calories_from_ingredients(project, location, model, state["dish"], state["items"])
+            lambda: estimate_calories(project, location, model, state["dish"], state["items"],
+                                      timings=timings, usage=usage, use_cache=use_cache),
+            cancel=cancel, timings=timings,
         )
         timings["calories_ms"] = round((time.perf_counter() - t0) * 1000.0, 2)
 
         if "error" in cal:
             yield _sse_pack("error", {"stage": "calories", "msg": cal.get("error")})
             yield _sse_pack("done", {"error": "calories_failed"})
-            return
+            return False
 
-        # fold calories into a final payload identical to /analyze
         state.update({
             "nutr_items": cal.get("items", []),
             "total_kcal": fnum(cal.get("total_kcal")),
@@ -362,85 +736,365 @@ def analyze_sse():
             "total_fat_g": fnum(cal.get("total_fat_g")),
             "kcal_conf": fnum(cal.get("confidence")),
             "kcal_notes": cal.get("notes"),
-            "gemini_conf": state.get("dish_confidence", 0.0),
-            "ingredients": state.get("ingredients_detected", []),
         })
-        total_ms = round((time.perf_counter() - t_total) * 1000.0, 2)
-
-        # build full API payload
-        final_payload = _finalize_payload(
-            {
-                "dish": state["dish"],
-                "ingredients": state["ingredients"],
-                "gemini_conf": state.get("gemini_conf"),
-                "items": state["items"],
-                "total_grams": state.get("total_grams"),
-                "ing_conf": state.get("grams_confidence"),
-                "ing_notes": state.get("ing_notes"),
-                "nutr_items": state["nutr_items"],
-                "total_kcal": state["total_kcal"],
-                "total_protein_g": state["total_protein_g"],
-                "total_carbs_g": state["total_carbs_g"],
-                "total_fat_g": state["total_fat_g"],
-                "kcal_conf": state["kcal_conf"],
-                "kcal_notes": state["kcal_notes"],
-                "timings": timings,
-                "total_ms": total_ms,
-            },
-            image_paths,
-        )
+        payload = _finalize_payload(pipeline_result(), image_paths)
 
         # emit the calories event (useful if UI wants to update before 'done')
-        yield _sse_pack("calories", {
-            "items_nutrition": final_payload["items_nutrition"],
-            "items_kcal": final_payload["items_kcal"],
-            "items_density": final_payload["items_density"],
-            "total_kcal": final_payload["total_kcal"],
-            "total_protein_g": final_payload["total_protein_g"],
-            "total_carbs_g": final_payload["total_carbs_g"],
-            "total_fat_g": final_payload["total_fat_g"],
-            "kcal_confidence": final_payload["kcal_confidence"],
-            "notes": final_payload.get("notes"),
+        yield stage_event("calories", {
+            "items_nutrition": payload["items_nutrition"],
+            "items_kcal": payload["items_kcal"],
+            "items_density": payload["items_density"],
+            "total_kcal": payload["total_kcal"],
+            "total_protein_g": payload["total_protein_g"],
+            "total_carbs_g": payload["total_carbs_g"],
+            "total_fat_g": payload["total_fat_g"],
+            "kcal_confidence": payload["kcal_confidence"],
+            "notes": payload.get("notes"),
             "timings": timings,
         })
+        return True
 
-        # persist + final done
-        _persist_history(final_payload, image_paths[0])
-        yield _sse_pack("done", final_payload)
+    sse_stages = {"recognize": run_recognize, "ing_quant": run_ing_quant, "fused": run_fused,
+                  "speculate": run_speculate, "calories": run_calories}
 
-    headers = {
-        "Content-Type": "text/event-stream",
-        "Cache-Control": "no-cache, no-transform",  # critical for Cloudflare/proxies
-        "X-Accel-Buffering": "no",
-        "Connection": "keep-alive",
-        "Access-Control-Allow-Origin": "*",
-    }
-    return Response(event_stream(), headers=headers)
+    def stages() -> Generator[str, None, None]:
+        t_total = time.perf_counter()
+        wait_ms = current_wait_ms()
+        if wait_ms is not None:
+            timings["queue_wait_ms"] = wait_ms   # not part of total_ms / stage timings
+        finished = set(ckpt["stages"])
+        if finished:
+            print(f"[sse] ↩ job {job_id[:8]} resuming after {sorted(finished)} (Last-Event-ID {last_id})")
+            timings["resumed_stages"] = float(len(finished))
+            yield _hb_line("resume")
+        # every checkpointed event; each client's stream drops the ones it already has
+        yield from ckpt["events"]
+        if ckpt.get("final"):
+            state["final"] = ckpt["final"]
+            return
+        for i, st in enumerate(VARIANTS[variant]):
+            if st in finished:
+                continue
+            if cancel.cancelled:
+                skip_rest(i)
+                return
+            state["stage"] = st
+            ok = yield from sse_stages[st]()
+            if not ok:
+                record_variant(variant, 0.0, False, usage)
+                return
+
+        # build full API payload, persist + final done
+        total_ms = round((time.perf_counter() - t_total) * 1000.0, 2)
+        final_payload = _finalize_payload(pipeline_result(total_ms), image_paths)
+        record_variant(variant, total_ms, True, usage)
+        _persist_history(final_payload, history_path, job.get("user", ""))
+        state["final"] = ckpt["final"] = final_payload
+        yield stage_event("done", final_payload)
+
+    def skip_rest(i: int):
+        rest = [st for st in VARIANTS[variant][i:] if st not in ckpt["stages"]]
+        count_cancel("stages_skipped", len(rest))
+        print(f"[sse] ✋ job {job_id[:8]} cancelled ({cancel.reason}); skipped {rest}")
+
+    def event_stream() -> Generator[str, None, None]:
+        try:
+            yield from stages()
+        except GeneratorExit:
+            # the server closed the stream because the client went away
+            if "final" not in state and cancel.cancel("client_disconnected"):
+                skip_rest(VARIANTS[variant].index(state["stage"]) + 1)
+            raise
+        except Cancelled:
+            # client gone: no events, no failure recorded; finished stages stay checkpointed
+            skip_rest(VARIANTS[variant].index(state["stage"]) + 1)
+        except Exception as e:
+            # deadline exceeded, circuit open, non-retryable API error
+            record_variant(variant, 0.0, False, usage)
+            yield _sse_pack("error", {"stage": state["stage"], "msg": str(e), "timings": timings})
+            yield _sse_pack("done", {"error": "pipeline_exception"})
+
+    return event_stream(), lambda: (state.get("final"), None if state.get("final") else "pipeline_failed")
+
+# Analyses queued or running on the job queue, per job + model + variant + inputs, so
+# the SSE request finds the run /upload already started.
+_RUNS: Dict[str, Flight] = {}
+_RUNS_LOCK = threading.Lock()
+
+def _sse_flight(job_id: str, job: Dict[str, Any], model: str, variant: str, inputs: Dict[str, Any],
+                use_cache: bool, lane: str, last_id: int = 0) -> Tuple[Flight, str]:
+    """
+    (flight streaming this analysis, SSE comment for the subscriber): the run /upload queued
+    ("queued"), an identical analysis of another upload ("coalesced"), or a new run
+    queued on `lane` (""). Raises QueueFull when the lane has no room.
+    """
+    run_key = f"{job_id}:{model}:{variant}:{json.dumps(inputs, sort_keys=True)}"
+    with _RUNS_LOCK:
+        prev = _RUNS.get(run_key)
+    if prev is not None and not prev.live:
+        # cancelled run still finishing its stage: let it checkpoint before resuming from it
+        prev.wait(timeout=5.0)
+    with _RUNS_LOCK:
+        flight = _RUNS.get(run_key)
+        if flight is not None and flight.live:
+            return flight, "queued"
+        key = flight_key(job.get("originals") or job.get("paths", []), model, variant, inputs, use_cache)
+        flight, leader = join("sse", key)
+        if not leader:
+            print(f"[single_flight] 🔗 /analyze_sse job {job_id[:8]} joined flight {flight.key[:10]}")
+            return flight, "coalesced"
+        flight = flight or Flight("sse", key)   # single-flight off: a flight of its own
+        cancel = CancelToken()   # fired when nobody is reading the stream any more
+        flight.token = cancel    # set before the run starts: a client may leave while it is queued
+        gen, outcome = _sse_pipeline(job_id, job, model, variant, inputs, use_cache, cancel, last_id)
+
+        def run():
+            try:
+                produce(flight, gen, outcome, cancel)
+            finally:
+                with _RUNS_LOCK:
+                    if _RUNS.get(run_key) is flight:
+                        del _RUNS[run_key]
+        try:
+            submit(lane, run, name=f"sse-{job_id[:8]}")
+        except QueueFull:
+            flight.finish(error="queue_full")
+            raise
+        if job_id:
+            _RUNS[run_key] = flight
+    return flight, ""
+
+def _busy(qf: QueueFull):
+    # admission control: fail fast while the lane's queue is full
+    resp = jsonify({"error": "queue_full", "lane": qf.lane, "retry_after_s": qf.retry_after})
+    resp.headers["Retry-After"] = str(qf.retry_after)
+    return resp, 429
+
+SSE_HEADERS = {
+    "Content-Type": "text/event-stream",
+    "Cache-Control": "no-cache, no-transform",  # critical for Cloudflare/proxies
+    "X-Accel-Buffering": "no",
+    "Connection": "keep-alive",
+    "Access-Control-Allow-Origin": "*",
+}
+
+@app.get("/analyze_sse")
+def analyze_sse():
+    """
+    SSE stream: emits events 'recognize', 'ing_quant', 'calories', 'done' (and possibly 'error').
+    While a stage is still generating: 'dish_partial' (dish / ingredients so far) and
+    'ing_item' (one per ingredient object as soon as it closes).
+    Query: job_id, model(optional), nocache(optional), variant(optional; only that
+    variant's stage events are sent) plus dish / ingredients / items for partial variants.
+    Stage results and 'done' carry `id:`; a reconnect with Last-Event-ID (or ?last_event_id=)
+    gets finished stages replayed from the job's checkpoint and only runs the rest.
+    """
+    opened, err = _start_sse()
+    if err:
+        return err
+    flight, note, last_id = opened
+
+    def subscribe() -> Generator[str, None, None]:
+        if note:
+            yield _hb_line(note)
+        yield from flight.follow(_hb_line)
+    return Response(_after_event_id(subscribe(), last_id), headers=SSE_HEADERS)
+
+def _start_sse():
+    """
+    Validate an /analyze_sse request and subscribe it to its queued run:
+    ((flight, first SSE comment, Last-Event-ID), None) or (None, error response).
+    Needs a request context; shared by the Flask route and asgi_app.
+    """
+    variant = _variant()
+    if variant not in VARIANTS:
+        return None, (jsonify({"error": "unknown_variant", "msg": f"variant must be one of {list(VARIANTS)}"}), 400)
+    inputs = _variant_inputs()
+    job_id = request.args.get("job_id", "")
+    image_paths: List[str] = []
+    job: Dict[str, Any] = {}
+    if needs_images(variant):
+        if not job_id:
+            return None, (jsonify({"error": "missing_job_id"}), 400)
+        job = _load_job(job_id)
+        image_paths = job.get("paths", [])
+        if not image_paths:
+            return None, (jsonify({"error": "invalid_job_id"}), 404)
+    elif not inputs.get("items"):
+        return None, (jsonify({"error": "missing_items", "msg": "variant 'calories' needs items=[{name, grams}]"}), 400)
+
+    model    = request.args.get("model") or DEFAULT_MODEL
+    use_cache = _use_cache()
+    last_id = _last_event_id()
+    if _user() and not job.get("user"):
+        job = {**job, "user": _user()}   # image-less variants have no /upload manifest
+
+    # the pipeline runs on the job queue; this request only subscribes to its events
+    try:
+        flight, note = _sse_flight(job_id, job, model, variant, inputs, use_cache, "interactive", last_id)
+    except QueueFull as qf:
+        return None, _busy(qf)
+    return (flight, note, last_id), None
+
+# ------------------------------
+# Batch of meals (NDJSON)
+# ------------------------------
+_MEAL_FIELD = re.compile(r"^meals?\[?(\d+)\]?(\[\])?$")
+
+def _gather_meals() -> List[Dict[str, Any]]:
+    """Multipart `meals[<i>]` / `meal<i>` fields (repeat one for more angles) + `job_ids` from /upload."""
+    by_index: Dict[int, List] = {}
+    for field in request.files:
+        m = _MEAL_FIELD.match(field)
+        if m:
+            files = [f for f in request.files.getlist(field) if f and f.filename]
+            if files:
+                by_index.setdefault(int(m.group(1)), []).extend(files)
+    meals: List[Dict[str, Any]] = []
+    for i in sorted(by_index):
+        meals.append({"paths": _save_uploads(by_index[i]), "field": i})
+    body = request.get_json(silent=True) or {}
+    ids = body.get("job_ids") if "job_ids" in body else request.values.get("job_ids")
+    if isinstance(ids, str):
+        try:
+            ids = json.loads(ids) if ids.strip().startswith("[") else ids.split(",")
+        except ValueError:
+            ids = []
+    for job_id in [str(x).strip() for x in (ids or []) if str(x).strip()]:
+        job = _load_job(job_id)
+        if not job.get("paths"):
+            raise LookupError(job_id)
+        meals.append({"paths": job.get("originals") or job["paths"], "model_paths": job["paths"],
+                      "normalize": job.get("normalize"), "job_id": job_id, "user": job.get("user", "")})
+    return meals
+
+@app.post("/analyze_batch")
+def analyze_batch():
+    """
+    Many meals, one request; NDJSON stream with one line per meal as soon as it is done
+    ({"meal": i, ...same payload as /analyze} or {"meal": i, "error": ...}), then a
+    {"summary": {meals_per_min, wall_ms, calorie_packs, ...}} line. Blank lines are keepalives.
+    Meals: multipart `meals[<i>]` (or `meal<i>`) fields, repeated for more angles of the
+    same meal, and/or `job_ids` (JSON list or comma list) from /upload.
+    Optional: model, variant (an image variant ending in calories), nocache.
+    Runs on the job queue's batch lane; 429 + Retry-After when that lane is full.
+    """
+    flight, err = _start_batch()
+    if err:
+        return err
+    return Response(flight.follow(_ndjson_keepalive), headers=NDJSON_HEADERS)
+
+NDJSON_HEADERS = {"Content-Type": "application/x-ndjson", "Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+def _ndjson_keepalive() -> str:
+    return "\n"
+
+def _start_batch():
+    """
+    Validate an /analyze_batch request, save its meals and queue the batch:
+    (flight of NDJSON lines, None) or (None, error response). Needs a request context;
+    shared by the Flask route and asgi_app.
+    """
+    variant = _variant()
+    if variant not in VARIANTS or not needs_images(variant) or VARIANTS[variant][-1] != "calories":
+        ok = [v for v in VARIANTS if needs_images(v) and VARIANTS[v][-1] == "calories"]
+        return None, (jsonify({"error": "unknown_variant", "msg": f"variant must be one of {ok}"}), 400)
+    try:
+        admit("batch")   # before saving any upload
+        meals = _gather_meals()
+    except QueueFull as qf:
+        return None, _busy(qf)
+    except ValueError as ve:
+        return None, (jsonify({"error": "bad_extension", "msg": str(ve)}), 400)
+    except LookupError as le:
+        return None, (jsonify({"error": "invalid_job_id", "msg": str(le)}), 404)
+    if not meals:
+        return None, (jsonify({"error": "missing_meals", "msg": "multipart 'meals[<i>]' fields or 'job_ids' required"}), 400)
+    if len(meals) > BATCH_MAX_MEALS:
+        return None, (jsonify({"error": "too_many_meals", "msg": f"at most {BATCH_MAX_MEALS} meals per batch"}), 413)
+
+    project  = os.getenv("GOOGLE_CLOUD_PROJECT")
+    location = os.getenv("GOOGLE_CLOUD_LOCATION", "global")
+    model    = request.values.get("model") or DEFAULT_MODEL
+    use_cache = _use_cache()
+    user     = _user()
+    print(f"[batch] 🍱 {len(meals)} meals [{variant}] on {model}")
+
+    token = CancelToken()   # fired when the client stops reading
+
+    def lines():
+        for kind, i, res in run_batch(meals, project, location, model, variant, use_cache, token=token):
+            if kind == "keepalive":
+                yield "\n"
+                continue
+            if kind == "summary":
+                yield json.dumps({"summary": res}, ensure_ascii=False) + "\n"
+                continue
+            meal = meals[i]
+            ref = {"meal": i, **({"job_id": meal["job_id"]} if meal.get("job_id") else {})}
+            if res.get("error"):
+                yield json.dumps({**ref, "error": res["error"], "dish": res.get("dish") or None}, ensure_ascii=False) + "\n"
+                continue
+            data = _finalize_payload(res, meal["paths"])
+            _persist_history(data, meal["paths"][0], meal.get("user") or user)
+            yield json.dumps({**ref, **data}, ensure_ascii=False) + "\n"
+
+    flight = Flight("batch", uuid.uuid4().hex)   # this request's own line log
+    flight.token = token
+    try:
+        submit("batch", lambda: produce(flight, lines(), lambda: (None, None), token), name=f"batch-{len(meals)}")
+    except QueueFull as qf:
+        return None, _busy(qf)
+    return flight, None
 
 @app.get("/history")
 def history():
-    limit = int(request.args.get("limit", 20))
-    files = [f for f in os.listdir(UPLOAD_DIR) if f.lower().endswith(".json")]
-    files.sort(reverse=True)
-    items = []
-    for fname in files[:limit]:
-        try:
-            with open(os.path.join(UPLOAD_DIR, fname), "r", encoding="utf-8") as f:
-                rec = json.load(f)
-            items.append({
-                "id": fname,
-                "dish": rec.get("dish"),
-                "dish_confidence": rec.get("dish_confidence"),
-                "total_kcal": rec.get("total_kcal"),
-                "total_protein_g": rec.get("total_protein_g"),
-                "total_carbs_g": rec.get("total_carbs_g"),
-                "total_fat_g": rec.get("total_fat_g"),
-                "created_at": rec.get("created_at"),
-                "total_ms": rec.get("total_ms"),
-            })
-        except Exception:
-            continue
-    return jsonify({"items": items})
+    """
+    Analysis history, newest first, from the history_store index.
+    Query: limit (≤ HISTORY_PAGE_MAX), cursor (next_cursor of the previous page),
+    from / to (UTC YYYY-MM-DD inclusive, or ISO timestamps), dish (exact, any case),
+    min_kcal / max_kcal, user (X-User-Id or ?user=), fields=dish,total_kcal,... (summary
+    projection), full=1 (whole record).
+    """
+    a = request.args
+    try:
+        page = query_history(
+            limit=int(a.get("limit", 20)), cursor=a.get("cursor"),
+            date_from=a.get("from"), date_to=a.get("to"), dish=a.get("dish"),
+            min_kcal=float(a["min_kcal"]) if a.get("min_kcal") else None,
+            max_kcal=float(a["max_kcal"]) if a.get("max_kcal") else None,
+            fields=[f.strip() for f in a["fields"].split(",") if f.strip()] if a.get("fields") else None,
+            full=a.get("full", "").lower() in ("1", "true", "yes"),
+            user=_user() or None,
+        )
+    except ValueError as ve:
+        return jsonify({"error": "bad_query", "msg": str(ve)}), 400
+    return jsonify(page)
+
+@app.get("/history/rollups")
+def history_rollups():
+    """
+    Daily or weekly nutrition totals from the incrementally kept rollups (no record scan).
+    Query: period=day|week, from / to (UTC YYYY-MM-DD, inclusive; default last 30 days /
+    12 weeks), user (X-User-Id or ?user=; default every user).
+    """
+    a = request.args
+    try:
+        return jsonify(query_rollups((a.get("period") or "day").lower(), a.get("from"), a.get("to"), _user() or None))
+    except ValueError as ve:
+        return jsonify({"error": "bad_query", "msg": str(ve)}), 400
+
+@app.delete("/history/<rec_id>")
+def history_delete(rec_id: str):
+    """Forget one analysis: its index row, its day/week rollups and its <image>.json."""
+    rec_id = secure_filename(rec_id)
+    if not rec_id.endswith(".json") or not delete_history(rec_id):
+        return jsonify({"error": "not_found", "id": rec_id}), 404
+    try:
+        os.remove(os.path.join(UPLOAD_DIR, rec_id))
+    except FileNotFoundError:
+        pass
+    return jsonify({"deleted": rec_id}), 200
 
 if __name__ == "__main__":
     port = int(os.getenv("PORT", "5000"))
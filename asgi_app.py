@@ -0,0 +1,129 @@
+# asgi_app.py
+import os, io, asyncio
+from typing import Any, Dict, Optional, Tuple
+
+from a2wsgi import WSGIMiddleware
+from a2wsgi.wsgi import build_environ
+from flask import Response
+from werkzeug.exceptions import HTTPException, RequestEntityTooLarge
+
+from app import (app as flask_app, _start_sse, _start_batch, _resume_filter, _hb_line, _ndjson_keepalive,
+                 SSE_HEADERS, NDJSON_HEADERS)
+
+# Async serving mode:  uvicorn asgi_app:app --host 0.0.0.0 --port 8080
+# The two streaming routes (/analyze_sse, /analyze_batch) are served on the event loop:
+# the request is validated and its job queued by the same Flask code (_start_sse /
+# _start_batch, on a short-lived thread), then the stream tails the job's Flight with
+# Flight.afollow(). An idle SSE connection is a coroutine parked on an asyncio.Event,
+# not an OS thread blocked in follow(). Stages, payloads (_finalize_payload, _sse_pack)
+# and checkpoints are untouched: they run on the job queue exactly as under gunicorn.
+# Every other route goes to the Flask app through a2wsgi's thread pool.
+# Flights and the job queue live in the process: run one uvicorn worker per container
+# (or sticky sessions), as with the gunicorn setup.
+ASGI_WSGI_THREADS = int(os.getenv("ASGI_WSGI_THREADS", "16"))
+MAX_BODY = flask_app.config.get("MAX_CONTENT_LENGTH") or 25 * 1024 * 1024
+STREAMS = {("GET", "/analyze_sse"): "sse", ("POST", "/analyze_batch"): "batch"}
+
+_wsgi = WSGIMiddleware(flask_app, workers=ASGI_WSGI_THREADS)
+
+def _open(kind: str, environ: Dict[str, Any]) -> Tuple[Optional[Tuple[Any, str, int]], Response]:
+    """
+    Run the Flask validation + queueing for one streaming request (worker thread).
+    ((flight, first chunk, Last-Event-ID), response head) or (None, full error response);
+    the response goes through after_request (CORS) like the Flask route's would.
+    """
+    with flask_app.request_context(environ):
+        try:
+            if kind == "sse":
+                opened, err = _start_sse()
+                if opened:
+                    flight, note, last_id = opened
+                    opened = (flight, _hb_line(note) if note else "", last_id)
+                headers = SSE_HEADERS
+            else:
+                flight, err = _start_batch()
+                opened, headers = ((flight, "", 0) if flight else None), NDJSON_HEADERS
+            resp = flask_app.make_response(err) if err else Response(headers=headers)
+        except HTTPException as e:   # e.g. 413 from the form parser
+            opened, resp = None, flask_app.make_response(flask_app.handle_http_exception(e))
+        return opened, flask_app.process_response(resp)
+
+async def _read_body(receive) -> Optional[bytes]:
+    """The whole request body (None if the client left first); raises on > MAX_CONTENT_LENGTH."""
+    body, more = bytearray(), True
+    while more:
+        msg = await receive()
+        if msg["type"] == "http.disconnect":
+            return None
+        body += msg.get("body", b"")
+        more = msg.get("more_body", False)
+        if len(body) > MAX_BODY:
+            raise RequestEntityTooLarge()
+    return bytes(body)
+
+def _head(resp: Response) -> Dict[str, Any]:
+    headers = [(k.lower().encode("latin1"), v.encode("latin1")) for k, v in resp.headers.items()
+               if k.lower() != "content-length" or resp.status_code >= 300]
+    return {"type": "http.response.start", "status": resp.status_code, "headers": headers}
+
+async def _stream(kind: str, scope, receive, send):
+    try:
+        body = await _read_body(receive)
+    except RequestEntityTooLarge as e:
+        resp = e.get_response()
+        await send(_head(resp))
+        await send({"type": "http.response.body", "body": resp.get_data()})
+        return
+    if body is None:
+        return
+    environ = build_environ(scope, io.BytesIO(body))
+    opened, resp = await asyncio.to_thread(_open, kind, environ)
+    if opened is None:
+        await send(_head(resp))
+        await send({"type": "http.response.body", "body": resp.get_data()})
+        return
+
+    flight, first, last_id = opened
+    keep = _resume_filter(last_id) if kind == "sse" else None
+    chunks = flight.afollow(_hb_line if kind == "sse" else _ndjson_keepalive)
+
+    async def pump():
+        await send(_head(resp))
+        if first:
+            await send({"type": "http.response.body", "body": first.encode(), "more_body": True})
+        async for chunk in chunks:
+            if keep is None or keep(chunk):
+                await send({"type": "http.response.body", "body": chunk.encode(), "more_body": True})
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+    async def gone():
+        while (await receive())["type"] != "http.disconnect":
+            pass
+
+    # (open async streams: single_flight_stats()["async_streams_open"] in /stats)
+    tasks = [asyncio.ensure_future(pump()), asyncio.ensure_future(gone())]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await chunks.aclose()   # detach -> an orphaned run gets cancelled (single_flight)
+
+async def _lifespan(receive, send):
+    while True:
+        msg = await receive()
+        if msg["type"] == "lifespan.startup":
+            print(f"[asgi] 🚀 streaming routes on the event loop, WSGI pool {ASGI_WSGI_THREADS} threads")
+            await send({"type": "lifespan.startup.complete"})
+        elif msg["type"] == "lifespan.shutdown":
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await _lifespan(receive, send)
+    kind = STREAMS.get((scope.get("method"), scope.get("path"))) if scope["type"] == "http" else None
+    if kind:
+        return await _stream(kind, scope, receive, send)
+    return await _wsgi(scope, receive, send)
@@ -0,0 +1,297 @@
+# calorie_engine.py
+import os, re, csv, time, asyncio, difflib, threading
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+from gemini_calories import calories_from_ingredients, calories_from_ingredients_async, calories_for_meals_async, fnum, is_oil
+from gemini_cascade import cascaded, acascaded, asettle, first_model
+
+# Calories stage without the LLM round trip: [{name, grams}] -> kcal/macros from an
+# offline USDA FoodData Central extract (data/fdc_foods.csv, per 100 g, cooked forms
+# unless the description says otherwise). Names are matched exactly (after dropping prep
+# words), then as '<known name> + frying words' ("fried rice"), then fuzzily (difflib);
+# only the names left over go to calories_from_ingredients.
+# The oil rule is the same as the prompt's: with a positive 'oil' item all added fat is
+# booked on it, so frying oil included in fried rows is taken back out; without one,
+# fried items that matched a plain row get LOCAL_FRIED_OIL_PCT g absorbed oil per 100 g.
+ENGINE = os.getenv("CALORIE_ENGINE", "local").lower()          # local | llm
+TABLE_PATH = os.getenv("FDC_TABLE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "fdc_foods.csv"))
+MATCH_CUTOFF = float(os.getenv("LOCAL_MATCH_CUTOFF", "0.82"))
+MATCH_MIN_LEN = int(os.getenv("LOCAL_MATCH_MIN_LEN", "5"))         # shortest word a typo is allowed in
+MATCH_AMBIGUITY = float(os.getenv("LOCAL_MATCH_AMBIGUITY", "0.03"))  # runner-up this close -> LLM
+FRIED_OIL_PCT = float(os.getenv("LOCAL_FRIED_OIL_PCT", "5"))
+LOCAL_CONFIDENCE = float(os.getenv("LOCAL_CALORIE_CONFIDENCE", "0.85"))
+OIL_KCAL_PER_G = 8.84
+
+_FILLER = {"cooked", "fresh", "plain", "raw", "boiled", "steamed", "grilled", "roasted", "baked", "sliced",
+           "chopped", "diced", "shredded", "cubed", "halved", "minced", "boneless", "skinless", "whole", "large",
+           "small", "medium", "and", "with", "of", "the", "a", "in", "on", "some", "piece", "pieces"}
+_FRIED = {"fried", "deep", "pan", "stir", "tempura", "breaded", "battered", "karaage", "katsu", "crispy"}
+
+_LOCK = threading.Lock()
+_STATS = {"calls": 0, "items": 0, "matched": 0, "unmatched": 0, "llm_fallbacks": 0, "local_ms_total": 0.0,
+          "packed_calls": 0, "packed_meals": 0}
+_TABLE: Optional[Dict] = None
+
+def _key(name: str) -> str:
+    words = re.findall(r"[a-z]+", (name or "").lower())
+    toks = {w[:-1] if len(w) > 3 and w.endswith("s") and not w.endswith("ss") else w
+            for w in words if w not in _FILLER}
+    return " ".join(sorted(toks))
+
+def load_table(path: str = TABLE_PATH) -> Dict:
+    """{rows, per_g (n x 4 kcal/protein/carbs/fat per g), absorbed (n,), keys {key: row}}; cached."""
+    global _TABLE
+    if _TABLE is not None and _TABLE["path"] == path:
+        return _TABLE
+    with _LOCK:
+        if _TABLE is None or _TABLE["path"] != path:
+            with open(path, newline="", encoding="utf-8") as f:
+                rows = list(csv.DictReader(f))
+            keys: Dict[str, int] = {}
+            for i, r in enumerate(rows):
+                for alias in [r["name"]] + [a for a in (r.get("aliases") or "").split("|") if a]:
+                    keys.setdefault(_key(alias), i)
+            per_g = np.array([[float(r[c] or 0) for c in ("kcal", "protein_g", "carbs_g", "fat_g")] for r in rows]) / 100.0
+            absorbed = np.array([float(r.get("absorbed_fat_g") or 0) for r in rows]) / 100.0
+            _TABLE = {"path": path, "rows": rows, "per_g": per_g, "absorbed": absorbed, "keys": keys,
+                      "key_list": list(keys), "key_tokens": {k: set(k.split()) for k in keys}}
+            print(f"[calories] 📚 loaded {len(rows)} foods / {len(keys)} names from {os.path.basename(path)}")
+    return _TABLE
+
+def _same_words(words: List[str], cand: List[str]) -> bool:
+    if len(words) != len(cand):
+        return False
+    left = list(cand)
+    for w in words:
+        hit = next((c for c in left if c == w or (min(len(c), len(w)) >= MATCH_MIN_LEN
+                                                  and difflib.SequenceMatcher(None, w, c).ratio() >= MATCH_CUTOFF)), None)
+        if hit is None:
+            return False
+        left.remove(hit)
+    return True
+
+def match_food(name: str, table: Optional[Dict] = None) -> Tuple[Optional[int], float]:
+    """(row index, score) for an ingredient name, or (None, best score) if nothing is close enough."""
+    t = table or load_table()
+    k = _key(name)
+    if not k:
+        return None, 0.0
+    if k in t["keys"]:
+        return t["keys"][k], 1.0
+    # a known name plus frying words only ("fried rice" -> rice, the oil rule adds the fat);
+    # anything else left over ("pork belly" vs pork) changes the food, so it goes to the LLM
+    toks = set(k.split())
+    best, best_rank = None, (0, 0.0)
+    for cand, ctoks in t["key_tokens"].items():
+        if ctoks <= toks and (toks - ctoks) <= _FRIED and not ctoks <= _FRIED:
+            rank = (len(ctoks), difflib.SequenceMatcher(None, k, cand).ratio())
+            if rank > best_rank:
+                best, best_rank = cand, rank
+    if best is not None:
+        return t["keys"][best], round(best_rank[1], 3)
+    # fuzzy: spelling only. Word for word, each name word is a candidate word or a typo of
+    # one at least MATCH_MIN_LEN letters long ("pear" is not "pea", "rice wine" is not
+    # "white rice"), and a close runner-up for a different food makes the name ambiguous;
+    # either way it goes to the LLM.
+    close = [(difflib.SequenceMatcher(None, k, c).ratio(), c)
+             for c in difflib.get_close_matches(k, t["key_list"], n=3, cutoff=MATCH_CUTOFF)
+             if _same_words(k.split(), c.split())]
+    close.sort(reverse=True)
+    if not close:
+        return None, 0.0
+    score, cand = close[0]
+    if any(t["keys"][c] != t["keys"][cand] and score - sc <= MATCH_AMBIGUITY for sc, c in close[1:]):
+        return None, round(score, 3)
+    return t["keys"][cand], round(score, 3)
+
+def local_calories(items: List[Dict], oil_present: Optional[bool] = None) -> Dict:
+    """
+    Output: same shape as calories_from_ingredients for the matched items, plus
+    'unmatched': [input indices] that still need pricing.
+    """
+    t = load_table()
+    idx, rows_i = [], []
+    unmatched = []
+    for i, it in enumerate(items):
+        r, _ = match_food(str(it.get("name", "")), t)
+        if r is None:
+            unmatched.append(i)
+        else:
+            idx.append(i)
+            rows_i.append(r)
+    if oil_present is None:
+        oil_present = any(is_oil(it.get("name", "")) and fnum(it.get("grams")) > 0 for it in items)
+
+    out_items: List[Optional[Dict]] = [None] * len(items)
+    if idx:
+        r = np.array(rows_i)
+        grams = np.array([max(0.0, fnum(items[i].get("grams"))) for i in idx])
+        vals = t["per_g"][r] * grams[:, None]                   # kcal, protein, carbs, fat
+        names = [str(items[i].get("name", "")) for i in idx]
+        not_oil = np.array([not is_oil(n) for n in names])
+        if oil_present:
+            # frying fat already booked on the oil item: drop what the fried rows carry
+            fat_adj = -t["absorbed"][r] * grams * not_oil
+        else:
+            fried = np.array([bool(set(re.findall(r"[a-z]+", n.lower())) & _FRIED) for n in names])
+            fat_adj = (FRIED_OIL_PCT / 100.0) * grams * fried * (t["absorbed"][r] == 0) * not_oil
+        vals[:, 3] += fat_adj
+        vals[:, 0] += fat_adj * OIL_KCAL_PER_G
+        vals = np.clip(vals, 0.0, None).round(1)
+        for j, i in enumerate(idx):
+            kcal, p, c, f = vals[j].tolist()
+            out_items[i] = {"name": str(items[i].get("name", "")).strip(), "kcal": kcal, "protein_g": p,
+                            "carbs_g": c, "fat_g": f, "method": f"fdc: {t['rows'][rows_i[j]]['fdc_description']}"}
+    totals = vals.sum(axis=0).round(1).tolist() if idx else [0.0, 0.0, 0.0, 0.0]
+    return {
+        "items": out_items,
+        "total_kcal": totals[0], "total_protein_g": totals[1], "total_carbs_g": totals[2], "total_fat_g": totals[3],
+        "confidence": LOCAL_CONFIDENCE,
+        "notes": ("added oil counted on the oil item only" if oil_present
+                  else "no oil item; fried items include typical absorbed oil"),
+        "unmatched": unmatched,
+    }
+
+def _merge(items: List[Dict], loc: Dict, llm: Optional[Dict]) -> Dict:
+    llm_items = iter((llm or {}).get("items") or [])
+    out = []
+    for it in loc["items"]:
+        out.append(it if it is not None else next(llm_items, None) or {})
+    kcal_loc = loc["total_kcal"]
+    kcal_llm = fnum((llm or {}).get("total_kcal"))
+    conf = loc["confidence"]
+    if llm:
+        conf = round((kcal_loc * loc["confidence"] + kcal_llm * fnum(llm.get("confidence"), 0.6))
+                     / max(1e-6, kcal_loc + kcal_llm), 2)
+    total = lambda k: round(sum(fnum(x.get(k)) for x in out), 1)
+    notes = loc["notes"] + (f"; LLM priced {len(loc['unmatched'])} unmatched item(s)" if llm else "")
+    if llm and llm.get("notes"):
+        notes += f" ({llm['notes']})"
+    return {"items": out, "total_kcal": total("kcal"), "total_protein_g": total("protein_g"),
+            "total_carbs_g": total("carbs_g"), "total_fat_g": total("fat_g"), "confidence": conf, "notes": notes}
+
+def _record(items: List[Dict], loc: Dict, ms: float, timings: Optional[Dict[str, float]]):
+    n_un = len(loc["unmatched"])
+    with _LOCK:
+        _STATS["calls"] += 1
+        _STATS["items"] += len(items)
+        _STATS["matched"] += len(items) - n_un
+        _STATS["unmatched"] += n_un
+        _STATS["llm_fallbacks"] += 1 if n_un else 0
+        _STATS["local_ms_total"] = round(_STATS["local_ms_total"] + ms, 3)
+    if timings is not None:
+        timings["calories_local_ms"] = ms
+        timings["calories_matched"] = float(len(items) - n_un)
+        timings["calories_unmatched"] = float(n_un)
+    print(f"[calories] 🧮 local: {len(items) - n_un}/{len(items)} matched in {ms} ms"
+          + (f", LLM for {[items[i].get('name') for i in loc['unmatched']]}" if n_un else ""))
+
+def _local_part(items: List[Dict], timings) -> Tuple[Dict, List[Dict], float]:
+    t0 = time.perf_counter()
+    loc = local_calories(items)
+    ms = round((time.perf_counter() - t0) * 1000.0, 3)
+    _record(items, loc, ms, timings)
+    oil_g = max([fnum(it.get("grams")) for it in items if is_oil(it.get("name", ""))] or [0.0])
+    return loc, [items[i] for i in loc["unmatched"]], oil_g
+
+def local_pass(items: List[Dict], timings: Optional[Dict[str, float]] = None
+               ) -> Optional[Tuple[Dict, List[Dict], float]]:
+    """(local result, items left for the LLM, oil grams), or None with CALORIE_ENGINE=llm.
+    Hand it back as meal["local"] to estimate_calories_many_async."""
+    return _local_part(items, timings) if ENGINE == "local" else None
+
+def estimate_calories(project: Optional[str], location: str, model: str, dish_hint: str, items: List[Dict],
+                      timings: Optional[Dict[str, float]] = None, usage: Optional[List[Dict]] = None,
+                      use_cache: bool = True) -> Dict:
+    """
+    calories_from_ingredients drop-in: local table first, the LLM only for names it can't match.
+    model="cascade" runs that LLM part through gemini_cascade.
+    """
+    if ENGINE != "local":
+        return cascaded("calories", model, lambda m: calories_from_ingredients(
+            project, location, m, dish_hint, items, timings=timings, usage=usage, use_cache=use_cache), timings, items)
+    loc, rest, oil_g = _local_part(items, timings)
+    llm = None
+    if rest:
+        llm = cascaded("calories", model, lambda m: calories_from_ingredients(
+            project, location, m, dish_hint, rest, timings=timings, usage=usage, oil_g=oil_g,
+            use_cache=use_cache), timings, rest)
+        if "error" in llm:
+            return llm
+    return _merge(items, loc, llm)
+
+async def estimate_calories_async(project: Optional[str], location: str, model: str, dish_hint: str, items: List[Dict],
+                                  timings: Optional[Dict[str, float]] = None, usage: Optional[List[Dict]] = None,
+                                  use_cache: bool = True) -> Dict:
+    if ENGINE != "local":
+        return await acascaded("calories", model, lambda m: calories_from_ingredients_async(
+            project, location, m, dish_hint, items, timings=timings, usage=usage, use_cache=use_cache), timings, items)
+    loc, rest, oil_g = _local_part(items, timings)
+    llm = None
+    if rest:
+        llm = await acascaded("calories", model, lambda m: calories_from_ingredients_async(
+            project, location, m, dish_hint, rest, timings=timings, usage=usage, oil_g=oil_g,
+            use_cache=use_cache), timings, rest)
+        if "error" in llm:
+            return llm
+    return _merge(items, loc, llm)
+
+async def estimate_calories_many_async(project: Optional[str], location: str, model: str, meals: List[Dict],
+                                       usage: Optional[List[Dict]] = None, use_cache: bool = True) -> List[Dict]:
+    """
+    estimate_calories for several meals ([{dish, items, timings?, local?}]): the local table
+    per meal (unless local_pass already ran), then ONE packed LLM call for all the names it couldn't match. A lone meal with
+    leftovers takes the single-meal path (LLM cache included). With model="cascade" the
+    packed call runs on the fast model and each meal escalates on its own. `usage` gets
+    the packed call's records (shared by the meals, so not split per meal).
+    """
+    parts = [(None, m["items"], None) if ENGINE != "local"
+             else m.get("local") or _local_part(m["items"], m.get("timings")) for m in meals]
+    pending = [i for i, (_, rest, _) in enumerate(parts) if rest]
+
+    def single(i: int):
+        m, (_, rest, oil_g) = meals[i], parts[i]
+        return lambda mdl: calories_from_ingredients_async(project, location, mdl, m.get("dish", ""), rest,
+                                                           timings=m.get("timings"), usage=usage, oil_g=oil_g,
+                                                           use_cache=use_cache)
+    llm: Dict[int, Dict] = {}
+    if len(pending) == 1:
+        i = pending[0]
+        llm[i] = await acascaded("calories", model, single(i), meals[i].get("timings"), parts[i][1])
+    elif pending:
+        t0 = time.perf_counter()
+        packed = await calories_for_meals_async(
+            project, location, first_model("calories", model),
+            [{"dish": meals[i].get("dish", ""), "items": parts[i][1], "oil_g": parts[i][2]} for i in pending],
+            usage=usage)
+        ms = round((time.perf_counter() - t0) * 1000.0, 2)
+        with _LOCK:
+            _STATS["packed_calls"] += 1
+            _STATS["packed_meals"] += len(pending)
+        print(f"[calories] 📦 priced leftovers of {len(pending)} meals in one call ({ms} ms)")
+        for i in pending:
+            if meals[i].get("timings") is not None:
+                meals[i]["timings"].update({"calories_packed_meals": float(len(pending)), "calories_llm_ms": ms})
+        settled = await asyncio.gather(*(asettle("calories", model, res, ms, single(i), meals[i].get("timings"),
+                                                 parts[i][1]) for i, res in zip(pending, packed)))
+        llm.update(zip(pending, settled))
+
+    out = []
+    for i, m in enumerate(meals):
+        loc, res = parts[i][0], llm.get(i)
+        if loc is None or (res is not None and "error" in res):
+            out.append(res)
+        else:
+            out.append(_merge(m["items"], loc, res))
+    return out
+
+def calorie_engine_stats() -> Dict:
+    with _LOCK:
+        s = dict(_STATS)
+    return {
+        "engine": ENGINE,
+        "foods": len(_TABLE["rows"]) if _TABLE else None,
+        **s,
+        "match_rate": round(s["matched"] / s["items"], 4) if s["items"] else 0.0,
+        "avg_local_ms": round(s["local_ms_total"] / s["calls"], 3) if s["calls"] else 0.0,
+    }
@@ -0,0 +1,98 @@
+# cancellation.py
+import threading, contextvars, contextlib
+from concurrent.futures import Future
+from typing import Callable, Dict, List, Optional
+
+# Cooperative cancellation for work nobody will read any more (the SSE client went away).
+# A CancelToken is made current for a pipeline run with cancel_scope() and is checked:
+#   - by gemini_policy before every attempt / retry and while waiting on a call (the
+#     caller is released at once; a blocking HTTP call is abandoned, async tasks are
+#     cancelled, which aborts the request),
+#   - by stream_json between chunks (closing the stream stops generation),
+#   - by the SSE stage loop before starting the next stage.
+# The token travels in a ContextVar; thread pools that sit between a stage and the call
+# policy submit in_context(fn) so the worker sees it.
+
+class Cancelled(RuntimeError):
+    pass
+
+_LOCK = threading.Lock()
+_STATS = {"tokens_cancelled": 0, "calls_skipped": 0, "calls_abandoned": 0, "streams_aborted": 0,
+          "async_calls_aborted": 0, "stages_skipped": 0}
+
+def count(key: str, n: int = 1):
+    with _LOCK:
+        _STATS[key] = _STATS.get(key, 0) + n
+
+class CancelToken:
+    def __init__(self):
+        self._ev = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks: List[Callable[[], None]] = []
+        self.reason = ""
+
+    @property
+    def cancelled(self) -> bool:
+        return self._ev.is_set()
+
+    def cancel(self, reason: str = "cancelled") -> bool:
+        """True if this call cancelled the token (False if it already was)."""
+        with self._lock:
+            if self._ev.is_set():
+                return False
+            self.reason = reason
+            self._ev.set()
+            callbacks, self._callbacks = self._callbacks, []
+        count("tokens_cancelled")
+        for cb in callbacks:
+            try:
+                cb()
+            except Exception:
+                pass
+        return True
+
+    def on_cancel(self, cb: Callable[[], None]):
+        with self._lock:
+            if not self._ev.is_set():
+                self._callbacks.append(cb)
+                return
+        cb()
+
+    def future(self) -> Future:
+        """Future that resolves when the token is cancelled (to wait on next to call futures)."""
+        f: Future = Future()
+        self.on_cancel(lambda: f.done() or f.set_result(self.reason))
+        return f
+
+    def wait(self, timeout: float) -> bool:
+        """Sleep up to `timeout`, waking early on cancel; True if cancelled."""
+        return self._ev.wait(timeout)
+
+    def check(self, what: str = ""):
+        if self._ev.is_set():
+            raise Cancelled(f"{what or 'work'} cancelled ({self.reason})")
+
+_CURRENT: "contextvars.ContextVar[Optional[CancelToken]]" = contextvars.ContextVar("cancel_token", default=None)
+
+def current_token() -> Optional[CancelToken]:
+    return _CURRENT.get()
+
+@contextlib.contextmanager
+def cancel_scope(token: Optional[CancelToken]):
+    reset = _CURRENT.set(token)
+    try:
+        yield token
+    finally:
+        _CURRENT.reset(reset)
+
+def in_context(fn: Callable) -> Callable:
+    """fn bound to the caller's context (cancel token included), for pool.submit."""
+    ctx = contextvars.copy_context()
+    return lambda *a, **kw: ctx.run(fn, *a, **kw)
+
+def cancel_stats() -> Dict:
+    with _LOCK:
+        s = dict(_STATS)
+    # abandoned blocking calls still run to the end on Gemini's side, so they don't count
+    s["gemini_calls_saved"] = s["calls_skipped"] + s["streams_aborted"] + s["async_calls_aborted"]
+    return s
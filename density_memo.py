@@ -0,0 +1,164 @@
+# density_memo.py
+import os, re, time, sqlite3, threading
+from typing import Dict, List, Optional, Tuple
+
+# Per-gram kcal/protein/carbs/fat learned from past calories LLM answers, keyed by
+# normalized ingredient name + cooking method (+ whether an oil item carried the added
+# fat, for fried items). Each key keeps a running mean/variance (Welford) and count.
+# A request is answered from the memo only if EVERY item has >= MEMO_MIN_SAMPLES
+# samples and a kcal/g coefficient of variation <= MEMO_MAX_CV. Memo answers are not
+# fed back, so the memo only ever learns from the model.
+ENABLED = os.getenv("DENSITY_MEMO", "1") != "0"
+MEMO_PATH = os.path.abspath(os.getenv("DENSITY_MEMO_PATH", "./cache/density_memo.sqlite"))
+MIN_SAMPLES = int(os.getenv("MEMO_MIN_SAMPLES", "5"))
+MAX_CV = float(os.getenv("MEMO_MAX_CV", "0.15"))
+
+FIELDS = ("kcal", "protein", "carbs", "fat")
+_METHODS = {"fried": "fried", "deep": "fried", "tempura": "fried", "breaded": "fried", "battered": "fried",
+            "karaage": "fried", "katsu": "fried", "crispy": "fried", "stir": "fried", "sauteed": "fried",
+            "grilled": "grilled", "roasted": "roasted", "baked": "baked", "broiled": "grilled",
+            "steamed": "boiled", "boiled": "boiled", "poached": "boiled", "raw": "raw"}
+_FILLER = {"cooked", "fresh", "plain", "sliced", "chopped", "diced", "shredded", "and", "with", "of", "the", "a", "pan"}
+
+_local = threading.local()
+_LOCK = threading.Lock()
+_STATS = {"lookups": 0, "hits": 0, "items_known": 0, "items_unknown": 0, "observed": 0}
+
+def _db() -> sqlite3.Connection:
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        os.makedirs(os.path.dirname(MEMO_PATH), exist_ok=True)
+        conn = sqlite3.connect(MEMO_PATH, timeout=5.0, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        cols = ", ".join(f"mean_{f} REAL, m2_{f} REAL" for f in FIELDS)
+        conn.execute(f"CREATE TABLE IF NOT EXISTS densities (name TEXT, method TEXT, oil INTEGER, n INTEGER, {cols},"
+                     " updated REAL, PRIMARY KEY (name, method, oil))")
+        _local.conn = conn
+    return conn
+
+def memo_key(name: str, oil_present: bool) -> Tuple[str, str, int]:
+    """('chicken', 'fried', 1) for 'Fried chicken' next to a cooking-oil item."""
+    words = re.findall(r"[a-z]+", (name or "").lower())
+    method = next((_METHODS[w] for w in words if w in _METHODS), "")
+    base = " ".join(w for w in words if w not in _METHODS and w not in _FILLER)
+    # the oil rule only changes the numbers for fried items
+    return base, method, int(oil_present) if method == "fried" else -1
+
+def is_oil(name: str) -> bool:
+    """'olive oil', 'Oil' - but not 'boiled egg' or 'broiled fish'."""
+    return re.search(r"\boils?\b", str(name or "").lower()) is not None
+
+def _oil_present(items: List[Dict], oil_g: Optional[float]) -> bool:
+    if oil_g is not None:
+        return oil_g > 0
+    return any(is_oil(it.get("name", "")) and _num(it.get("grams")) > 0 for it in items)
+
+def _num(x) -> float:
+    try:
+        return float(x)
+    except (TypeError, ValueError):
+        return 0.0
+
+def observe(items: List[Dict], result: Dict, oil_g: Optional[float] = None):
+    """Fold one successful LLM calories answer (aligned with `items`) into the memo."""
+    if not ENABLED:
+        return
+    oil = _oil_present(items, oil_g)
+    now = time.time()
+    try:
+        db = _db()
+        db.execute("BEGIN IMMEDIATE")
+        n_obs = 0
+        for src, out in zip(items, result.get("items") or []):
+            grams, kcal = _num(src.get("grams")), _num(out.get("kcal"))
+            if grams <= 0 or kcal <= 0:
+                continue   # unaligned/missing answers come back as zeros
+            name, method, oil_k = memo_key(src.get("name", ""), oil)
+            if not name:
+                continue
+            x = [kcal / grams] + [_num(out.get(f"{f}_g")) / grams for f in FIELDS[1:]]
+            row = db.execute("SELECT n, " + ", ".join(f"mean_{f}, m2_{f}" for f in FIELDS) +
+                             " FROM densities WHERE name=? AND method=? AND oil=?", (name, method, oil_k)).fetchone()
+            n, stats = (row[0], list(row[1:])) if row else (0, [0.0] * (2 * len(FIELDS)))
+            n += 1
+            for i, xi in enumerate(x):
+                mean, m2 = stats[2 * i], stats[2 * i + 1]
+                delta = xi - mean
+                mean += delta / n
+                stats[2 * i], stats[2 * i + 1] = mean, m2 + delta * (xi - mean)
+            db.execute("INSERT OR REPLACE INTO densities VALUES (?,?,?,?," + ",".join("?" * len(stats)) + ",?)",
+                       (name, method, oil_k, n, *stats, now))
+            n_obs += 1
+        db.execute("COMMIT")
+        with _LOCK:
+            _STATS["observed"] += n_obs
+    except Exception as e:
+        try:
+            _db().execute("ROLLBACK")
+        except Exception:
+            pass
+        print(f"[density_memo] write failed: {e}")
+
+def _confident(row) -> Optional[float]:
+    """kcal/g coefficient of variation if the row is trusted, else None."""
+    n, mean, m2 = row[0], row[1], row[2]
+    if n < MIN_SAMPLES or mean <= 0:
+        return None
+    cv = ((m2 / (n - 1)) ** 0.5) / mean if n > 1 else 0.0
+    return cv if cv <= MAX_CV else None
+
+def lookup(items: List[Dict], oil_g: Optional[float] = None) -> Optional[Dict]:
+    """
+    calories_from_ingredients-shaped answer when every item is known well enough, else None.
+    """
+    if not ENABLED or not items:
+        return None
+    oil = _oil_present(items, oil_g)
+    out_items, cvs, ns = [], [], []
+    known = 0
+    try:
+        db = _db()
+        for it in items:
+            name, method, oil_k = memo_key(it.get("name", ""), oil)
+            row = db.execute("SELECT n, mean_kcal, m2_kcal, mean_protein, mean_carbs, mean_fat FROM densities"
+                             " WHERE name=? AND method=? AND oil=?", (name, method, oil_k)).fetchone()
+            cv = _confident(row) if row else None
+            if cv is None:
+                continue
+            known += 1
+            grams = max(0.0, _num(it.get("grams")))
+            out_items.append({"name": str(it.get("name", "")).strip(), "kcal": round(row[1] * grams, 1),
+                              "protein_g": round(row[3] * grams, 1), "carbs_g": round(row[4] * grams, 1),
+                              "fat_g": round(row[5] * grams, 1), "method": f"memo: n={row[0]}"})
+            cvs.append(cv)
+            ns.append(row[0])
+    except Exception as e:
+        print(f"[density_memo] read failed: {e}")
+        return None
+    hit = known == len(items)
+    with _LOCK:
+        _STATS["lookups"] += 1
+        _STATS["hits"] += 1 if hit else 0
+        _STATS["items_known"] += known
+        _STATS["items_unknown"] += len(items) - known
+    if not hit:
+        return None
+    total = lambda k: round(sum(x[k] for x in out_items), 1)
+    return {
+        "items": out_items,
+        "total_kcal": total("kcal"), "total_protein_g": total("protein_g"),
+        "total_carbs_g": total("carbs_g"), "total_fat_g": total("fat_g"),
+        "confidence": round(max(0.5, 0.9 - max(cvs)), 2),
+        "notes": f"density memo (min {min(ns)} samples, max kcal/g CV {max(cvs):.2f})",
+    }
+
+def memo_stats() -> Dict:
+    out = {**_STATS, "enabled": ENABLED, "path": MEMO_PATH, "min_samples": MIN_SAMPLES, "max_cv": MAX_CV}
+    try:
+        n, trusted = _db().execute("SELECT COUNT(*), COALESCE(SUM(n >= ?),0) FROM densities", (MIN_SAMPLES,)).fetchone()
+        out.update({"keys": n, "keys_with_min_samples": trusted})
+    except Exception:
+        pass
+    out["hit_rate"] = round(_STATS["hits"] / _STATS["lookups"], 4) if _STATS["lookups"] else 0.0
+    return out
@@ -42,7 +42,24 @@ export class UploadAnalyzeComponent {
 
     this.svc.analyzeStream(req.files, req.model).subscribe({
       next: (evt) => {
-        if (evt.phase === 'recognize') {
+        if (evt.phase === 'dish_partial') {
+          const d = evt.data || {};
+          if (!this.gotRecognize) {
+            this.result.dish = d.dish;
+            this.result.ingredients_detected = d.ingredients_detected || [];
+          }
+        } else if (evt.phase === 'ing_item') {
+          const d = evt.data || {};
+          if (!this.gotIngr) {
+            const items = [...(this.result.items_grams || [])];
+            items[d.index ?? items.length] = {
+              name: d.name,
+              grams: d.grams || 0,
+              ...(d.note ? { note: d.note } : {}),
+            };
+            this.result.items_grams = items;
+          }
+        } else if (evt.phase === 'recognize') {
           this.gotRecognize = true;
           const d = evt.data || {};
           this.result.dish = d.dish;
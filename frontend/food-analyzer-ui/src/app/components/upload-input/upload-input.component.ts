@@ -14,7 +14,7 @@ export class UploadInputComponent {
   @Output() clear = new EventEmitter<void>();
 
   form = new FormGroup({
-    model: new FormControl<string>('gemini-2.5-pro'),
+    model: new FormControl<string>('cascade'),
     files: new FormControl<File[] | null>(null),
   });
 
@@ -42,13 +42,13 @@ export class UploadInputComponent {
 
   submit() {
     const files = this.form.value.files as File[] | null;
-    const model = this.form.value.model || 'gemini-2.5-pro';
+    const model = this.form.value.model || 'cascade';
     if (!files?.length) return;
     this.analyze.emit({ files, model });
   }
 
   reset() {
-    this.form.reset({ model: 'gemini-2.5-pro', files: null });
+    this.form.reset({ model: 'cascade', files: null });
     this.fileNames = [];
     this.filePreviews = [];
     this.clear.emit();
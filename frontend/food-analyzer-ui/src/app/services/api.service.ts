@@ -57,7 +57,7 @@ export class ApiService {
 
   constructor(private http: HttpClient) {}
 
-  analyze(file: File, model = 'gemini-2.5-pro'): Observable<AnalyzeResponse> {
+  analyze(file: File, model = 'cascade'): Observable<AnalyzeResponse> {
     const form = new FormData();
     form.append('image', file, file.name);
     form.append('model', model);
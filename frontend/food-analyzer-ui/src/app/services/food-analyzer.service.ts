@@ -10,7 +10,9 @@ import {
 } from '../models/analyzer.models';
 
 type StreamEvent =
+  | { phase: 'dish_partial'; data: any }
   | { phase: 'recognize'; data: any }
+  | { phase: 'ing_item'; data: any }
   | { phase: 'ing_quant'; data: any }
   | { phase: 'calories'; data: any }
   | { phase: 'done'; data: ApiResponse }
@@ -21,7 +23,7 @@ export class FoodAnalyzerService {
   constructor(private http: HttpClient) {}
 
   // Legacy non-streaming (kept for fallback)
-  analyze(files: File[], model = 'gemini-2.5-pro'): Observable<ApiResponse> {
+  analyze(files: File[], model = 'cascade'): Observable<ApiResponse> {
     const fd = new FormData();
     files.forEach((f) => fd.append('image', f));
     fd.append('model', model);
@@ -39,7 +41,7 @@ export class FoodAnalyzerService {
   // NEW: streaming flow with SSE
   analyzeStream(
     files: File[],
-    model = 'gemini-2.5-pro'
+    model = 'cascade'
   ): Observable<StreamEvent> {
     const fd = new FormData();
     files.forEach((f) => fd.append('image', f));
@@ -64,6 +66,13 @@ export class FoodAnalyzerService {
               } catch {}
             };
 
+            // partial results while the model is still generating
+            es.addEventListener('dish_partial', (e: MessageEvent) => {
+              observer.next({ phase: 'dish_partial', data: JSON.parse(e.data) });
+            });
+            es.addEventListener('ing_item', (e: MessageEvent) => {
+              observer.next({ phase: 'ing_item', data: JSON.parse(e.data) });
+            });
             es.addEventListener('recognize', (e: MessageEvent) => {
               observer.next({ phase: 'recognize', data: JSON.parse(e.data) });
             });
@@ -79,6 +88,9 @@ export class FoodAnalyzerService {
               onClose();
             });
             es.addEventListener('error', (e: MessageEvent) => {
+              // dropped connection: EventSource reconnects with Last-Event-ID and
+              // the server replays finished stages, so don't tear the stream down
+              if (!e.data && es.readyState === EventSource.CONNECTING) return;
               try {
                 observer.next({ phase: 'error', data: JSON.parse(e.data) });
               } catch {}
@@ -2,7 +2,11 @@
 import re
 from typing import Dict, List, Optional
 from google.genai import types
-from gemini_client import make_client, extract_text_from_response, first_json_block
+from gemini_client import make_client, generate_text, agenerate_text, first_json_block, json_mode, record_passes
+from gemini_policy import deadline_for
+import llm_cache
+import density_memo
+from density_memo import is_oil   # shared with calorie_engine and the memo keys
 
 def fnum(x, default=0.0) -> float:
     if isinstance(x, (int, float)):
@@ -34,31 +38,23 @@ def _items_to_text(items: List[Dict]) -> str:
         parts.append(f'{{"name":"{name}","grams":{grams}}}')
     return "[" + ", ".join(parts) + "]"
 
-def calories_from_ingredients(
-    project: Optional[str],
-    location: str,
-    model: str,
-    dish_hint: str,
-    items: List[Dict],
-) -> Dict:
-    """
-    Input: items = [{ name, grams }]
-    Output: {
-      items: [{name,kcal,protein_g,carbs_g,fat_g,method?}],
-      total_kcal,total_protein_g,total_carbs_g,total_fat_g,
-      confidence,notes?
-    }
-    Enforces "single-source-of-truth" for added oil:
-      - If a 'cooking oil' item (grams>0) exists, do NOT include added oil in any other item.
-      - If no positive 'cooking oil', fried items may include typical absorbed oil.
-    """
-    client = make_client(project or "", location)
+_KCAL_GUIDE = (
+    "For fats:\n"
+    "- generic cooking oils: 8.84 kcal/g (fat_g ~= grams, protein/carbs ~= 0)\n"
+    "- butter: 7.17 kcal/g\n"
+    "- typical cooked rice: ~1.30 kcal/g\n"
+    "- lean cooked chicken breast (no skin): ~1.65 kcal/g; fried versions are higher due to batter/skin/oil\n"
+    "Adjust intelligently by preparation words in names (steamed, boiled, fried, breaded, grilled, sauce, dressing, etc.)\n\n"
+)
 
-    # Detect oil presence in the request
-    oil_g = 0.0
-    for it in items:
-        if "oil" in (it.get("name","").lower()):
-            oil_g = max(oil_g, fnum(it.get("grams")))
+def _detect_oil(items: List[Dict], oil_g: Optional[float]) -> float:
+    # oil_g: the caller already accounted for it elsewhere
+    if oil_g is not None:
+        return oil_g
+    return max([fnum(it.get("grams")) for it in items if is_oil(it.get("name", ""))] or [0.0])
+
+def _build_prompt(dish_hint: str, items: List[Dict], oil_g: Optional[float] = None) -> str:
+    oil_g = _detect_oil(items, oil_g)
 
     oil_policy = (
         "OIL ACCOUNTING RULE:\n"
@@ -70,15 +66,10 @@ def calories_from_ingredients(
     )
 
     items_text = _items_to_text(items)
-    prompt = (
+    return (
         "You are a careful nutrition estimator for cooked dishes. You only have the item names and grams.\n"
         "Return STRICT JSON ONLY with per-item kcal/macros using sane cooked-food constants.\n"
-        "For fats:\n"
-        "- generic cooking oils: 8.84 kcal/g (fat_g ~= grams, protein/carbs ~= 0)\n"
-        "- butter: 7.17 kcal/g\n"
-        "- typical cooked rice: ~1.30 kcal/g\n"
-        "- lean cooked chicken breast (no skin): ~1.65 kcal/g; fried versions are higher due to batter/skin/oil\n"
-        "Adjust intelligently by preparation words in names (steamed, boiled, fried, breaded, grilled, sauce, dressing, etc.)\n\n"
+        + _KCAL_GUIDE
         + oil_policy +
         "\nRules:\n"
         "- Output a per-item array aligned to the input order and the same names.\n"
@@ -91,65 +82,102 @@ def calories_from_ingredients(
         "Return ONLY the JSON with keys: items,total_kcal,total_protein_g,total_carbs_g,total_fat_g,confidence,notes"
     )
 
-    # Pass 1: free JSON (deterministic)
-    cfg1 = types.GenerateContentConfig(
-        temperature=0.0,
-        max_output_tokens=2048,
-        thinking_config=types.ThinkingConfig(thinking_budget=128),
-    )
-    resp1 = client.models.generate_content(
-        model=model,
-        contents=[types.Content(role="user", parts=[types.Part.from_text(text=prompt)])],
-        config=cfg1,
+def _build_batch_prompt(meals: List[Dict]) -> str:
+    """Several meals in one request; each keeps its own dish context and oil accounting."""
+    blocks = []
+    for i, m in enumerate(meals, 1):
+        blocks.append(
+            f"Meal {i}: dish context: {m.get('dish') or '(unknown)'}; "
+            f"detected cooking oil grams: {_detect_oil(m['items'], m.get('oil_g')):.1f} g\n"
+            f"Items (name + grams): {_items_to_text(m['items'])}"
+        )
+    return (
+        "You are a careful nutrition estimator for cooked dishes, pricing several meals at once. "
+        "You only have the item names and grams.\n"
+        "Return STRICT JSON ONLY with per-item kcal/macros using sane cooked-food constants.\n"
+        + _KCAL_GUIDE +
+        "OIL ACCOUNTING RULE (applies to each meal on its own):\n"
+        "- If the meal's cooking oil grams > 0, its other items are cooked WITHOUT added oil; "
+        "all added oil kcal/macros go on its 'cooking oil' item only.\n"
+        "- If the meal's cooking oil grams == 0, you may include typical absorbed oil in its fried items.\n"
+        "\nRules:\n"
+        f"- Output exactly {len(meals)} entries in 'meals', in the input order, one per meal.\n"
+        "- Per meal: a per-item array aligned to that meal's input order and the same names, "
+        "each item {\"name\",\"kcal\",\"protein_g\",\"carbs_g\",\"fat_g\",\"method\"?}; meal totals; "
+        "confidence; brief 'notes' on oil assumptions.\n"
+        "- Use realistic macronutrient breakdowns (kcal ≈ 4*protein + 4*carbs + 9*fat, allow small drift).\n"
+        "- If unsure, choose conservative mid-range values rather than extremes.\n\n"
+        + "\n\n".join(blocks) +
+        "\n\nReturn ONLY the JSON: {\"meals\": [{items,total_kcal,total_protein_g,total_carbs_g,total_fat_g,"
+        "confidence,notes}, ...]}"
     )
-    raw1 = extract_text_from_response(resp1) or getattr(resp1, "text", "")
-    data = first_json_block(raw1)
 
-    # Pass 2: schema-enforced JSON if needed
-    if not data or any(k not in data for k in NEEDED):
-        schema = types.Schema(
-            type=types.Type.OBJECT,
-            properties={
-                "items": types.Schema(
-                    type=types.Type.ARRAY,
-                    items=types.Schema(
-                        type=types.Type.OBJECT,
-                        properties={
-                            "name":      types.Schema(type=types.Type.STRING),
-                            "kcal":      types.Schema(type=types.Type.NUMBER),
-                            "protein_g": types.Schema(type=types.Type.NUMBER),
-                            "carbs_g":   types.Schema(type=types.Type.NUMBER),
-                            "fat_g":     types.Schema(type=types.Type.NUMBER),
-                            "method":    types.Schema(type=types.Type.STRING),
-                        },
-                        required=["name","kcal","protein_g","carbs_g","fat_g"]
-                    )
-                ),
-                "total_kcal":      types.Schema(type=types.Type.NUMBER),
-                "total_protein_g": types.Schema(type=types.Type.NUMBER),
-                "total_carbs_g":   types.Schema(type=types.Type.NUMBER),
-                "total_fat_g":     types.Schema(type=types.Type.NUMBER),
-                "confidence":      types.Schema(type=types.Type.NUMBER),
-                "notes":           types.Schema(type=types.Type.STRING),
-            },
-            required=NEEDED
-        )
-        cfg2 = types.GenerateContentConfig(
-            temperature=0.0,
-            response_mime_type="application/json",
-            response_schema=schema,
-            max_output_tokens=4096,
-            thinking_config=types.ThinkingConfig(thinking_budget=128),
-        )
-        resp2 = client.models.generate_content(
-            model=model,
-            contents=[types.Content(role="user", parts=[types.Part.from_text(text=prompt)])],
-            config=cfg2,
-        )
-        raw2 = extract_text_from_response(resp2) or getattr(resp2, "text", "")
-        data = first_json_block(raw2) or {}
-        if any(k not in data for k in NEEDED):
-            return {"error": "calories_failed", "raw": raw2 or raw1}
+# Pass 1: free JSON (deterministic)
+_CFG_FREE = types.GenerateContentConfig(
+    temperature=0.0,
+    max_output_tokens=2048,
+    thinking_config=types.ThinkingConfig(thinking_budget=128),
+)
+
+# Pass 2: schema-enforced JSON if needed
+_SCHEMA = types.Schema(
+    type=types.Type.OBJECT,
+    properties={
+        "items": types.Schema(
+            type=types.Type.ARRAY,
+            items=types.Schema(
+                type=types.Type.OBJECT,
+                properties={
+                    "name":      types.Schema(type=types.Type.STRING),
+                    "kcal":      types.Schema(type=types.Type.NUMBER),
+                    "protein_g": types.Schema(type=types.Type.NUMBER),
+                    "carbs_g":   types.Schema(type=types.Type.NUMBER),
+                    "fat_g":     types.Schema(type=types.Type.NUMBER),
+                    "method":    types.Schema(type=types.Type.STRING),
+                },
+                required=["name","kcal","protein_g","carbs_g","fat_g"]
+            )
+        ),
+        "total_kcal":      types.Schema(type=types.Type.NUMBER),
+        "total_protein_g": types.Schema(type=types.Type.NUMBER),
+        "total_carbs_g":   types.Schema(type=types.Type.NUMBER),
+        "total_fat_g":     types.Schema(type=types.Type.NUMBER),
+        "confidence":      types.Schema(type=types.Type.NUMBER),
+        "notes":           types.Schema(type=types.Type.STRING),
+    },
+    required=NEEDED
+)
+_CFG_SCHEMA = types.GenerateContentConfig(
+    temperature=0.0,
+    response_mime_type="application/json",
+    response_schema=_SCHEMA,
+    max_output_tokens=4096,
+    thinking_config=types.ThinkingConfig(thinking_budget=128),
+)
+
+_CFG_BATCH_FREE = types.GenerateContentConfig(
+    temperature=0.0,
+    max_output_tokens=8192,
+    thinking_config=types.ThinkingConfig(thinking_budget=256),
+)
+_CFG_BATCH_SCHEMA = types.GenerateContentConfig(
+    temperature=0.0,
+    response_mime_type="application/json",
+    response_schema=types.Schema(type=types.Type.OBJECT, properties={
+        "meals": types.Schema(type=types.Type.ARRAY, items=_SCHEMA)}, required=["meals"]),
+    max_output_tokens=16384,
+    thinking_config=types.ThinkingConfig(thinking_budget=256),
+)
+
+def _pass1_cfg() -> types.GenerateContentConfig:
+    return _CFG_SCHEMA if json_mode("calories") == "schema" else _CFG_FREE
+
+def _ok(data: Dict) -> bool:
+    return bool(data) and all(k in data for k in NEEDED)
+
+def _finish(data: Dict, raw1: str, raw2: str, items: List[Dict]) -> Dict:
+    if not _ok(data):
+        return {"error": "calories_failed", "raw": raw2 or raw1}
 
     # Normalize items list (keep order & names) with robust numbers
     out_items = []
@@ -181,3 +209,132 @@ def calories_from_ingredients(
         "confidence": fnum(data.get("confidence"), 0.6),
         "notes": data.get("notes"),
     }
+
+def _from_memo(items: List[Dict], oil_g: Optional[float], timings: Optional[Dict[str, float]]) -> Optional[Dict]:
+    res = density_memo.lookup(items, oil_g)
+    if res is not None:
+        if timings is not None:
+            timings["calories_memo_hit"] = 1.0
+        print(f"[calories] 📒 density memo answered {len(items)} item(s), no LLM call")
+    return res
+
+def _learn(items: List[Dict], res: Dict, oil_g: Optional[float]) -> Dict:
+    if "error" not in res:
+        density_memo.observe(items, res, oil_g)
+    return res
+
+def _cache_key(a: Dict) -> str:
+    return llm_cache.make_key("calories", a["model"], _build_prompt(a["dish_hint"], a["items"], a["oil_g"]), [],
+                              [_pass1_cfg(), _CFG_SCHEMA])
+
+@llm_cache.cached_stage("calories", _cache_key)
+def calories_from_ingredients(
+    project: Optional[str],
+    location: str,
+    model: str,
+    dish_hint: str,
+    items: List[Dict],
+    timings: Optional[Dict[str, float]] = None,
+    usage: Optional[List[Dict]] = None,
+    oil_g: Optional[float] = None,
+) -> Dict:
+    """
+    Input: items = [{ name, grams }]
+    Output: {
+      items: [{name,kcal,protein_g,carbs_g,fat_g,method?}],
+      total_kcal,total_protein_g,total_carbs_g,total_fat_g,
+      confidence,notes?
+    }
+    Enforces "single-source-of-truth" for added oil:
+      - If a 'cooking oil' item (grams>0) exists, do NOT include added oil in any other item.
+      - If no positive 'cooking oil', fried items may include typical absorbed oil.
+    oil_g overrides the detected oil grams (items priced elsewhere, e.g. calorie_engine).
+    Answers from density_memo without calling the model when every item is well known.
+    """
+    memo = _from_memo(items, oil_g, timings)
+    if memo is not None:
+        return memo
+    client = make_client(project or "", location)
+    deadline = deadline_for("calories")
+    parts = [types.Part.from_text(text=_build_prompt(dish_hint, items, oil_g))]
+
+    cfg1 = _pass1_cfg()
+    raw1 = generate_text(client, model, parts, cfg1, "calories", deadline, timings, usage=usage)
+    data = first_json_block(raw1)
+    raw2 = ""
+    second = not _ok(data) and cfg1 is _CFG_FREE
+    if second:
+        raw2 = generate_text(client, model, parts, _CFG_SCHEMA, "calories", deadline, timings, usage=usage)
+        data = first_json_block(raw2) or {}
+    record_passes("calories", model, 2 if second else 1, timings)
+    return _learn(items, _finish(data, raw1, raw2, items), oil_g)
+
+@llm_cache.cached_stage("calories", _cache_key)
+async def calories_from_ingredients_async(
+    project: Optional[str],
+    location: str,
+    model: str,
+    dish_hint: str,
+    items: List[Dict],
+    timings: Optional[Dict[str, float]] = None,
+    usage: Optional[List[Dict]] = None,
+    oil_g: Optional[float] = None,
+) -> Dict:
+    """Async twin of calories_from_ingredients (same prompt, passes and output)."""
+    memo = _from_memo(items, oil_g, timings)
+    if memo is not None:
+        return memo
+    client = make_client(project or "", location)
+    deadline = deadline_for("calories")
+    parts = [types.Part.from_text(text=_build_prompt(dish_hint, items, oil_g))]
+
+    cfg1 = _pass1_cfg()
+    raw1 = await agenerate_text(client, model, parts, cfg1, "calories", deadline, timings, usage=usage)
+    data = first_json_block(raw1)
+    raw2 = ""
+    second = not _ok(data) and cfg1 is _CFG_FREE
+    if second:
+        raw2 = await agenerate_text(client, model, parts, _CFG_SCHEMA, "calories", deadline, timings, usage=usage)
+        data = first_json_block(raw2) or {}
+    record_passes("calories", model, 2 if second else 1, timings)
+    return _learn(items, _finish(data, raw1, raw2, items), oil_g)
+
+async def calories_for_meals_async(
+    project: Optional[str],
+    location: str,
+    model: str,
+    meals: List[Dict],
+    timings: Optional[Dict[str, float]] = None,
+    usage: Optional[List[Dict]] = None,
+) -> List[Dict]:
+    """
+    Calories for several meals in ONE call (batch backfills): meals = [{dish, items, oil_g?}].
+    Returns one calories_from_ingredients-shaped result per meal, in order. Meals the
+    density memo already knows are answered without the model; the rest share the call
+    (stage 'calories_batch' in usage). Not on the LLM cache: packed prompts rarely repeat.
+    """
+    out: List[Optional[Dict]] = [_from_memo(m["items"], m.get("oil_g"), timings) for m in meals]
+    rest = [i for i, r in enumerate(out) if r is None]
+    if not rest:
+        return out
+    client = make_client(project or "", location)
+    deadline = deadline_for("calories")
+    parts = [types.Part.from_text(text=_build_batch_prompt([meals[i] for i in rest]))]
+
+    ok = lambda d: isinstance(d, dict) and isinstance(d.get("meals"), list) and len(d["meals"]) == len(rest)
+    cfg1 = _CFG_BATCH_SCHEMA if json_mode("calories") == "schema" else _CFG_BATCH_FREE
+    raw1 = await agenerate_text(client, model, parts, cfg1, "calories_batch", deadline, timings, usage=usage)
+    data = first_json_block(raw1)
+    raw2 = ""
+    second = not ok(data) and cfg1 is _CFG_BATCH_FREE
+    if second:
+        raw2 = await agenerate_text(client, model, parts, _CFG_BATCH_SCHEMA, "calories_batch", deadline, timings,
+                                    usage=usage)
+        data = first_json_block(raw2) or {}
+    record_passes("calories_batch", model, 2 if second else 1, timings)
+    answers = data.get("meals") if ok(data) else []
+    for j, i in enumerate(rest):
+        m = meals[i]
+        ans = answers[j] if j < len(answers) and isinstance(answers[j], dict) else {}
+        out[i] = _learn(m["items"], _finish(ans, raw1, raw2, m["items"]), m.get("oil_g"))
+    return out
@@ -0,0 +1,235 @@
+# gemini_cascade.py
+import os, json, time, threading
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from cancellation import Cancelled
+from density_memo import is_oil
+
+# Model cascade per stage: when a request asks for model "cascade", each stage runs the
+# fast model first and re-runs on the slow one only if the answer fails its checks
+# (error, confidence under the stage threshold, totals that don't add up, oil out of
+# bounds...). Escalations, their reasons and the latency saved against always using the
+# slow model are counted per stage. Per-stage policy: CASCADE_<STAGE> = cascade | fast |
+# slow, CASCADE_MIN_CONF_<STAGE>, or CASCADE_POLICY_JSON {"stage": {"fast", "slow",
+# "min_conf", "mode"}}.
+CASCADE_MODEL = os.getenv("CASCADE_MODEL_NAME", "cascade")
+FAST_MODEL = os.getenv("CASCADE_FAST_MODEL", "gemini-2.5-flash")
+SLOW_MODEL = os.getenv("CASCADE_SLOW_MODEL", "gemini-2.5-pro")
+_DEFAULT_MIN_CONF = {"recognize": 0.7, "ing_quant": 0.6, "fused": 0.65, "calories": 0.6}
+OIL_MAX_FRAC = float(os.getenv("CASCADE_OIL_MAX_FRAC", "0.15"))   # oil grams vs the rest of the plate
+OIL_MAX_G = float(os.getenv("CASCADE_OIL_MAX_G", "60"))
+
+POLICY: Dict[str, Dict[str, Any]] = {
+    st: {"mode": os.getenv(f"CASCADE_{st.upper()}", "cascade").lower(), "fast": FAST_MODEL, "slow": SLOW_MODEL,
+         "min_conf": float(os.getenv(f"CASCADE_MIN_CONF_{st.upper()}", conf))}
+    for st, conf in _DEFAULT_MIN_CONF.items()
+}
+for _st, _p in json.loads(os.getenv("CASCADE_POLICY_JSON", "{}")).items():
+    POLICY.setdefault(_st, {"mode": "cascade", "fast": FAST_MODEL, "slow": SLOW_MODEL, "min_conf": 0.6}).update(_p)
+
+_LOCK = threading.Lock()
+_STATS: Dict[str, Dict[str, Any]] = {}
+
+def is_cascade(model: str) -> bool:
+    return model == CASCADE_MODEL
+
+def _num(x, default=0.0) -> float:
+    try:
+        return float(x)
+    except (TypeError, ValueError):
+        return default
+
+# ---------- checks ----------
+def _grams_reasons(items: List[Dict], total: Any) -> List[str]:
+    if not items:
+        return ["no_items"]
+    out = []
+    s = sum(_num(it.get("grams")) for it in items)
+    if total is not None and abs(_num(total) - s) > max(15.0, 0.1 * s):
+        out.append("total_mismatch")
+    oil = sum(_num(it.get("grams")) for it in items if is_oil(it.get("name", "")))
+    if oil < 0 or oil > OIL_MAX_G or (oil > 0 and oil > OIL_MAX_FRAC * max(1.0, s - oil)):
+        out.append("oil_bound")
+    return out
+
+def _calorie_reasons(res: Dict, items: Optional[List[Dict]]) -> List[str]:
+    out_items = res.get("items") or []
+    out = []
+    s = sum(_num(it.get("kcal")) for it in out_items)
+    if abs(_num(res.get("total_kcal")) - s) > max(20.0, 0.05 * s):
+        out.append("total_mismatch")
+    for it in out_items:
+        kcal = _num(it.get("kcal"))
+        atwater = 4 * _num(it.get("protein_g")) + 4 * _num(it.get("carbs_g")) + 9 * _num(it.get("fat_g"))
+        if abs(kcal - atwater) > 0.25 * kcal + 10:
+            out.append("macro_mismatch")
+            break
+    for src, it in zip(items or [], out_items):
+        grams = _num(src.get("grams"))
+        if grams <= 0:
+            continue
+        if _num(it.get("kcal")) <= 0:
+            out.append("missing_item")
+            break
+        if is_oil(src.get("name", "")) and not 7.5 <= _num(it.get("kcal")) / grams <= 9.2:
+            out.append("oil_bound")
+            break
+    return out
+
+def check(stage: str, res: Dict, min_conf: float, items: Optional[List[Dict]] = None) -> List[str]:
+    """Reasons to escalate; empty list = keep the fast answer."""
+    if not isinstance(res, dict) or "error" in res:
+        return ["error"]
+    out = []
+    if stage in ("recognize", "fused"):
+        if not res.get("dish"):
+            out.append("no_dish")
+        if _num(res.get("confidence")) < min_conf:
+            out.append("low_confidence")
+    if stage == "ing_quant":
+        if _num(res.get("confidence")) < min_conf:
+            out.append("low_confidence")
+        out += _grams_reasons(res.get("items") or [], res.get("total_grams"))
+    if stage == "fused":
+        if _num(res.get("grams_confidence")) < min_conf:
+            out.append("low_grams_confidence")
+        out += _grams_reasons(res.get("items") or [], res.get("total_grams"))
+    if stage == "calories":
+        if _num(res.get("confidence")) < min_conf:
+            out.append("low_confidence")
+        out += _calorie_reasons(res, items)
+    return out
+
+# ---------- run ----------
+def _record(stage: str, fast_ms: float, slow_ms: Optional[float], reasons: List[str],
+            timings: Optional[Dict[str, float]]):
+    with _LOCK:
+        st = _STATS.setdefault(stage, {"runs": 0, "escalations": 0, "fast_ms_total": 0.0,
+                                       "slow_ms_total": 0.0, "reasons": {}})
+        st["runs"] += 1
+        st["fast_ms_total"] = round(st["fast_ms_total"] + fast_ms, 2)
+        if slow_ms is not None:
+            st["escalations"] += 1
+            st["slow_ms_total"] = round(st["slow_ms_total"] + slow_ms, 2)
+            for r in reasons:
+                st["reasons"][r] = st["reasons"].get(r, 0) + 1
+    if timings is not None:
+        timings[f"{stage}_escalated"] = 1.0 if slow_ms is not None else 0.0
+        timings[f"{stage}_fast_ms"] = fast_ms
+
+def _pick(fast: Optional[Dict], slow: Dict) -> Dict:
+    # a failed slow pass shouldn't throw away a usable (if doubtful) fast answer
+    if isinstance(slow, dict) and "error" in slow and fast is not None and "error" not in fast:
+        return fast
+    return slow
+
+def _ms(t0: float) -> float:
+    return round((time.perf_counter() - t0) * 1000.0, 2)
+
+def cascaded(stage: str, model: str, call: Callable[[str], Dict], timings: Optional[Dict[str, float]] = None,
+             items: Optional[List[Dict]] = None) -> Dict:
+    """call(model) -> stage result. Plain models pass straight through."""
+    if not is_cascade(model):
+        return call(model)
+    pol = POLICY.get(stage) or {"mode": "slow", "slow": SLOW_MODEL}
+    if pol["mode"] in ("fast", "slow"):
+        return call(pol[pol["mode"]])
+    t0 = time.perf_counter()
+    try:
+        fast = call(pol["fast"])
+        reasons = check(stage, fast, pol["min_conf"], items)
+    except Cancelled:
+        raise   # nobody is waiting for a better answer either
+    except Exception as e:
+        fast, reasons = None, [f"exception:{type(e).__name__}"]
+    fast_ms = _ms(t0)
+    if not reasons:
+        _record(stage, fast_ms, None, [], timings)
+        return fast
+    print(f"[cascade] ⤴ {stage}: {pol['fast']} → {pol['slow']} ({', '.join(reasons)})")
+    t1 = time.perf_counter()
+    try:
+        slow = call(pol["slow"])
+    finally:
+        _record(stage, fast_ms, _ms(t1), reasons, timings)
+    return _pick(fast, slow)
+
+async def acascaded(stage: str, model: str, acall: Callable[[str], Awaitable[Dict]],
+                    timings: Optional[Dict[str, float]] = None, items: Optional[List[Dict]] = None) -> Dict:
+    if not is_cascade(model):
+        return await acall(model)
+    pol = POLICY.get(stage) or {"mode": "slow", "slow": SLOW_MODEL}
+    if pol["mode"] in ("fast", "slow"):
+        return await acall(pol[pol["mode"]])
+    t0 = time.perf_counter()
+    try:
+        fast = await acall(pol["fast"])
+        reasons = check(stage, fast, pol["min_conf"], items)
+    except Cancelled:
+        raise   # nobody is waiting for a better answer either
+    except Exception as e:
+        fast, reasons = None, [f"exception:{type(e).__name__}"]
+    fast_ms = _ms(t0)
+    if not reasons:
+        _record(stage, fast_ms, None, [], timings)
+        return fast
+    print(f"[cascade] ⤴ {stage}: {pol['fast']} → {pol['slow']} ({', '.join(reasons)})")
+    t1 = time.perf_counter()
+    try:
+        slow = await acall(pol["slow"])
+    finally:
+        _record(stage, fast_ms, _ms(t1), reasons, timings)
+    return _pick(fast, slow)
+
+# ---------- answers obtained elsewhere ----------
+# A caller that got the first answer itself (one packed call for several meals) asks
+# first_model() which model to use, then settles each answer like acascaded() would.
+def first_model(stage: str, model: str) -> str:
+    if not is_cascade(model):
+        return model
+    pol = POLICY.get(stage) or {"mode": "slow", "slow": SLOW_MODEL}
+    return pol[pol["mode"]] if pol["mode"] in ("fast", "slow") else pol["fast"]
+
+def _needs_settling(stage: str, model: str) -> bool:
+    return is_cascade(model) and (POLICY.get(stage) or {}).get("mode") == "cascade"
+
+async def asettle(stage: str, model: str, res: Dict, fast_ms: float, acall: Callable[[str], Awaitable[Dict]],
+                  timings: Optional[Dict[str, float]] = None, items: Optional[List[Dict]] = None) -> Dict:
+    """Keep a first_model() answer or re-run `acall` on the slow model, recorded as in acascaded()."""
+    if not _needs_settling(stage, model):
+        return res
+    pol = POLICY[stage]
+    reasons = check(stage, res, pol["min_conf"], items)
+    if not reasons:
+        _record(stage, fast_ms, None, [], timings)
+        return res
+    print(f"[cascade] ⤴ {stage}: {pol['fast']} → {pol['slow']} ({', '.join(reasons)})")
+    t1 = time.perf_counter()
+    try:
+        slow = await acall(pol["slow"])
+    finally:
+        _record(stage, fast_ms, _ms(t1), reasons, timings)
+    return _pick(res, slow)
+
+def cascade_stats() -> Dict:
+    """
+    Per stage: escalation rate and reasons, plus latency saved against always calling
+    the slow model (estimated from the slow calls made by escalations).
+    """
+    with _LOCK:
+        out = {}
+        for stage, st in _STATS.items():
+            n, esc = st["runs"], st["escalations"]
+            slow_avg = st["slow_ms_total"] / esc if esc else None
+            saved = (n * slow_avg - st["fast_ms_total"] - st["slow_ms_total"]) if slow_avg is not None else None
+            out[stage] = {
+                "policy": POLICY.get(stage),
+                "runs": n, "escalations": esc,
+                "escalation_rate": round(esc / n, 4) if n else 0.0,
+                "reasons": dict(st["reasons"]),
+                "fast_ms_avg": round(st["fast_ms_total"] / n, 1) if n else None,
+                "slow_ms_avg": round(slow_avg, 1) if slow_avg is not None else None,
+                "saved_ms_est_total": round(saved, 1) if saved is not None else None,
+                "saved_ms_est_avg": round(saved / n, 1) if saved is not None and n else None,
+            }
+        return out
@@ -1,48 +1,514 @@
 # gemini_client.py
-import os, json, re
-from typing import List, Dict
+import os, json, re, time, hashlib, asyncio, threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, List, Dict, Tuple, Optional
 from google import genai
 from google.genai import types
 import base64
 
+from gemini_policy import call_with_policy, acall_with_policy
+from json_stream import JsonStreamParser
+from cancellation import current_token, count as count_cancel
+
+# ---------- Client pool ----------
+# One genai.Client per (backend, project, location), shared by every request and
+# gunicorn thread. The client owns its HTTP connection pool, so reusing it keeps
+# TLS sessions and keep-alive sockets warm instead of handshaking per stage.
+_POOL: Dict[Tuple[str, str, str], genai.Client] = {}
+_POOL_LOCK = threading.Lock()
+_VERTEX_FAILED: Dict[Tuple[str, str], str] = {}   # (project, location) -> error, skip retrying Vertex
+_POOL_STATS = {"hits": 0, "misses": 0, "vertex_fallbacks": 0, "setup_ms_total": 0.0, "setup_ms_last": 0.0}
+BACKEND = os.getenv("GEMINI_BACKEND", "auto").lower()   # auto | fake (in-process gemini_fake.FakeClient)
+BASE_URL = os.getenv("GEMINI_BASE_URL", "")             # API-key client against another endpoint (gemini_fake.serve)
+
+def _new_client(backend: str, project: str, location: str) -> genai.Client:
+    t0 = time.perf_counter()
+    if backend == "fake":
+        from gemini_fake import FakeClient
+        client = FakeClient()
+    elif backend == "vertex":
+        client = genai.Client(vertexai=True, project=project, location=location)
+    elif BASE_URL:
+        client = genai.Client(api_key=os.getenv("GOOGLE_API_KEY") or "stand-in",
+                              http_options=types.HttpOptions(base_url=BASE_URL))
+    else:
+        client = genai.Client(api_key=os.getenv("GOOGLE_API_KEY"))
+    ms = round((time.perf_counter() - t0) * 1000.0, 2)
+    _POOL_STATS["misses"] += 1
+    _POOL_STATS["setup_ms_total"] = round(_POOL_STATS["setup_ms_total"] + ms, 2)
+    _POOL_STATS["setup_ms_last"] = ms
+    print(f"[client_pool] new {backend} client (project={project or '-'}, location={location or '-'}) in {ms} ms")
+    return client
+
+def _pooled(backend: str, project: str, location: str) -> genai.Client:
+    key = (backend, project, location)
+    client = _POOL.get(key)
+    if client is not None:
+        with _POOL_LOCK:
+            _POOL_STATS["hits"] += 1
+        return client
+    with _POOL_LOCK:
+        client = _POOL.get(key)
+        if client is None:
+            client = _new_client(backend, project, location)
+            _POOL[key] = client
+        else:
+            _POOL_STATS["hits"] += 1
+    if backend != "vertex":
+        _ensure_sweeper()   # orphans from before a restart get swept without a new upload
+    return client
+
 def make_client(project: str, location: str) -> genai.Client:
+    """
+    Return the pooled client for this project/location.
+    Prefers Vertex when project is set; falls back to API key (and remembers the fallback).
+    GEMINI_BACKEND=fake or GEMINI_BASE_URL route everything to the offline stand-in.
+    """
+    if BACKEND == "fake":
+        return _pooled("fake", "", "")
     api_key = os.getenv("GOOGLE_API_KEY")
-    if project:
+    if BASE_URL:
+        return _pooled("api_key", "", "")
+    location = location or ""
+    if project and (project, location) not in _VERTEX_FAILED:
         try:
-            return genai.Client(vertexai=True, project=project, location=location)
-        except Exception:
-            if api_key:
-                return genai.Client(api_key=api_key)
-            raise
+            return _pooled("vertex", project, location)
+        except Exception as e:
+            if not api_key:
+                raise
+            with _POOL_LOCK:
+                _VERTEX_FAILED[(project, location)] = str(e)
+                _POOL_STATS["vertex_fallbacks"] += 1
+            print(f"[client_pool] Vertex init failed ({e}); using API key mode from now on")
     if not api_key:
         raise RuntimeError("Provide GOOGLE_CLOUD_PROJECT (Vertex) or GOOGLE_API_KEY.")
-    return genai.Client(api_key=api_key)
+    return _pooled("api_key", "", "")
+
+def client_pool_stats() -> Dict:
+    with _POOL_LOCK:
+        total = _POOL_STATS["hits"] + _POOL_STATS["misses"]
+        return {
+            **_POOL_STATS,
+            "clients": ["/".join(x for x in k if x) for k in _POOL],
+            "hit_rate": round(_POOL_STATS["hits"] / total, 4) if total else 0.0,
+        }
+
+# ---------- Uploaded-file cache ----------
+# File API handles keyed by (client, sha256 of the bytes). Recognize and ingredients
+# send the same angles, and users resubmit the same photo, so one upload serves all.
+# Remote files expire after 48 h; we stop reusing them a little earlier.
+FILE_EXPIRY_S = 48 * 3600   # File API retention
+FILE_TTL_S = float(os.getenv("GEMINI_FILE_TTL_S", str(47 * 3600)))
+# an orphan (ours, not cached in this process) older than this is reused by no worker:
+# past every worker's FILE_TTL_S, but still before the API deletes it on its own
+ORPHAN_AGE_S = min(FILE_TTL_S + 600, FILE_EXPIRY_S - 1800)
+FILE_SWEEP_S = float(os.getenv("GEMINI_FILE_SWEEP_S", "600"))
+FILE_PREFIX = "fta-"   # display_name prefix marks files this app uploaded
+
+_FILE_CACHE: Dict[Tuple[int, str], Tuple[object, float, genai.Client]] = {}  # -> (handle, expires_at, client)
+_FILE_INFLIGHT: Dict[Tuple[int, str], Future] = {}
+_FILE_LOCK = threading.Lock()
+_FILE_STATS = {"hits": 0, "uploads": 0, "upload_errors": 0, "inline": 0,
+               "upload_ms_total": 0.0, "bytes_uploaded": 0, "deleted": 0}
+_UPLOAD_POOL = ThreadPoolExecutor(max_workers=int(os.getenv("GEMINI_UPLOAD_WORKERS", "4")),
+                                  thread_name_prefix="gemini-upload")
+_SWEEPER: Optional[threading.Thread] = None
+
+def _mime_for(path: str) -> str:
+    ext = os.path.splitext(path)[1].lower()
+    return "image/jpeg" if ext in [".jpg",".jpeg"] else ("image/png" if ext==".png" else "image/webp")
+
+def _read_image(path: str) -> Tuple[bytes, str]:
+    with open(path, "rb") as f:
+        data = f.read()
+    return data, hashlib.sha256(data).hexdigest()
+
+def _file_part(handle, path: str) -> types.Part:
+    # A bare types.File inside types.Content validates to an empty Part; reference it by URI.
+    return types.Part.from_uri(file_uri=handle.uri, mime_type=getattr(handle, "mime_type", None) or _mime_for(path))
+
+def _upload(client: genai.Client, path: str, data: bytes, sha: str):
+    t0 = time.perf_counter()
+    handle = client.files.upload(
+        file=path,
+        config=types.UploadFileConfig(mime_type=_mime_for(path), display_name=f"{FILE_PREFIX}{sha[:32]}"),
+    )
+    ms = (time.perf_counter() - t0) * 1000.0
+    exp = getattr(handle, "expiration_time", None)
+    expires_at = time.time() + FILE_TTL_S
+    if exp is not None and hasattr(exp, "timestamp"):
+        expires_at = min(expires_at, exp.timestamp() - 600)
+    with _FILE_LOCK:
+        _FILE_CACHE[(id(client), sha)] = (handle, expires_at, client)
+        _FILE_STATS["uploads"] += 1
+        _FILE_STATS["upload_ms_total"] = round(_FILE_STATS["upload_ms_total"] + ms, 2)
+        _FILE_STATS["bytes_uploaded"] += len(data)
+    _ensure_sweeper()
+    return handle
 
 def prepare_image_part(client: genai.Client, path: str):
     """
-    Prefer File API; fallback to inline bytes.
+    Prefer File API (cached by content hash); fallback to inline bytes.
     """
+    data, sha = _read_image(path)
+    if getattr(client, "vertexai", False):
+        # Vertex has no File API; don't pay for a failing upload attempt.
+        with _FILE_LOCK:
+            _FILE_STATS["inline"] += 1
+        return types.Part.from_bytes(data=data, mime_type=_mime_for(path))
+
+    key = (id(client), sha)
+    with _FILE_LOCK:
+        hit = _FILE_CACHE.get(key)
+        if hit and hit[1] > time.time():
+            _FILE_STATS["hits"] += 1
+            return _file_part(hit[0], path)
+        fut = _FILE_INFLIGHT.get(key)
+        owner = fut is None
+        if owner:
+            fut = Future()
+            _FILE_INFLIGHT[key] = fut
+    if owner:
+        try:
+            fut.set_result(_upload(client, path, data, sha))
+        except Exception as e:
+            fut.set_exception(e)
+        finally:
+            with _FILE_LOCK:
+                _FILE_INFLIGHT.pop(key, None)
     try:
-        return client.files.upload(file=path)
+        return _file_part(fut.result(), path)
     except Exception:
-        with open(path, "rb") as f:
-            data = f.read()
-        ext = os.path.splitext(path)[1].lower()
-        mime = "image/jpeg" if ext in [".jpg",".jpeg"] else ("image/png" if ext==".png" else "image/webp")
-        return types.Part.from_bytes(data=data, mime_type=mime)
+        with _FILE_LOCK:
+            _FILE_STATS["upload_errors"] += 1
+            _FILE_STATS["inline"] += 1
+        return types.Part.from_bytes(data=data, mime_type=_mime_for(path))
 
 def prepare_image_parts(client: genai.Client, paths: List[str]):
-    parts = []
-    for p in paths:
-        parts.append(prepare_image_part(client, p))
-    return parts
+    """All angles in parallel; order matches paths."""
+    if len(paths) <= 1:
+        return [prepare_image_part(client, p) for p in paths]
+    return list(_UPLOAD_POOL.map(lambda p: prepare_image_part(client, p), paths))
 
 def encode_image_to_part(path: str) -> types.Part:
-    with open(path, "rb") as f:
-        data = f.read()
-    ext = os.path.splitext(path)[1].lower()
-    mime = "image/jpeg" if ext in [".jpg",".jpeg"] else ("image/png" if ext==".png" else "image/webp")
-    return types.Part.from_bytes(data=data, mime_type=mime)
+    data, _ = _read_image(path)
+    return types.Part.from_bytes(data=data, mime_type=_mime_for(path))
+
+def sweep_uploaded_files() -> Dict[str, int]:
+    """
+    Delete remote files whose cache entry expired, plus orphans (our prefix, not cached
+    here, older than ORPHAN_AGE_S — no worker still reuses those). Orphans are listed
+    through every pooled File API client, so uploads from before a restart are found too.
+    """
+    now = time.time()
+    with _FILE_LOCK:
+        expired = [(k, v) for k, v in _FILE_CACHE.items() if v[1] <= now]
+        for k, _ in expired:
+            _FILE_CACHE.pop(k, None)
+        live = {getattr(v[0], "name", None) for v in _FILE_CACHE.values()}
+        clients = {id(c): c for _, _, c in _FILE_CACHE.values()}
+        clients.update({id(v[2]): v[2] for _, v in expired})
+    with _POOL_LOCK:
+        clients.update({id(c): c for (backend, _, _), c in _POOL.items() if backend != "vertex"})
+    deleted = 0
+    for _, (handle, _, client) in expired:
+        try:
+            client.files.delete(name=handle.name)
+            deleted += 1
+        except Exception:
+            pass
+    for client in clients.values():
+        try:
+            for f in client.files.list():
+                if not (getattr(f, "display_name", "") or "").startswith(FILE_PREFIX) or f.name in live:
+                    continue
+                created = getattr(f, "create_time", None)
+                if created is None or now - created.timestamp() < ORPHAN_AGE_S:
+                    continue
+                client.files.delete(name=f.name)
+                deleted += 1
+        except Exception as e:
+            print(f"[file_cache] orphan sweep failed: {e}")
+    with _FILE_LOCK:
+        _FILE_STATS["deleted"] += deleted
+    return {"expired": len(expired), "deleted": deleted}
+
+def _ensure_sweeper():
+    global _SWEEPER
+    if _SWEEPER is not None or FILE_SWEEP_S <= 0:
+        return
+    with _FILE_LOCK:
+        if _SWEEPER is not None:
+            return
+        def loop():
+            while True:
+                time.sleep(FILE_SWEEP_S)
+                try:
+                    sweep_uploaded_files()
+                except Exception as e:
+                    print(f"[file_cache] sweep failed: {e}")
+        _SWEEPER = threading.Thread(target=loop, name="gemini-file-sweeper", daemon=True)
+        _SWEEPER.start()
+
+def file_cache_stats() -> Dict:
+    with _FILE_LOCK:
+        return {**_FILE_STATS, "cached": len(_FILE_CACHE), "inflight": len(_FILE_INFLIGHT)}
+
+# ---------- JSON mode ----------
+# two_pass: free-form JSON first, schema-constrained call only if it doesn't parse (default)
+# schema:   go straight to schema-constrained JSON, one round trip
+JSON_MODE = os.getenv("GEMINI_JSON_MODE", "two_pass").lower()
+_STAGE_JSON_MODE = {s: os.getenv(f"GEMINI_JSON_MODE_{s.upper()}", JSON_MODE).lower()
+                    for s in ("recognize", "ing_quant", "fused", "calories")}
+_PASS_STATS: Dict[Tuple[str, str, str], Dict[str, int]] = {}   # (stage, model, mode) -> counts
+_PASS_LOCK = threading.Lock()
+
+def json_mode(stage: str) -> str:
+    return _STAGE_JSON_MODE.get(stage, JSON_MODE)
+
+def record_passes(stage: str, model: str, passes: int, timings: Optional[Dict[str, float]] = None):
+    with _PASS_LOCK:
+        st = _PASS_STATS.setdefault((stage, model, json_mode(stage)), {"runs": 0, "second_pass": 0})
+        st["runs"] += 1
+        st["second_pass"] += 1 if passes > 1 else 0
+    if timings is not None:
+        timings[f"{stage}_passes"] = float(passes)
+
+def json_pass_stats() -> Dict:
+    with _PASS_LOCK:
+        return {
+            f"{stage}/{model}/{mode}": {
+                **st,
+                "fallback_rate": round(st["second_pass"] / st["runs"], 4) if st["runs"] else 0.0,
+            }
+            for (stage, model, mode), st in _PASS_STATS.items()
+        }
+
+# ---------- Fixture recording ----------
+# GEMINI_RECORD_DIR=<dir> appends every raw answer to <dir>/<stage>.jsonl; point
+# FAKE_FIXTURES_DIR at it to replay real answers through gemini_fake.
+RECORD_DIR = os.getenv("GEMINI_RECORD_DIR", "")
+_RECORD_LOCK = threading.Lock()
+
+def _record(stage: str, model: str, text: str):
+    if not RECORD_DIR or not text:
+        return
+    line = json.dumps({"stage": stage, "model": model, "text": text, "ts": time.time()}, ensure_ascii=False)
+    try:
+        with _RECORD_LOCK:
+            os.makedirs(RECORD_DIR, exist_ok=True)
+            with open(os.path.join(RECORD_DIR, f"{stage or 'generate'}.jsonl"), "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+    except Exception as e:
+        print(f"[record] write failed: {e}")
+
+# ---------- Usage / cost ----------
+# usage_metadata of every successful pass: appended to the caller's `usage` list (one
+# record per pass, carried into the job payload/history) and summed per (stage, model).
+# Prices are USD per 1M tokens (input, output); thinking tokens bill as output.
+PRICES_PER_MTOK: Dict[str, Tuple[float, float]] = {
+    "gemini-2.5-pro": (1.25, 10.0),
+    "gemini-2.5-flash": (0.30, 2.50),
+    "gemini-2.5-flash-lite": (0.10, 0.40),
+}
+PRICES_PER_MTOK.update({m: tuple(v) for m, v in json.loads(os.getenv("GEMINI_PRICES_JSON", "{}")).items()})
+
+_USAGE_FIELDS = (
+    ("prompt_tokens", "prompt_token_count"),
+    ("output_tokens", "candidates_token_count"),
+    ("thinking_tokens", "thoughts_token_count"),
+    ("cached_tokens", "cached_content_token_count"),
+    ("total_tokens", "total_token_count"),
+)
+_USAGE_STATS: Dict[Tuple[str, str], Dict[str, float]] = {}   # (stage, model) -> sums
+_USAGE_LOCK = threading.Lock()
+
+def _price(model: str) -> Optional[Tuple[float, float]]:
+    name = (model or "").split("/")[-1]
+    best = max((m for m in PRICES_PER_MTOK if name.startswith(m)), key=len, default=None)
+    return PRICES_PER_MTOK.get(best) if best else None
+
+def record_usage(stage: str, model: str, meta, usage: Optional[List[Dict]] = None) -> Optional[Dict]:
+    if meta is None:
+        return None
+    rec: Dict[str, Any] = {"stage": stage, "model": model,
+                           "pass": 1 + sum(1 for u in (usage or []) if u.get("stage") == stage)}
+    for key, attr in _USAGE_FIELDS:
+        rec[key] = int(getattr(meta, attr, None) or 0)
+    price = _price(model)
+    rec["cost_usd"] = round((rec["prompt_tokens"] * price[0]
+                             + (rec["output_tokens"] + rec["thinking_tokens"]) * price[1]) / 1e6, 6) if price else None
+    with _USAGE_LOCK:
+        st = _USAGE_STATS.setdefault((stage, model), {"calls": 0, "cost_usd": 0.0, **{k: 0 for k, _ in _USAGE_FIELDS}})
+        st["calls"] += 1
+        for key, _ in _USAGE_FIELDS:
+            st[key] += rec[key]
+        st["cost_usd"] = round(st["cost_usd"] + (rec["cost_usd"] or 0.0), 6)
+    if usage is not None:
+        usage.append(rec)
+    return rec
+
+def summarize_usage(usage: List[Dict]) -> Dict[str, Any]:
+    """Job-level totals over the per-pass records."""
+    out: Dict[str, Any] = {"calls": len(usage), **{k: sum(u.get(k, 0) for u in usage) for k, _ in _USAGE_FIELDS}}
+    out["cost_usd"] = round(sum(u.get("cost_usd") or 0.0 for u in usage), 6)
+    return out
+
+def usage_stats() -> Dict:
+    with _USAGE_LOCK:
+        out = {}
+        for (stage, model), st in _USAGE_STATS.items():
+            n = st["calls"] or 1
+            out[f"{stage}/{model}"] = {
+                **st,
+                "avg_prompt_tokens": round(st["prompt_tokens"] / n, 1),
+                "avg_output_tokens": round(st["output_tokens"] / n, 1),
+                "avg_thinking_tokens": round(st["thinking_tokens"] / n, 1),
+            }
+        return out
+
+# ---------- Calls ----------
+# Single choke point for generate_content so every stage (sync and async) shares the
+# retry/deadline/hedging policy in gemini_policy.
+def generate_text(client: genai.Client, model: str, parts: List, config: types.GenerateContentConfig,
+                  stage: str = "", deadline: Optional[float] = None,
+                  timings: Optional[Dict[str, float]] = None, usage: Optional[List[Dict]] = None) -> str:
+    def call():
+        return client.models.generate_content(
+            model=model,
+            contents=[types.Content(role="user", parts=parts)],
+            config=config,
+        )
+    resp = call_with_policy(stage or "generate", model, call, deadline=deadline, timings=timings)
+    record_usage(stage or "generate", model, getattr(resp, "usage_metadata", None), usage)
+    text = extract_text_from_response(resp) or getattr(resp, "text", "") or ""
+    _record(stage, model, text)
+    return text
+
+async def agenerate_text(client: genai.Client, model: str, parts: List, config: types.GenerateContentConfig,
+                         stage: str = "", deadline: Optional[float] = None,
+                         timings: Optional[Dict[str, float]] = None, usage: Optional[List[Dict]] = None) -> str:
+    def call():
+        return client.aio.models.generate_content(
+            model=model,
+            contents=[types.Content(role="user", parts=parts)],
+            config=config,
+        )
+    resp = await acall_with_policy(stage or "generate", model, call, deadline=deadline, timings=timings)
+    record_usage(stage or "generate", model, getattr(resp, "usage_metadata", None), usage)
+    text = extract_text_from_response(resp) or getattr(resp, "text", "") or ""
+    _record(stage, model, text)
+    return text
+
+def _stream_collector(on_value: Callable[[tuple, Any], None]):
+    # Values already reported stay reported if a retry re-streams the same paths.
+    seen = set()
+    def cb(path, value):
+        if path not in seen:
+            seen.add(path)
+            on_value(path, value)
+    return cb
+
+def _stream_timings(timings: Optional[Dict[str, float]], stage: str, first_ms: Optional[float], early: bool):
+    if timings is None:
+        return
+    if first_ms is not None:
+        timings[f"{stage}_first_token_ms"] = round(first_ms, 2)
+    if early:
+        timings[f"{stage}_early_stop"] = 1.0
+
+def stream_json(client: genai.Client, model: str, parts: List, config: types.GenerateContentConfig,
+                on_value: Callable[[tuple, Any], None], stage: str = "", deadline: Optional[float] = None,
+                timings: Optional[Dict[str, float]] = None,
+                usage: Optional[List[Dict]] = None) -> str:
+    """
+    generate_text over generate_content_stream: chunks go through JsonStreamParser,
+    on_value(path, value) fires as each JSON value closes, and we stop reading (which
+    ends generation) as soon as the top-level object is complete. Returns the raw text.
+    Usage comes from the last chunk that carried usage_metadata; an early stop can
+    leave it out (then no usage record is written for the pass). A cancelled token
+    stops reading the same way (and raises Cancelled).
+    """
+    cb = _stream_collector(on_value)
+    tok = current_token()   # call() runs on the policy pool, outside this context
+
+    def call():
+        parser = JsonStreamParser(cb)
+        t0 = time.perf_counter()
+        first_ms, early, meta = None, False, None
+        stream = client.models.generate_content_stream(
+            model=model,
+            contents=[types.Content(role="user", parts=parts)],
+            config=config,
+        )
+        try:
+            for chunk in stream:
+                if tok is not None and tok.cancelled:
+                    count_cancel("streams_aborted")
+                    tok.check(stage or "generate")
+                txt = extract_text_from_response(chunk)
+                meta = getattr(chunk, "usage_metadata", None) or meta
+                if txt and first_ms is None:
+                    first_ms = (time.perf_counter() - t0) * 1000.0
+                parser.feed(txt)
+                if parser.done:
+                    early = True
+                    break
+        finally:
+            close = getattr(stream, "close", None)
+            if close:
+                close()
+        return parser.text, first_ms, early, meta
+
+    text, first_ms, early, meta = call_with_policy(stage or "generate", model, call, deadline=deadline,
+                                                   timings=timings, hedge=False, interruptible=True)
+    _stream_timings(timings, stage, first_ms, early)
+    record_usage(stage or "generate", model, meta, usage)
+    _record(stage, model, text)
+    return text
+
+async def astream_json(client: genai.Client, model: str, parts: List, config: types.GenerateContentConfig,
+                       on_value: Callable[[tuple, Any], None], stage: str = "", deadline: Optional[float] = None,
+                       timings: Optional[Dict[str, float]] = None,
+                       usage: Optional[List[Dict]] = None) -> str:
+    """Async twin of stream_json (client.aio)."""
+    cb = _stream_collector(on_value)
+
+    async def call():
+        parser = JsonStreamParser(cb)
+        t0 = time.perf_counter()
+        first_ms, early, meta = None, False, None
+        stream = await client.aio.models.generate_content_stream(
+            model=model,
+            contents=[types.Content(role="user", parts=parts)],
+            config=config,
+        )
+        try:
+            async for chunk in stream:
+                txt = extract_text_from_response(chunk)
+                meta = getattr(chunk, "usage_metadata", None) or meta
+                if txt and first_ms is None:
+                    first_ms = (time.perf_counter() - t0) * 1000.0
+                parser.feed(txt)
+                if parser.done:
+                    early = True
+                    break
+        finally:
+            aclose = getattr(stream, "aclose", None)
+            if aclose:
+                await aclose()
+        return parser.text, first_ms, early, meta
+
+    text, first_ms, early, meta = await acall_with_policy(stage or "generate", model, call, deadline=deadline,
+                                                          timings=timings, hedge=False)
+    _stream_timings(timings, stage, first_ms, early)
+    record_usage(stage or "generate", model, meta, usage)
+    _record(stage, model, text)
+    return text
+
+async def aprepare_image_parts(client: genai.Client, paths: List[str]):
+    """Uploads stay on the shared thread pool so the content-hash cache is shared with sync callers."""
+    return await asyncio.to_thread(prepare_image_parts, client, paths)
 
 def extract_text_from_response(resp) -> str:
     """Return JSON/text from parts; also decode inline_data if needed."""
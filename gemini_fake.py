@@ -0,0 +1,539 @@
+# gemini_fake.py
+import os, re, json, glob, math, time, uuid, zlib, random, asyncio, argparse, threading
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import urlparse, parse_qs
+from google.genai import errors, types
+
+# Offline stand-in for the Gemini API, for load tests and CI without network or billing.
+# FakeBackend decides what each call returns (a recorded fixture or a synthetic answer
+# for the stage it recognizes from the prompt), how long it takes (lognormal latency)
+# and whether it fails (5xx error rate, 429 bursts). It is exposed two ways:
+#   - FakeClient: in-process genai.Client look-alike (GEMINI_BACKEND=fake in make_client)
+#   - serve():    HTTP stand-in for generateContent / streamGenerateContent / files, so an
+#                 unmodified genai.Client can point at it via GEMINI_BASE_URL
+# With FAKE_SEED set, every call sequence is reproducible.
+
+SEED = os.getenv("FAKE_SEED")
+TIME_SCALE = float(os.getenv("FAKE_TIME_SCALE", "1.0"))          # 0.01 = 100x faster than real
+LATENCY_MEDIAN_MS = float(os.getenv("FAKE_LATENCY_MEDIAN_MS", "2000"))
+STAGE_MEDIAN_MS = {
+    "recognize": float(os.getenv("FAKE_LATENCY_RECOGNIZE_MS", "2500")),
+    "ing_quant": float(os.getenv("FAKE_LATENCY_ING_QUANT_MS", "4500")),
+    "fused":     float(os.getenv("FAKE_LATENCY_FUSED_MS", "5000")),
+    "calories":  float(os.getenv("FAKE_LATENCY_CALORIES_MS", "2000")),
+    "calories_batch": float(os.getenv("FAKE_LATENCY_CALORIES_BATCH_MS", "3000")),
+    "mass":      float(os.getenv("FAKE_LATENCY_MASS_MS", "2500")),
+}
+LATENCY_SIGMA = float(os.getenv("FAKE_LATENCY_SIGMA", "0.35"))   # lognormal shape; 0.35 → p95 ≈ 1.8x median
+FIRST_TOKEN_FRAC = float(os.getenv("FAKE_FIRST_TOKEN_FRAC", "0.5"))
+UPLOAD_MEDIAN_MS = float(os.getenv("FAKE_UPLOAD_MEDIAN_MS", "400"))
+ERROR_RATE = float(os.getenv("FAKE_ERROR_RATE", "0"))             # per call: 500/503
+BURST_429_RATE = float(os.getenv("FAKE_429_RATE", "0"))           # per call: chance a 429 burst starts
+BURST_429_S = float(os.getenv("FAKE_429_BURST_S", "3"))           # every call inside a burst gets 429
+BAD_JSON_RATE = float(os.getenv("FAKE_BAD_JSON_RATE", "0"))       # free-form pass returns unparseable text
+FIXTURES_DIR = os.getenv("FAKE_FIXTURES_DIR", "")                 # *.jsonl with {"stage","text"} lines
+IMAGE_TOKENS = int(os.getenv("FAKE_IMAGE_TOKENS", "1032"))
+DISH_DRIFT = float(os.getenv("FAKE_DISH_DRIFT", "0.1"))            # unhinted call reads the photo as another dish
+LOW_CONF_RATE = float(os.getenv("FAKE_LOW_CONF_RATE", "0"))        # answer comes back unsure (cascade escalates)
+# latency multiplier by model name prefix (longest match wins); stage medians are for pro
+MODEL_SPEED = {"gemini-2.5-pro": 1.0, "gemini-2.5-flash": 0.45, "gemini-2.5-flash-lite": 0.3}
+MODEL_SPEED.update(json.loads(os.getenv("FAKE_MODEL_SPEED_JSON", "{}")))
+
+_STAGE_MARKERS = (   # first match wins; the fused prompt also mentions ingredient grams
+    ("fused", "recognize the dish and estimate"),
+    ("recognize", "precise food recognizer"),
+    ("ing_quant", "ingredient portions"),
+    ("calories_batch", "pricing several meals"),
+    ("calories", "nutrition estimator"),
+    ("mass", "edible mass"),
+)
+
+_MENU = [
+    {"dish": "chicken fried rice", "container": "plate",
+     "items": [("cooked rice", 220), ("chicken", 90), ("egg", 50), ("peas and carrots", 40), ("cooking oil", 12)]},
+    {"dish": "spaghetti bolognese", "container": "plate",
+     "items": [("cooked spaghetti", 200), ("ground beef", 90), ("tomato sauce", 110), ("parmesan", 8), ("olive oil", 8)]},
+    {"dish": "karaage bowl", "container": "bowl",
+     "items": [("cooked rice", 200), ("fried chicken", 140), ("cabbage", 40), ("mayonnaise", 12), ("cooking oil", 18)]},
+    {"dish": "greek salad", "container": "bowl",
+     "items": [("tomato", 120), ("cucumber", 100), ("feta", 50), ("olives", 25), ("olive oil", 15)]},
+]
+
+# kcal/g and macro split (protein, carbs, fat as fractions of kcal) by name keyword
+_KCAL_PER_G = [
+    ("oil", 8.84, (0.0, 0.0, 1.0)), ("mayonnaise", 6.8, (0.01, 0.01, 0.98)), ("butter", 7.17, (0.0, 0.0, 1.0)),
+    ("rice", 1.30, (0.08, 0.90, 0.02)), ("spaghetti", 1.58, (0.14, 0.80, 0.06)), ("fried chicken", 2.6, (0.35, 0.15, 0.50)),
+    ("chicken", 1.65, (0.80, 0.0, 0.20)), ("beef", 2.5, (0.40, 0.0, 0.60)), ("egg", 1.55, (0.35, 0.02, 0.63)),
+    ("feta", 2.64, (0.22, 0.06, 0.72)), ("parmesan", 4.1, (0.36, 0.04, 0.60)), ("olives", 1.15, (0.03, 0.10, 0.87)),
+]
+
+class FakeBackend:
+    """Shared decision logic for FakeClient and the HTTP stand-in."""
+
+    def __init__(self, seed: Optional[str] = SEED):
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.burst_until = 0.0
+        self.files: Dict[str, types.File] = {}
+        self.fixtures = self._load_fixtures(FIXTURES_DIR)
+        self.stats = {"calls": 0, "streams": 0, "errors_5xx": 0, "errors_429": 0, "bursts_429": 0,
+                      "bad_json": 0, "fixture_answers": 0, "synthetic_answers": 0,
+                      "uploads": 0, "deletes": 0, "by_stage": {}}
+
+    @staticmethod
+    def _load_fixtures(path: str) -> Dict[str, List[str]]:
+        out: Dict[str, List[str]] = {}
+        for fn in sorted(glob.glob(os.path.join(path, "*.jsonl"))) if path else []:
+            with open(fn, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        rec = json.loads(line)
+                        out.setdefault(rec["stage"], []).append(rec["text"])
+                    except Exception:
+                        continue
+        if out:
+            print(f"[fake] loaded fixtures: " + ", ".join(f"{k}={len(v)}" for k, v in out.items()))
+        return out
+
+    # ---------- sampling ----------
+    def _lognormal_s(self, median_ms: float) -> float:
+        with self.lock:
+            z = self.rng.gauss(0.0, 1.0)
+        return median_ms * math.exp(LATENCY_SIGMA * z) / 1000.0 * TIME_SCALE
+
+    def _roll(self, p: float) -> bool:
+        if p <= 0:
+            return False
+        with self.lock:
+            return self.rng.random() < p
+
+    def stage_of(self, text: str) -> str:
+        low = text.lower()
+        return next((stage for stage, marker in _STAGE_MARKERS if marker in low), "generate")
+
+    def _error(self, stage: str) -> Optional[Tuple[int, str]]:
+        now = time.time()
+        with self.lock:
+            in_burst = now < self.burst_until
+            if not in_burst and BURST_429_RATE > 0 and self.rng.random() < BURST_429_RATE:
+                self.burst_until = now + BURST_429_S * TIME_SCALE
+                self.stats["bursts_429"] += 1
+                in_burst = True
+            if in_burst:
+                self.stats["errors_429"] += 1
+                return 429, "RESOURCE_EXHAUSTED"
+            if ERROR_RATE > 0 and self.rng.random() < ERROR_RATE:
+                self.stats["errors_5xx"] += 1
+                return self.rng.choice((500, 503)), "UNAVAILABLE"
+        return None
+
+    # ---------- answers ----------
+    def _pick(self, seq):
+        with self.lock:
+            return self.rng.choice(seq)
+
+    def _scene_dish(self, scene: str, drift: bool = False) -> Dict:
+        """The same photos read as the same dish (calls agree), except for DISH_DRIFT on unhinted reads."""
+        if not scene or (drift and self._roll(DISH_DRIFT)):
+            return self._pick(_MENU)
+        return _MENU[zlib.crc32(scene.encode("utf-8")) % len(_MENU)]
+
+    def _menu_for(self, text: str, scene: str = "") -> Dict:
+        m = re.search(r"Dish context: (.+)", text)
+        hint = (m.group(1).strip().lower() if m else "")
+        return next((d for d in _MENU if d["dish"] == hint), None) or self._scene_dish(scene, drift=True)
+
+    def _synthetic(self, stage: str, text: str, scene: str = "") -> Dict:
+        unsure = self._roll(LOW_CONF_RATE)
+        if stage == "recognize":
+            d = self._scene_dish(scene)
+            return {"dish": d["dish"], "ingredients": [n for n, _ in d["items"]],
+                    "container": d["container"], "confidence": 0.45 if unsure else 0.86}
+        if stage == "ing_quant":
+            d = self._menu_for(text, scene)
+            items = [{"name": n, "grams": g, "note": ""} for n, g in d["items"]]
+            return {"items": items, "total_grams": sum(g for _, g in d["items"]),
+                    "confidence": 0.4 if unsure else 0.72, "notes": "synthetic estimate"}
+        if stage == "fused":
+            d = self._scene_dish(scene)
+            return {"dish": d["dish"], "ingredients": [n for n, _ in d["items"]], "container": d["container"],
+                    "dish_confidence": 0.45 if unsure else 0.86,
+                    "items": [{"name": n, "grams": g, "note": ""} for n, g in d["items"]],
+                    "total_grams": sum(g for _, g in d["items"]), "grams_confidence": 0.72,
+                    "notes": "synthetic estimate"}
+        if stage == "calories":
+            m = re.search(r"Items \(name \+ grams\): (\[.*\])", text)
+            return self._price(m.group(1) if m else "[]", unsure)
+        if stage == "calories_batch":
+            return {"meals": [self._price(block, unsure)
+                              for block in re.findall(r"Items \(name \+ grams\): (\[.*\])", text)]}
+        if stage == "mass":
+            return {"grams_low": 320, "grams_high": 420, "confidence": 0.6, "notes": "synthetic estimate"}
+        return {"ok": True}
+
+    def _price(self, items_json: str, unsure: bool) -> Dict:
+        try:
+            items = json.loads(items_json)
+        except Exception:
+            items = []
+        out = []
+        for it in items:
+            name, grams = str(it.get("name", "")), float(it.get("grams") or 0.0)
+            kpg, (p, c, f) = next(((k, s) for key, k, s in _KCAL_PER_G if key in name.lower()), (1.2, (0.15, 0.6, 0.25)))
+            kcal = round(kpg * grams, 1)
+            out.append({"name": name, "kcal": kcal, "protein_g": round(kcal * p / 4, 1),
+                        "carbs_g": round(kcal * c / 4, 1), "fat_g": round(kcal * f / 9, 1)})
+        tot = lambda k: round(sum(x[k] for x in out), 1)
+        return {"items": out, "total_kcal": tot("kcal"), "total_protein_g": tot("protein_g"),
+                "total_carbs_g": tot("carbs_g"), "total_fat_g": tot("fat_g"),
+                "confidence": 0.4 if unsure else 0.78, "notes": "synthetic estimate"}
+
+    def answer(self, stage: str, text: str, constrained: bool, scene: str = "") -> str:
+        fixtures = self.fixtures.get(stage)
+        if fixtures:
+            out = self._pick(fixtures)
+            key = "fixture_answers"
+        else:
+            out = json.dumps(self._synthetic(stage, text, scene), ensure_ascii=False)
+            key = "synthetic_answers"
+        if not constrained and self._roll(BAD_JSON_RATE):
+            # what a chatty free-form pass sometimes returns: prose + truncated JSON
+            out = "Here is my estimate:\n" + out[: max(1, len(out) // 2)]
+            key = "bad_json"
+        with self.lock:
+            self.stats[key] += 1
+        return out
+
+    def usage(self, text: str, n_images: int, out: str, config) -> types.GenerateContentResponseUsageMetadata:
+        budget = getattr(getattr(config, "thinking_config", None), "thinking_budget", None) or 0
+        with self.lock:
+            thoughts = int(self.rng.uniform(0.3, 1.0) * budget) if budget > 0 else 0
+        prompt, cand = len(text) // 4 + IMAGE_TOKENS * n_images, max(1, len(out) // 4)
+        return types.GenerateContentResponseUsageMetadata(
+            prompt_token_count=prompt, candidates_token_count=cand,
+            thoughts_token_count=thoughts or None, total_token_count=prompt + cand + thoughts)
+
+    # ---------- one call ----------
+    def plan(self, contents, config=None, stream: bool = False, model: str = "") -> Dict[str, Any]:
+        """Decide one call up front: stage, delay, error or (text, usage)."""
+        text, n_images, scene = _flatten_contents(contents)
+        stage = self.stage_of(text)
+        with self.lock:
+            self.stats["calls"] += 1
+            self.stats["streams"] += 1 if stream else 0
+            self.stats["by_stage"][stage] = self.stats["by_stage"].get(stage, 0) + 1
+        err = self._error(stage)
+        if err is not None:
+            # rejected calls come back fast; server errors after part of the work
+            delay = self._lognormal_s(60.0 if err[0] == 429 else STAGE_MEDIAN_MS.get(stage, LATENCY_MEDIAN_MS) * 0.3)
+            return {"stage": stage, "delay_s": delay, "error": err}
+        constrained = bool(getattr(config, "response_schema", None))
+        out = self.answer(stage, text, constrained, scene)
+        name = (model or "").split("/")[-1]
+        speed = MODEL_SPEED[max((m for m in MODEL_SPEED if name.startswith(m)), key=len, default="gemini-2.5-pro")]
+        return {"stage": stage, "delay_s": self._lognormal_s(STAGE_MEDIAN_MS.get(stage, LATENCY_MEDIAN_MS) * speed),
+                "error": None, "text": out, "usage": self.usage(text, n_images, out, config)}
+
+    def upload(self, display_name: str = "", mime_type: str = "", size: int = 0) -> types.File:
+        now = datetime.now(timezone.utc)
+        name = f"files/{uuid.uuid4().hex[:16]}"
+        f = types.File(name=name, display_name=display_name or None, mime_type=mime_type or None,
+                       size_bytes=size, state="ACTIVE", uri=f"fake://{name}",
+                       create_time=now, expiration_time=now + timedelta(hours=48))
+        with self.lock:
+            self.files[name] = f
+            self.stats["uploads"] += 1
+        return f
+
+    def delete(self, name: str):
+        with self.lock:
+            if self.files.pop(name, None) is None:
+                raise errors.ClientError(404, {"error": {"code": 404, "message": f"{name} not found", "status": "NOT_FOUND"}})
+            self.stats["deletes"] += 1
+
+    def snapshot(self) -> Dict:
+        with self.lock:
+            return {**self.stats, "by_stage": dict(self.stats["by_stage"]), "files": len(self.files),
+                    "config": {"seed": SEED, "time_scale": TIME_SCALE, "sigma": LATENCY_SIGMA,
+                               "error_rate": ERROR_RATE, "burst_429_rate": BURST_429_RATE,
+                               "bad_json_rate": BAD_JSON_RATE, "dish_drift": DISH_DRIFT, "low_conf_rate": LOW_CONF_RATE, "fixtures": bool(self.fixtures)}}
+
+_BACKEND: Optional[FakeBackend] = None
+_BACKEND_LOCK = threading.Lock()
+
+def backend() -> FakeBackend:
+    global _BACKEND
+    with _BACKEND_LOCK:
+        if _BACKEND is None:
+            _BACKEND = FakeBackend()
+        return _BACKEND
+
+def fake_stats() -> Dict:
+    return backend().snapshot() if _BACKEND is not None else {}
+
+def _flatten_contents(contents) -> Tuple[str, int, str]:
+    """(all prompt text, image count, scene key) from SDK objects or REST JSON dicts."""
+    texts, refs = [], []
+    for c in (contents if isinstance(contents, list) else [contents]):
+        parts = c.get("parts", []) if isinstance(c, dict) else (getattr(c, "parts", None) or [c])
+        for p in parts:
+            if isinstance(p, str):
+                texts.append(p)
+            elif isinstance(p, dict):
+                if p.get("text"):
+                    texts.append(p["text"])
+                if p.get("fileData"):
+                    refs.append(p["fileData"].get("fileUri", ""))
+                elif p.get("inlineData"):
+                    refs.append(str(p["inlineData"].get("data", ""))[:256])
+            elif isinstance(p, types.File):
+                refs.append(p.uri or p.name or "")
+            else:
+                if getattr(p, "text", None):
+                    texts.append(p.text)
+                if getattr(p, "file_data", None):
+                    refs.append(p.file_data.file_uri or "")
+                elif getattr(p, "inline_data", None):
+                    refs.append(str(zlib.crc32(p.inline_data.data or b"")))
+    return "\n".join(texts), len(refs), "|".join(refs)
+
+def _api_error(code: int, status: str) -> errors.APIError:
+    body = {"error": {"code": code, "message": f"fake {status.lower()}", "status": status}}
+    return errors.ClientError(code, body) if code < 500 else errors.ServerError(code, body)
+
+def _response(text: str, usage=None, final: bool = True) -> types.GenerateContentResponse:
+    return types.GenerateContentResponse(
+        candidates=[types.Candidate(content=types.Content(role="model", parts=[types.Part.from_text(text=text)]),
+                                    finish_reason="STOP" if final else None)],
+        usage_metadata=usage,
+    )
+
+def _chunks(text: str, size: int = 48) -> List[str]:
+    return [text[i:i + size] for i in range(0, len(text), size)] or [""]
+
+def _chunk_delays(p: Dict) -> List[Tuple[float, str]]:
+    """First chunk at FIRST_TOKEN_FRAC of the total delay, the rest spread evenly."""
+    chunks = _chunks(p["text"])
+    first = p["delay_s"] * FIRST_TOKEN_FRAC
+    rest = (p["delay_s"] - first) / max(1, len(chunks) - 1)
+    return [(first if i == 0 else rest, c) for i, c in enumerate(chunks)]
+
+# ---------- in-process client ----------
+class _Models:
+    def __init__(self, be: FakeBackend):
+        self.be = be
+
+    def generate_content(self, model: str, contents, config=None):
+        p = self.be.plan(contents, config, model=model)
+        time.sleep(p["delay_s"])
+        if p["error"]:
+            raise _api_error(*p["error"])
+        return _response(p["text"], p["usage"])
+
+    def generate_content_stream(self, model: str, contents, config=None):
+        p = self.be.plan(contents, config, stream=True, model=model)
+        if p["error"]:
+            time.sleep(p["delay_s"])
+            raise _api_error(*p["error"])
+        def gen():
+            steps = _chunk_delays(p)
+            for i, (delay, chunk) in enumerate(steps):
+                time.sleep(delay)
+                last = i == len(steps) - 1
+                yield _response(chunk, p["usage"] if last else None, final=last)
+        return gen()
+
+class _AsyncModels:
+    def __init__(self, be: FakeBackend):
+        self.be = be
+
+    async def generate_content(self, model: str, contents, config=None):
+        p = self.be.plan(contents, config, model=model)
+        await asyncio.sleep(p["delay_s"])
+        if p["error"]:
+            raise _api_error(*p["error"])
+        return _response(p["text"], p["usage"])
+
+    async def generate_content_stream(self, model: str, contents, config=None):
+        p = self.be.plan(contents, config, stream=True, model=model)
+        if p["error"]:
+            await asyncio.sleep(p["delay_s"])
+            raise _api_error(*p["error"])
+        async def agen():
+            steps = _chunk_delays(p)
+            for i, (delay, chunk) in enumerate(steps):
+                await asyncio.sleep(delay)
+                last = i == len(steps) - 1
+                yield _response(chunk, p["usage"] if last else None, final=last)
+        return agen()
+
+class _Files:
+    def __init__(self, be: FakeBackend):
+        self.be = be
+
+    def upload(self, file, config=None):
+        size = os.path.getsize(file) if isinstance(file, (str, os.PathLike)) else 0
+        time.sleep(self.be._lognormal_s(UPLOAD_MEDIAN_MS))
+        return self.be.upload(getattr(config, "display_name", "") or "", getattr(config, "mime_type", "") or "", size)
+
+    def get(self, name: str):
+        f = self.be.files.get(name)
+        if f is None:
+            raise _api_error(404, "NOT_FOUND")
+        return f
+
+    def delete(self, name: str, config=None):
+        self.be.delete(name)
+
+    def list(self, config=None):
+        with self.be.lock:
+            return iter(list(self.be.files.values()))
+
+class _AsyncFiles:
+    def __init__(self, files: _Files):
+        self.sync = files
+
+    async def upload(self, file, config=None):
+        return await asyncio.to_thread(self.sync.upload, file, config)
+
+    async def delete(self, name: str, config=None):
+        self.sync.delete(name)
+
+class FakeClient:
+    """Drop-in for the parts of genai.Client the app uses. Behaves like an API-key client (File API on)."""
+    vertexai = False
+
+    def __init__(self, be: Optional[FakeBackend] = None):
+        be = be or backend()
+        self.models = _Models(be)
+        self.files = _Files(be)
+        self.aio = SimpleNamespace(models=_AsyncModels(be), files=_AsyncFiles(self.files))
+
+# ---------- HTTP stand-in ----------
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    uploads: Dict[str, Dict] = {}   # upload_id -> pending file metadata
+
+    def log_message(self, fmt, *args):
+        pass
+
+    def _send_json(self, code: int, obj: Dict, headers: Optional[Dict[str, str]] = None):
+        body = json.dumps(obj).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _body(self) -> bytes:
+        n = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(n) if n else b""
+
+    def _error(self, code: int, status: str):
+        self._send_json(code, {"error": {"code": code, "message": f"fake {status.lower()}", "status": status}})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        be = backend()
+        if url.path.endswith("/files") and url.path.startswith("/upload/"):
+            qs = parse_qs(url.query)
+            if "upload_id" not in qs:
+                meta = (json.loads(self._body() or b"{}").get("file") or {})
+                uid = uuid.uuid4().hex
+                _Handler.uploads[uid] = meta
+                host = self.headers.get("Host", "localhost")
+                return self._send_json(200, {}, {"x-goog-upload-url": f"http://{host}{url.path}?upload_id={uid}"})
+            data = self._body()
+            if "finalize" not in (self.headers.get("X-Goog-Upload-Command") or ""):
+                return self._send_json(200, {}, {"x-goog-upload-status": "active"})
+            meta = _Handler.uploads.pop(qs["upload_id"][0], {})
+            time.sleep(be._lognormal_s(UPLOAD_MEDIAN_MS))
+            f = be.upload(meta.get("displayName", ""), meta.get("mimeType", ""), len(data))
+            return self._send_json(200, {"file": f.model_dump(mode="json", by_alias=True, exclude_none=True)},
+                                   {"x-goog-upload-status": "final"})
+
+        m = re.match(r"^/[^/]+/models/([^:]+):(generateContent|streamGenerateContent)$", url.path)
+        if not m:
+            return self._error(404, "NOT_FOUND")
+        req = json.loads(self._body() or b"{}")
+        cfg = req.get("generationConfig") or {}
+        config = SimpleNamespace(response_schema=cfg.get("responseSchema"),
+                                 thinking_config=SimpleNamespace(
+                                     thinking_budget=(cfg.get("thinkingConfig") or {}).get("thinkingBudget")))
+        stream = m.group(2) == "streamGenerateContent"
+        p = be.plan(req.get("contents") or [], config, stream=stream, model=m.group(1))
+        if p["error"]:
+            time.sleep(p["delay_s"])
+            return self._error(*p["error"])
+        dump = lambda r: r.model_dump(mode="json", by_alias=True, exclude_none=True)
+        if not stream:
+            time.sleep(p["delay_s"])
+            return self._send_json(200, dump(_response(p["text"], p["usage"])))
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        steps = _chunk_delays(p)
+        try:
+            for i, (delay, chunk) in enumerate(steps):
+                time.sleep(delay)
+                last = i == len(steps) - 1
+                line = f"data: {json.dumps(dump(_response(chunk, p['usage'] if last else None, final=last)))}\r\n\r\n"
+                data = line.encode("utf-8")
+                self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+                self.wfile.flush()
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            pass   # client stopped reading (early stop after the JSON closed)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        be = backend()
+        if url.path == "/stats":
+            return self._send_json(200, be.snapshot())
+        if re.match(r"^/[^/]+/files$", url.path):
+            with be.lock:
+                files = [f.model_dump(mode="json", by_alias=True, exclude_none=True) for f in be.files.values()]
+            return self._send_json(200, {"files": files})
+        m = re.match(r"^/[^/]+/(files/[^/]+)$", url.path)
+        f = be.files.get(m.group(1)) if m else None
+        if f is None:
+            return self._error(404, "NOT_FOUND")
+        return self._send_json(200, f.model_dump(mode="json", by_alias=True, exclude_none=True))
+
+    def do_DELETE(self):
+        m = re.match(r"^/[^/]+/(files/[^/]+)$", urlparse(self.path).path)
+        try:
+            backend().delete(m.group(1) if m else "")
+        except errors.APIError:
+            return self._error(404, "NOT_FOUND")
+        return self._send_json(200, {})
+
+def serve(host: str = "127.0.0.1", port: int = 8089) -> ThreadingHTTPServer:
+    """Start the stand-in on a daemon thread and return the server (call .shutdown() to stop)."""
+    srv = ThreadingHTTPServer((host, port), _Handler)
+    srv.daemon_threads = True
+    threading.Thread(target=srv.serve_forever, name="gemini-fake-http", daemon=True).start()
+    print(f"[fake] Gemini stand-in on http://{host}:{srv.server_address[1]}  (set GEMINI_BASE_URL to this)")
+    return srv
+
+def main():
+    ap = argparse.ArgumentParser("Gemini stand-in server (offline load testing)")
+    ap.add_argument("--host", type=str, default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8089)
+    args = ap.parse_args()
+    srv = serve(args.host, args.port)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        srv.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+# gemini_fused.py
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from google.genai import types
+from gemini_client import (make_client, prepare_image_parts, aprepare_image_parts, generate_text, agenerate_text,
+                           stream_json, astream_json, first_json_block, json_mode, record_passes)
+from gemini_ingredients import PROMPT_BLOCK, UTENSIL_SCALE, fnum
+from gemini_policy import deadline_for
+import llm_cache
+
+# One multimodal call doing recognize + ing_quant: the images are sent (and billed) once
+# and the second round trip disappears. Field order puts dish/ingredients first so a
+# streamed response surfaces them before the per-item grams.
+NEEDED = ["dish", "items"]
+
+SYS_PROMPT = (
+    "You recognize the dish AND estimate its ingredient grams for a SINGLE-PLATE serving "
+    "from one or more photos (multiple angles), in one answer.\n\n"
+    "Output: STRICT JSON ONLY, keys in this order:\n"
+    "{\n"
+    '  "dish": "<short canonical dish, lowercase>",\n'
+    '  "ingredients": ["<3-12 likely ingredients, lowercase; include cooking fats/oils if implied>"],\n'
+    '  "container": "plate|bowl|tray|cup|none",\n'
+    '  "dish_confidence": <0..1>,\n'
+    '  "items": [{"name": string, "grams": number, "note": string}],\n'
+    '  "total_grams": number,\n'
+    '  "grams_confidence": <0..1>,\n'
+    '  "notes": string\n'
+    "}\n\n"
+    "'items' quantifies the ingredients you listed (same names where possible).\n\n"
+    # the portioning rules are shared with the two-call path so both estimate alike
+    + "Rules:" + PROMPT_BLOCK.split("Rules:", 1)[1]
+    + UTENSIL_SCALE
+)
+
+_CFG_FREE = types.GenerateContentConfig(
+    temperature=0.0,
+    max_output_tokens=2048,
+    thinking_config=types.ThinkingConfig(thinking_budget=128),
+)
+
+_SCHEMA = types.Schema(
+    type=types.Type.OBJECT,
+    properties={
+        "dish": types.Schema(type=types.Type.STRING),
+        "ingredients": types.Schema(type=types.Type.ARRAY, items=types.Schema(type=types.Type.STRING)),
+        "container": types.Schema(type=types.Type.STRING),
+        "dish_confidence": types.Schema(type=types.Type.NUMBER),
+        "items": types.Schema(
+            type=types.Type.ARRAY,
+            items=types.Schema(
+                type=types.Type.OBJECT,
+                properties={
+                    "name":  types.Schema(type=types.Type.STRING),
+                    "grams": types.Schema(type=types.Type.NUMBER),
+                    "note":  types.Schema(type=types.Type.STRING),
+                },
+                required=["name","grams"]
+            )
+        ),
+        "total_grams": types.Schema(type=types.Type.NUMBER),
+        "grams_confidence": types.Schema(type=types.Type.NUMBER),
+        "notes": types.Schema(type=types.Type.STRING),
+    },
+    required=["dish","ingredients","container","dish_confidence","items","total_grams","grams_confidence"],
+    property_ordering=["dish","ingredients","container","dish_confidence","items","total_grams","grams_confidence","notes"],
+)
+_CFG_SCHEMA = types.GenerateContentConfig(
+    temperature=0.0,
+    response_mime_type="application/json",
+    response_schema=_SCHEMA,
+    max_output_tokens=4096,
+    thinking_config=types.ThinkingConfig(thinking_budget=128),
+)
+
+def _pass1_cfg() -> types.GenerateContentConfig:
+    return _CFG_SCHEMA if json_mode("fused") == "schema" else _CFG_FREE
+
+def _ok(data: Dict) -> bool:
+    return bool(data) and all(k in data for k in NEEDED) and bool(data.get("items"))
+
+def _finish(data: Dict, raw: str) -> Dict:
+    if not _ok(data):
+        return {"error": "fused_failed", "raw": raw}
+    items = []
+    for it in (data.get("items") or []):
+        if not isinstance(it, dict):
+            continue
+        items.append({"name": str(it.get("name") or "").strip().lower(),
+                      "grams": max(0.0, fnum(it.get("grams"))), "note": it.get("note")})
+    return {
+        "dish": str(data.get("dish") or "").lower().strip(),
+        "ingredients": [str(x).lower().strip() for x in (data.get("ingredients") or [])][:12],
+        "container": str(data.get("container") or "none").lower().strip(),
+        "confidence": fnum(data.get("dish_confidence"), 0.0),
+        "items": items,
+        "total_grams": fnum(data.get("total_grams"), sum(i["grams"] for i in items)),
+        "grams_confidence": fnum(data.get("grams_confidence"), 0.6),
+        "notes": data.get("notes"),
+    }
+
+def split_fused(res: Dict) -> Tuple[Dict, Dict]:
+    """(recognize-shaped, ing_quant-shaped) views of a fused result, for code written against the two stages."""
+    rec = {k: res.get(k) for k in ("dish", "ingredients", "container", "confidence")}
+    ing = {"items": res.get("items", []), "total_grams": res.get("total_grams"),
+           "confidence": res.get("grams_confidence"), "notes": res.get("notes")}
+    return rec, ing
+
+def _cache_key(a: Dict) -> str:
+    return llm_cache.make_key("fused", a["model"], SYS_PROMPT, a["image_paths"], [_pass1_cfg(), _CFG_SCHEMA])
+
+@llm_cache.cached_stage("fused", _cache_key)
+def recognize_and_quantify(project: Optional[str], location: str, model: str, image_paths: List[str],
+                           timings: Optional[Dict[str, float]] = None,
+                           usage: Optional[List[Dict]] = None,
+                           on_partial: Optional[Callable[[tuple, Any], None]] = None) -> Dict:
+    """
+    Output: {dish, ingredients, container, confidence, items:[{name,grams,note}],
+             total_grams, grams_confidence, notes}
+    on_partial(path, value) fires for ("dish",), ("ingredients", i) and ("items", i) as they close.
+    """
+    client = make_client(project, location)
+    deadline = deadline_for("fused")
+    parts = [types.Part.from_text(text=SYS_PROMPT)] + prepare_image_parts(client, image_paths)
+
+    cfg1 = _pass1_cfg()
+    if on_partial:
+        raw1 = stream_json(client, model, parts, cfg1, on_partial, "fused", deadline, timings, usage=usage)
+    else:
+        raw1 = generate_text(client, model, parts, cfg1, "fused", deadline, timings, usage=usage)
+    data = first_json_block(raw1)
+    raw2 = ""
+    second = not _ok(data) and cfg1 is _CFG_FREE
+    if second:
+        raw2 = generate_text(client, model, parts, _CFG_SCHEMA, "fused", deadline, timings, usage=usage)
+        data = first_json_block(raw2)
+    record_passes("fused", model, 2 if second else 1, timings)
+    return _finish(data, raw2 or raw1)
+
+@llm_cache.cached_stage("fused", _cache_key)
+async def recognize_and_quantify_async(project: Optional[str], location: str, model: str, image_paths: List[str],
+                                       timings: Optional[Dict[str, float]] = None,
+                                       usage: Optional[List[Dict]] = None,
+                                       on_partial: Optional[Callable[[tuple, Any], None]] = None) -> Dict:
+    client = make_client(project, location)
+    deadline = deadline_for("fused")
+    parts = [types.Part.from_text(text=SYS_PROMPT)] + await aprepare_image_parts(client, image_paths)
+
+    cfg1 = _pass1_cfg()
+    if on_partial:
+        raw1 = await astream_json(client, model, parts, cfg1, on_partial, "fused", deadline, timings, usage=usage)
+    else:
+        raw1 = await agenerate_text(client, model, parts, cfg1, "fused", deadline, timings, usage=usage)
+    data = first_json_block(raw1)
+    raw2 = ""
+    second = not _ok(data) and cfg1 is _CFG_FREE
+    if second:
+        raw2 = await agenerate_text(client, model, parts, _CFG_SCHEMA, "fused", deadline, timings, usage=usage)
+        data = first_json_block(raw2)
+    record_passes("fused", model, 2 if second else 1, timings)
+    return _finish(data, raw2 or raw1)
@@ -1,8 +1,11 @@
 # gemini_ingredients.py
 import re
-from typing import Dict, List, Optional
+from typing import Any, Callable, Dict, List, Optional
 from google.genai import types
-from gemini_client import make_client, prepare_image_parts, extract_text_from_response, first_json_block
+from gemini_client import (make_client, prepare_image_parts, aprepare_image_parts, generate_text, agenerate_text,
+                           stream_json, astream_json, first_json_block, json_mode, record_passes)
+from gemini_policy import deadline_for
+import llm_cache
 
 def fnum(x, default=0.0) -> float:
     """
@@ -30,18 +33,7 @@ A standard fork or spoon may be present. Use it as a SCALE reference:
 Leverage multiple angles to reconcile volumes and surfaces; down-weight outliers; pick ONE best grams per item.
 """
 
-def ingredients_from_image(project: Optional[str], location: str, model: str,
-                           image_paths: List[str], dish_hint: str = "", ing_hint: Optional[List[str]] = None) -> Dict:
-    """
-    Ask Gemini to list EDIBLE components and return a SINGLE BEST estimate in grams for each item (no ranges).
-    Returns:
-      { items:[{name, grams, note?}], total_grams, confidence, notes? }
-      or { "error": "...", "raw": "..." }
-    """
-    client = make_client(project or "", location)
-    img_parts = prepare_image_parts(client, image_paths)
-
-    prompt_block = """
+PROMPT_BLOCK = """
 You estimate ingredient portions (grams) for a SINGLE-PLATE serving from one or more photos (multiple angles).
 
 Output: STRICT JSON ONLY
@@ -75,90 +67,85 @@ Before answering, sanity-check your oil estimate:
 
 Return ONLY the JSON.
 """
+
+def _build_parts(img_parts: List, dish_hint: str, ing_hint: Optional[List[str]]) -> List:
     ing_text = ", ".join(ing_hint or [])
     hints_block = (
         f"Dish context: {dish_hint or '(unknown)'}\n"
         f"Likely ingredients to consider: {ing_text or '(model must infer)'}\n"
         + UTENSIL_SCALE
     )
+    return [types.Part.from_text(text=hints_block), types.Part.from_text(text=PROMPT_BLOCK)] + img_parts
 
-    # Pass 1: free JSON (deterministic)
-    cfg1 = types.GenerateContentConfig(
-        temperature=0.0,
-        max_output_tokens=2048,
-        thinking_config=types.ThinkingConfig(thinking_budget=128),
-    )
-    parts = [types.Part.from_text(text=hints_block), types.Part.from_text(text=prompt_block)] + img_parts
-    resp1 = client.models.generate_content(
-        model=model,
-        contents=[types.Content(role="user", parts=parts)],
-        config=cfg1,
-    )
-    raw1 = extract_text_from_response(resp1) or getattr(resp1, "text", "")
-    data = first_json_block(raw1)
+# Pass 1: free JSON (deterministic)
+_CFG_FREE = types.GenerateContentConfig(
+    temperature=0.0,
+    max_output_tokens=2048,
+    thinking_config=types.ThinkingConfig(thinking_budget=128),
+)
 
-    # Pass 2: force schema if needed
-    if not data or any(k not in data for k in NEEDED):
-        schema = types.Schema(
-            type=types.Type.OBJECT,
-            properties={
-                "items": types.Schema(
-                    type=types.Type.ARRAY,
-                    items=types.Schema(
-                        type=types.Type.OBJECT,
-                        properties={
-                            "name":  types.Schema(type=types.Type.STRING),
-                            "grams": types.Schema(type=types.Type.NUMBER),
-                            "note":  types.Schema(type=types.Type.STRING),
-                        },
-                        required=["name","grams"]
-                    )
-                ),
-                "total_grams": types.Schema(type=types.Type.NUMBER),
-                "confidence":  types.Schema(type=types.Type.NUMBER),
-                "notes":       types.Schema(type=types.Type.STRING),
-            },
-            required=NEEDED
-        )
-        cfg2 = types.GenerateContentConfig(
-            temperature=0.0,
-            response_mime_type="application/json",
-            response_schema=schema,
-            max_output_tokens=4096,
-            thinking_config=types.ThinkingConfig(thinking_budget=128),
-        )
-        resp2 = client.models.generate_content(
-            model=model,
-            contents=[types.Content(role="user", parts=parts)],
-            config=cfg2,
-        )
-        raw2 = extract_text_from_response(resp2) or getattr(resp2, "text", "")
-        data = first_json_block(raw2) or {}
-        if any(k not in data for k in NEEDED):
-            # Backcompat: if model still returns grams_low/high, collapse to median.
-            fallback = first_json_block(raw2 or raw1) or {}
-            items = []
-            for it in (fallback.get("items") or []):
-                try:
-                    name = str(it.get("name","")).lower().strip()
-                    if "grams" in it:
-                        g = fnum(it["grams"])
-                    else:
-                        gL = fnum(it.get("grams_low"), 0.0)
-                        gH = fnum(it.get("grams_high"), gL)
-                        g = max(0.0, (gL + max(gL, gH)) / 2.0)
-                    items.append({"name": name, "grams": g, "note": it.get("note")})
-                except Exception:
-                    continue
-            if not items:
-                return {"error":"ingredients_failed", "raw": raw2 or raw1}
-            total = fnum(fallback.get("total_grams"), sum(i["grams"] for i in items))
-            return {
-                "items": items,
-                "total_grams": total,
-                "confidence": fnum(fallback.get("confidence"), 0.6),
-                "notes": fallback.get("notes"),
-            }
+# Pass 2: force schema if needed
+_SCHEMA = types.Schema(
+    type=types.Type.OBJECT,
+    properties={
+        "items": types.Schema(
+            type=types.Type.ARRAY,
+            items=types.Schema(
+                type=types.Type.OBJECT,
+                properties={
+                    "name":  types.Schema(type=types.Type.STRING),
+                    "grams": types.Schema(type=types.Type.NUMBER),
+                    "note":  types.Schema(type=types.Type.STRING),
+                },
+                required=["name","grams"]
+            )
+        ),
+        "total_grams": types.Schema(type=types.Type.NUMBER),
+        "confidence":  types.Schema(type=types.Type.NUMBER),
+        "notes":       types.Schema(type=types.Type.STRING),
+    },
+    required=NEEDED
+)
+_CFG_SCHEMA = types.GenerateContentConfig(
+    temperature=0.0,
+    response_mime_type="application/json",
+    response_schema=_SCHEMA,
+    max_output_tokens=4096,
+    thinking_config=types.ThinkingConfig(thinking_budget=128),
+)
+
+def _pass1_cfg() -> types.GenerateContentConfig:
+    return _CFG_SCHEMA if json_mode("ing_quant") == "schema" else _CFG_FREE
+
+def _ok(data: Dict) -> bool:
+    return bool(data) and all(k in data for k in NEEDED)
+
+def _finish(data: Dict, raw1: str, raw2: str) -> Dict:
+    if not _ok(data):
+        # Backcompat: if model still returns grams_low/high, collapse to median.
+        fallback = first_json_block(raw2 or raw1) or {}
+        items = []
+        for it in (fallback.get("items") or []):
+            try:
+                name = str(it.get("name","")).lower().strip()
+                if "grams" in it:
+                    g = fnum(it["grams"])
+                else:
+                    gL = fnum(it.get("grams_low"), 0.0)
+                    gH = fnum(it.get("grams_high"), gL)
+                    g = max(0.0, (gL + max(gL, gH)) / 2.0)
+                items.append({"name": name, "grams": g, "note": it.get("note")})
+            except Exception:
+                continue
+        if not items:
+            return {"error":"ingredients_failed", "raw": raw2 or raw1}
+        total = fnum(fallback.get("total_grams"), sum(i["grams"] for i in items))
+        return {
+            "items": items,
+            "total_grams": total,
+            "confidence": fnum(fallback.get("confidence"), 0.6),
+            "notes": fallback.get("notes"),
+        }
 
     # normalize single-grams response (robust numbers)
     items = []
@@ -175,3 +162,65 @@ Return ONLY the JSON.
         "confidence": fnum(data.get("confidence"), 0.6),
         "notes": data.get("notes"),
     }
+
+def _cache_key(a: Dict) -> str:
+    return llm_cache.make_key("ing_quant", a["model"], PROMPT_BLOCK + UTENSIL_SCALE, a["image_paths"],
+                              [_pass1_cfg(), _CFG_SCHEMA],
+                              extra={"dish_hint": a["dish_hint"], "ing_hint": a["ing_hint"] or []})
+
+@llm_cache.cached_stage("ing_quant", _cache_key)
+def ingredients_from_image(project: Optional[str], location: str, model: str,
+                           image_paths: List[str], dish_hint: str = "", ing_hint: Optional[List[str]] = None,
+                           timings: Optional[Dict[str, float]] = None,
+                           usage: Optional[List[Dict]] = None,
+                           on_partial: Optional[Callable[[tuple, Any], None]] = None) -> Dict:
+    """
+    Ask Gemini to list EDIBLE components and return a SINGLE BEST estimate in grams for each item (no ranges).
+    Returns:
+      { items:[{name, grams, note?}], total_grams, confidence, notes? }
+      or { "error": "...", "raw": "..." }
+    on_partial(path, value) streams pass 1; (("items", i), {...}) fires as each item closes.
+    """
+    client = make_client(project or "", location)
+    deadline = deadline_for("ing_quant")
+    parts = _build_parts(prepare_image_parts(client, image_paths), dish_hint, ing_hint)
+
+    cfg1 = _pass1_cfg()
+    if on_partial:
+        raw1 = stream_json(client, model, parts, cfg1, on_partial, "ing_quant", deadline, timings, usage=usage)
+    else:
+        raw1 = generate_text(client, model, parts, cfg1, "ing_quant", deadline, timings, usage=usage)
+    data = first_json_block(raw1)
+    raw2 = ""
+    second = not _ok(data) and cfg1 is _CFG_FREE
+    if second:
+        raw2 = generate_text(client, model, parts, _CFG_SCHEMA, "ing_quant", deadline, timings, usage=usage)
+        data = first_json_block(raw2) or {}
+    record_passes("ing_quant", model, 2 if second else 1, timings)
+    return _finish(data, raw1, raw2)
+
+@llm_cache.cached_stage("ing_quant", _cache_key)
+async def ingredients_from_image_async(project: Optional[str], location: str, model: str,
+                                       image_paths: List[str], dish_hint: str = "",
+                                       ing_hint: Optional[List[str]] = None,
+                                       timings: Optional[Dict[str, float]] = None,
+                                       usage: Optional[List[Dict]] = None,
+                                       on_partial: Optional[Callable[[tuple, Any], None]] = None) -> Dict:
+    """Async twin of ingredients_from_image (same prompt, passes and output)."""
+    client = make_client(project or "", location)
+    deadline = deadline_for("ing_quant")
+    parts = _build_parts(await aprepare_image_parts(client, image_paths), dish_hint, ing_hint)
+
+    cfg1 = _pass1_cfg()
+    if on_partial:
+        raw1 = await astream_json(client, model, parts, cfg1, on_partial, "ing_quant", deadline, timings, usage=usage)
+    else:
+        raw1 = await agenerate_text(client, model, parts, cfg1, "ing_quant", deadline, timings, usage=usage)
+    data = first_json_block(raw1)
+    raw2 = ""
+    second = not _ok(data) and cfg1 is _CFG_FREE
+    if second:
+        raw2 = await agenerate_text(client, model, parts, _CFG_SCHEMA, "ing_quant", deadline, timings, usage=usage)
+        data = first_json_block(raw2) or {}
+    record_passes("ing_quant", model, 2 if second else 1, timings)
+    return _finish(data, raw1, raw2)
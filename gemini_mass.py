@@ -1,7 +1,8 @@
 # gemini_mass.py
 from typing import Dict, Optional, List
 from google.genai import types
-from gemini_client import make_client, prepare_image_part, extract_text_from_response, first_json_block
+from gemini_client import make_client, prepare_image_part, generate_text, first_json_block
+from gemini_policy import deadline_for
 
 NEEDED = ["grams_low","grams_high","confidence"]
 
@@ -13,6 +14,7 @@ def mass_from_image(project: Optional[str], location: str, model: str,
     Returns dict with grams_low, grams_high, confidence, notes OR {"error":..., "raw":...}.
     """
     client = make_client(project or "", location)
+    deadline = deadline_for("mass")
     img_part = prepare_image_part(client, image_path)
 
     ingredient_hint = ", ".join(ingredients or [])
@@ -35,12 +37,8 @@ def mass_from_image(project: Optional[str], location: str, model: str,
         max_output_tokens=1024,
         thinking_config=types.ThinkingConfig(thinking_budget=128),
     )
-    resp1 = client.models.generate_content(
-        model=model,
-        contents=[types.Content(role="user", parts=[img_part, types.Part.from_text(text=prompt)])],
-        config=cfg1,
-    )
-    raw1 = extract_text_from_response(resp1) or getattr(resp1, "text", "")
+    parts = [img_part, types.Part.from_text(text=prompt)]
+    raw1 = generate_text(client, model, parts, cfg1, "mass", deadline)
     data = first_json_block(raw1)
 
     # Attempt 2: force schema JSON
@@ -62,12 +60,7 @@ def mass_from_image(project: Optional[str], location: str, model: str,
             max_output_tokens=2048,
             thinking_config=types.ThinkingConfig(thinking_budget=128),
         )
-        resp2 = client.models.generate_content(
-            model=model,
-            contents=[types.Content(role="user", parts=[img_part, types.Part.from_text(text=prompt)])],
-            config=cfg2,
-        )
-        raw2 = extract_text_from_response(resp2) or getattr(resp2, "text", "")
+        raw2 = generate_text(client, model, parts, cfg2, "mass", deadline)
         data = first_json_block(raw2) or {}
         if any(k not in data for k in NEEDED):
             return {"error": "mass_estimate_failed", "raw": raw2 or raw1}
@@ -0,0 +1,290 @@
+# gemini_policy.py
+import os, time, random, asyncio, threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+import httpx
+from google.genai import errors
+
+from cancellation import CancelToken, current_token, count as count_cancel
+
+# Shared call policy for generate_content: per-stage deadline, jittered exponential
+# backoff on retryable errors, a hedged duplicate once a call runs past the observed
+# p95 for (stage, model), and a per-model circuit breaker. Every decision is counted
+# into the caller's `timings` dict as '<stage>_<what>'. A cancelled token (see
+# cancellation.py) stops retries and releases the caller right away.
+
+DEFAULT_DEADLINE_S = float(os.getenv("GEMINI_DEADLINE_S", "45"))
+STAGE_DEADLINE_S = {
+    "recognize": float(os.getenv("GEMINI_DEADLINE_RECOGNIZE_S", DEFAULT_DEADLINE_S)),
+    "ing_quant": float(os.getenv("GEMINI_DEADLINE_ING_QUANT_S", DEFAULT_DEADLINE_S)),
+    "fused":     float(os.getenv("GEMINI_DEADLINE_FUSED_S", DEFAULT_DEADLINE_S)),
+    "calories":  float(os.getenv("GEMINI_DEADLINE_CALORIES_S", "30")),
+}
+MAX_RETRIES = int(os.getenv("GEMINI_MAX_RETRIES", "3"))
+BACKOFF_BASE_S = float(os.getenv("GEMINI_BACKOFF_BASE_S", "0.5"))
+BACKOFF_CAP_S = float(os.getenv("GEMINI_BACKOFF_CAP_S", "8"))
+HEDGE = os.getenv("GEMINI_HEDGE", "1") != "0"
+HEDGE_MIN_SAMPLES = int(os.getenv("GEMINI_HEDGE_MIN_SAMPLES", "20"))
+BREAKER_FAILS = int(os.getenv("GEMINI_BREAKER_FAILS", "5"))
+BREAKER_COOLDOWN_S = float(os.getenv("GEMINI_BREAKER_COOLDOWN_S", "30"))
+
+RETRYABLE_CODES = {408, 429, 500, 502, 503, 504}
+
+_CALL_POOL = ThreadPoolExecutor(max_workers=int(os.getenv("GEMINI_CALL_WORKERS", "32")),
+                                thread_name_prefix="gemini-call")
+_LOCK = threading.Lock()
+_LATENCY: Dict[Tuple[str, str], deque] = {}          # (stage, model) -> recent successful call ms
+_BREAKERS: Dict[str, Dict[str, float]] = {}           # model -> {fails, open_until}
+_COUNTERS: Dict[str, int] = {"calls": 0, "retries": 0, "hedges": 0, "hedge_wins": 0,
+                             "deadline_exceeded": 0, "breaker_rejects": 0, "breaker_trips": 0}
+
+class CircuitOpenError(RuntimeError):
+    pass
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+def deadline_for(stage: str) -> float:
+    """Absolute perf_counter deadline for a stage (shared by all of its passes)."""
+    return time.perf_counter() + STAGE_DEADLINE_S.get(stage, DEFAULT_DEADLINE_S)
+
+def is_retryable(e: BaseException) -> bool:
+    if isinstance(e, errors.APIError):
+        return getattr(e, "code", None) in RETRYABLE_CODES
+    return isinstance(e, (httpx.TimeoutException, httpx.TransportError))
+
+def _bump(timings: Optional[Dict[str, float]], key: str, by: float = 1.0):
+    if timings is not None:
+        timings[key] = round(timings.get(key, 0.0) + by, 2)
+
+def _count(key: str):
+    with _LOCK:
+        _COUNTERS[key] += 1
+
+# ---------- latency profile ----------
+def _record_latency(stage: str, model: str, ms: float):
+    with _LOCK:
+        _LATENCY.setdefault((stage, model), deque(maxlen=200)).append(ms)
+
+def hedge_after_s(stage: str, model: str) -> Optional[float]:
+    """Observed p95 in seconds, or None while there are too few samples to trust it."""
+    if not HEDGE:
+        return None
+    with _LOCK:
+        xs = sorted(_LATENCY.get((stage, model), ()))
+    if len(xs) < HEDGE_MIN_SAMPLES:
+        return None
+    return xs[min(len(xs) - 1, int(0.95 * len(xs)))] / 1000.0
+
+# ---------- circuit breaker ----------
+def _breaker_admit(model: str) -> bool:
+    with _LOCK:
+        b = _BREAKERS.setdefault(model, {"fails": 0, "open_until": 0.0})
+        if b["open_until"] == 0.0:
+            return True
+        if time.time() >= b["open_until"]:
+            b["open_until"] = time.time() + BREAKER_COOLDOWN_S   # half-open: admit one probe
+            return True
+        _COUNTERS["breaker_rejects"] += 1
+        return False
+
+def _breaker_result(model: str, ok: bool):
+    with _LOCK:
+        b = _BREAKERS.setdefault(model, {"fails": 0, "open_until": 0.0})
+        if ok:
+            b["fails"], b["open_until"] = 0, 0.0
+            return
+        b["fails"] += 1
+        if b["fails"] >= BREAKER_FAILS and b["open_until"] == 0.0:
+            _COUNTERS["breaker_trips"] += 1
+            print(f"[policy] ⚡ circuit open for {model} after {int(b['fails'])} failures")
+        if b["fails"] >= BREAKER_FAILS:
+            b["open_until"] = time.time() + BREAKER_COOLDOWN_S
+
+def _backoff_s(attempt: int) -> float:
+    return random.uniform(0, min(BACKOFF_CAP_S, BACKOFF_BASE_S * (2 ** attempt)))
+
+def _check_admit(stage: str, model: str, timings):
+    if not _breaker_admit(model):
+        _bump(timings, f"{stage}_breaker_open")
+        raise CircuitOpenError(f"circuit open for {model}; skipping {stage}")
+
+def _on_deadline(stage: str, model: str, timings):
+    # a hung backend is the failure the breaker is for: without this it only ever sees
+    # retryable errors, while every timed-out call keeps a _CALL_POOL thread busy
+    _breaker_result(model, ok=False)
+    _count("deadline_exceeded")
+    _bump(timings, f"{stage}_deadline_exceeded")
+    return DeadlineExceeded(f"{stage} deadline exceeded")
+
+def _check_cancel(tok: Optional[CancelToken], stage: str, timings):
+    if tok is not None and tok.cancelled:
+        count_cancel("calls_skipped")
+        _bump(timings, f"{stage}_cancelled")
+        tok.check(stage)
+
+def _retry_delay(e: BaseException, stage: str, model: str, attempt: int, deadline: float, timings) -> Optional[float]:
+    """Seconds to back off before the next attempt, or None to give up and re-raise."""
+    if not is_retryable(e):
+        return None
+    _breaker_result(model, ok=False)
+    if attempt >= MAX_RETRIES:
+        return None
+    delay = min(_backoff_s(attempt), max(0.0, deadline - time.perf_counter()))
+    if delay <= 0:
+        return None
+    _count("retries")
+    _bump(timings, f"{stage}_retries")
+    _bump(timings, f"{stage}_backoff_ms", delay * 1000.0)
+    print(f"[policy] ↻ {stage}/{model} retry {attempt + 1} in {delay*1000:.0f} ms ({e})")
+    return delay
+
+def call_with_policy(stage: str, model: str, fn: Callable[[], Any],
+                     deadline: Optional[float] = None, timings: Optional[Dict[str, float]] = None,
+                     hedge: bool = True, interruptible: bool = False) -> Any:
+    """
+    Run blocking `fn` under the policy. Losing hedge calls finish in the background.
+    hedge=False for calls with side effects while running (streams feeding SSE events).
+    interruptible=True when `fn` watches the cancel token itself (streams stop reading).
+    """
+    deadline = deadline or deadline_for(stage)
+    tok = current_token()
+    attempt = 0
+    while True:
+        _check_cancel(tok, stage, timings)
+        _check_admit(stage, model, timings)
+        _count("calls")
+        t0 = time.perf_counter()
+        primary = _CALL_POOL.submit(fn)
+        pending = {primary}
+        cancel_f = tok.future() if tok is not None else None
+        hedge_s = hedge_after_s(stage, model) if hedge else None
+        hedged = False
+        err: Optional[BaseException] = None
+        result, won = None, None
+        while pending:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                raise _on_deadline(stage, model, timings)
+            wait_s = remaining
+            if not hedged and hedge_s is not None:
+                wait_s = min(remaining, max(0.0, t0 + hedge_s - time.perf_counter()))
+            done, pending = wait(pending | ({cancel_f} if cancel_f else set()), timeout=wait_s,
+                                 return_when=FIRST_COMPLETED)
+            if cancel_f is not None:
+                pending.discard(cancel_f)
+                if cancel_f in done:
+                    # a blocking call can't be interrupted: leave it to finish unread
+                    if pending and not interruptible:
+                        count_cancel("calls_abandoned")
+                    _bump(timings, f"{stage}_cancelled")
+                    tok.check(stage)
+            for f in done:
+                if f.exception() is None:
+                    result, won = f.result(), f
+                    break
+                err = f.exception()
+            if won is not None:
+                break
+            if not done and not hedged and hedge_s is not None and time.perf_counter() < deadline:
+                hedged = True
+                pending.add(_CALL_POOL.submit(fn))
+                _count("hedges")
+                _bump(timings, f"{stage}_hedges")
+        if won is not None:
+            if hedged and won is not primary:
+                _count("hedge_wins")
+                _bump(timings, f"{stage}_hedge_wins")
+            _record_latency(stage, model, (time.perf_counter() - t0) * 1000.0)
+            _breaker_result(model, ok=True)
+            return result
+        delay = _retry_delay(err, stage, model, attempt, deadline, timings)
+        if delay is None:
+            raise err
+        if tok is not None:
+            tok.wait(delay)
+        else:
+            time.sleep(delay)
+        attempt += 1
+
+async def acall_with_policy(stage: str, model: str, afn: Callable[[], Awaitable[Any]],
+                            deadline: Optional[float] = None, timings: Optional[Dict[str, float]] = None,
+                            hedge: bool = True) -> Any:
+    """Async twin of call_with_policy; losing hedge tasks are cancelled."""
+    deadline = deadline or deadline_for(stage)
+    tok = current_token()
+    attempt = 0
+    while True:
+        _check_cancel(tok, stage, timings)
+        _check_admit(stage, model, timings)
+        _count("calls")
+        t0 = time.perf_counter()
+        primary = asyncio.ensure_future(afn())
+        pending = {primary}
+        cancel_f = asyncio.wrap_future(tok.future()) if tok is not None else None
+        hedge_s = hedge_after_s(stage, model) if hedge else None
+        hedged = False
+        err: Optional[BaseException] = None
+        result, won = None, None
+        try:
+            while pending:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    raise _on_deadline(stage, model, timings)
+                wait_s = remaining
+                if not hedged and hedge_s is not None:
+                    wait_s = min(remaining, max(0.0, t0 + hedge_s - time.perf_counter()))
+                done, pending = await asyncio.wait(pending | ({cancel_f} if cancel_f else set()), timeout=wait_s,
+                                                   return_when=asyncio.FIRST_COMPLETED)
+                if cancel_f is not None:
+                    pending.discard(cancel_f)
+                    if cancel_f in done:
+                        # pending tasks are cancelled below, which aborts their requests
+                        count_cancel("async_calls_aborted", len(pending))
+                        _bump(timings, f"{stage}_cancelled")
+                        tok.check(stage)
+                for f in done:
+                    if f.exception() is None:
+                        result, won = f.result(), f
+                        break
+                    err = f.exception()
+                if won is not None:
+                    break
+                if not done and not hedged and hedge_s is not None:
+                    hedged = True
+                    pending.add(asyncio.ensure_future(afn()))
+                    _count("hedges")
+                    _bump(timings, f"{stage}_hedges")
+        finally:
+            for f in pending:
+                f.cancel()
+            if cancel_f is not None and not cancel_f.done():
+                cancel_f.cancel()
+        if won is not None:
+            if hedged and won is not primary:
+                _count("hedge_wins")
+                _bump(timings, f"{stage}_hedge_wins")
+            _record_latency(stage, model, (time.perf_counter() - t0) * 1000.0)
+            _breaker_result(model, ok=True)
+            return result
+        delay = _retry_delay(err, stage, model, attempt, deadline, timings)
+        if delay is None:
+            raise err
+        await asyncio.sleep(delay)
+        attempt += 1
+
+def call_policy_stats() -> Dict:
+    with _LOCK:
+        lat = {}
+        for (stage, model), xs in _LATENCY.items():
+            s = sorted(xs)
+            lat[f"{stage}/{model}"] = {
+                "n": len(s),
+                "p50_ms": round(s[len(s) // 2], 1),
+                "p95_ms": round(s[min(len(s) - 1, int(0.95 * len(s)))], 1),
+            }
+        now = time.time()
+        breakers = {m: {"fails": int(b["fails"]), "open": b["open_until"] > now} for m, b in _BREAKERS.items()}
+        return {**_COUNTERS, "latency": lat, "breakers": breakers}
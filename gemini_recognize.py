@@ -1,7 +1,10 @@
 # gemini_recognize.py
-from typing import Dict, List
+from typing import Any, Callable, Dict, List, Optional
 from google.genai import types
-from gemini_client import make_client, prepare_image_parts, extract_text_from_response, first_json_block, recognize_schema
+from gemini_client import (make_client, prepare_image_parts, aprepare_image_parts, generate_text, agenerate_text,
+                           stream_json, astream_json, first_json_block, recognize_schema, json_mode, record_passes)
+from gemini_policy import deadline_for
+import llm_cache
 
 UTENSIL_SCALE = (
     "If a standard fork or spoon is visible, use it as a scale reference:\n"
@@ -11,57 +14,100 @@ UTENSIL_SCALE = (
     "If multiple angles are provided, reconcile them and infer a single best description.\n"
 )
 
-def gemini_recognize_dish(project: str, location: str, model: str, image_paths: List[str]) -> Dict:
-    client = make_client(project, location)
-    img_parts = prepare_image_parts(client, image_paths)
-    sys_prompt = (
-        "You are a precise food recognizer. Return STRICT JSON ONLY:\n"
-        "{"
-        "\"dish\":\"<short canonical dish>\","
-        "\"ingredients\":[\"<3-12 likely ingredients, lowercase; include typical cooking fats/oils if implied (e.g., sesame oil for fried rice, olive oil for sautéed veg)>\"],"
-        "\"container\":\"plate|bowl|tray|cup|none\","
-        "\"confidence\":<0..1>"
-        "}\n\n"
-        + UTENSIL_SCALE
-    )
+SYS_PROMPT = (
+    "You are a precise food recognizer. Return STRICT JSON ONLY:\n"
+    "{"
+    "\"dish\":\"<short canonical dish>\","
+    "\"ingredients\":[\"<3-12 likely ingredients, lowercase; include typical cooking fats/oils if implied (e.g., sesame oil for fried rice, olive oil for sautéed veg)>\"],"
+    "\"container\":\"plate|bowl|tray|cup|none\","
+    "\"confidence\":<0..1>"
+    "}\n\n"
+    + UTENSIL_SCALE
+)
 
-    # Attempt 1: plain (no tools), free-form JSON
-    cfg1 = types.GenerateContentConfig(
-        temperature=0.2,
-        max_output_tokens=512,
-        thinking_config=types.ThinkingConfig(thinking_budget=128),
-    )
-    parts = [types.Part.from_text(text=sys_prompt)] + img_parts
-    resp1 = client.models.generate_content(
-        model=model,
-        contents=[types.Content(role="user", parts=parts)],
-        config=cfg1
-    )
-    raw1 = extract_text_from_response(resp1) or getattr(resp1, "text", "")
-    data = first_json_block(raw1)
+# Built once at import; reused by every call.
+_SCHEMA = recognize_schema()
 
-    # Attempt 2: structured JSON with schema
-    if not data or "dish" not in data:
-        cfg2 = types.GenerateContentConfig(
-            temperature=0.1,
-            response_mime_type="application/json",
-            response_schema=recognize_schema(),
-            max_output_tokens=1024,
-            thinking_config=types.ThinkingConfig(thinking_budget=128),
-        )
-        resp2 = client.models.generate_content(
-            model=model,
-            contents=[types.Content(role="user", parts=parts)],
-            config=cfg2
-        )
-        raw2 = extract_text_from_response(resp2) or getattr(resp2, "text", "")
-        data = first_json_block(raw2)
+# Attempt 1: plain (no tools), free-form JSON
+_CFG_FREE = types.GenerateContentConfig(
+    temperature=0.2,
+    max_output_tokens=512,
+    thinking_config=types.ThinkingConfig(thinking_budget=128),
+)
 
-        if not data or "dish" not in data:
-            return {"error": "recognition_failed", "raw": raw1 or raw2}
+# Attempt 2: structured JSON with schema
+_CFG_SCHEMA = types.GenerateContentConfig(
+    temperature=0.1,
+    response_mime_type="application/json",
+    response_schema=_SCHEMA,
+    max_output_tokens=1024,
+    thinking_config=types.ThinkingConfig(thinking_budget=128),
+)
+
+def _pass1_cfg() -> types.GenerateContentConfig:
+    return _CFG_SCHEMA if json_mode("recognize") == "schema" else _CFG_FREE
+
+def _ok(data: Dict) -> bool:
+    return bool(data) and "dish" in data
 
+def _finish(data: Dict, raw: str) -> Dict:
+    if not _ok(data):
+        return {"error": "recognition_failed", "raw": raw}
     data["dish"] = (data.get("dish") or "").lower().strip()
     data["ingredients"] = [str(x).lower().strip() for x in (data.get("ingredients") or [])][:12]
     data["container"] = (data.get("container") or "none").lower().strip()
     data["confidence"] = float(data.get("confidence", 0.0))
     return data
+
+def _cache_key(a: Dict) -> str:
+    return llm_cache.make_key("recognize", a["model"], SYS_PROMPT, a["image_paths"], [_pass1_cfg(), _CFG_SCHEMA])
+
+@llm_cache.cached_stage("recognize", _cache_key)
+def gemini_recognize_dish(project: str, location: str, model: str, image_paths: List[str],
+                          timings: Optional[Dict[str, float]] = None,
+                          usage: Optional[List[Dict]] = None,
+                          on_partial: Optional[Callable[[tuple, Any], None]] = None) -> Dict:
+    """
+    on_partial(path, value) streams pass 1 and fires as values close,
+    e.g. (("dish",), "fried rice") or (("ingredients", 2), "egg").
+    """
+    client = make_client(project, location)
+    deadline = deadline_for("recognize")
+    parts = [types.Part.from_text(text=SYS_PROMPT)] + prepare_image_parts(client, image_paths)
+
+    cfg1 = _pass1_cfg()
+    if on_partial:
+        raw1 = stream_json(client, model, parts, cfg1, on_partial, "recognize", deadline, timings, usage=usage)
+    else:
+        raw1 = generate_text(client, model, parts, cfg1, "recognize", deadline, timings, usage=usage)
+    data = first_json_block(raw1)
+    raw2 = ""
+    second = not _ok(data) and cfg1 is _CFG_FREE
+    if second:
+        raw2 = generate_text(client, model, parts, _CFG_SCHEMA, "recognize", deadline, timings, usage=usage)
+        data = first_json_block(raw2)
+    record_passes("recognize", model, 2 if second else 1, timings)
+    return _finish(data, raw1 or raw2)
+
+@llm_cache.cached_stage("recognize", _cache_key)
+async def gemini_recognize_dish_async(project: str, location: str, model: str, image_paths: List[str],
+                                      timings: Optional[Dict[str, float]] = None,
+                                      usage: Optional[List[Dict]] = None,
+                                      on_partial: Optional[Callable[[tuple, Any], None]] = None) -> Dict:
+    client = make_client(project, location)
+    deadline = deadline_for("recognize")
+    parts = [types.Part.from_text(text=SYS_PROMPT)] + await aprepare_image_parts(client, image_paths)
+
+    cfg1 = _pass1_cfg()
+    if on_partial:
+        raw1 = await astream_json(client, model, parts, cfg1, on_partial, "recognize", deadline, timings, usage=usage)
+    else:
+        raw1 = await agenerate_text(client, model, parts, cfg1, "recognize", deadline, timings, usage=usage)
+    data = first_json_block(raw1)
+    raw2 = ""
+    second = not _ok(data) and cfg1 is _CFG_FREE
+    if second:
+        raw2 = await agenerate_text(client, model, parts, _CFG_SCHEMA, "recognize", deadline, timings, usage=usage)
+        data = first_json_block(raw2)
+    record_passes("recognize", model, 2 if second else 1, timings)
+    return _finish(data, raw1 or raw2)
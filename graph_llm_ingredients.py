@@ -1,17 +1,25 @@
 # graph_llm_ingredients.py
-from typing import TypedDict, Optional, Dict, Any, List
+from typing import TypedDict, Optional, Dict, Any, List, Tuple, Callable
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from langgraph.graph import StateGraph, END
-import time
+import os, re, time, asyncio, threading
 
-from gemini_recognize import gemini_recognize_dish
-from gemini_ingredients import ingredients_from_image
-from gemini_calories import calories_from_ingredients
+from gemini_recognize import gemini_recognize_dish, gemini_recognize_dish_async
+from gemini_ingredients import ingredients_from_image, ingredients_from_image_async
+from calorie_engine import estimate_calories, estimate_calories_async
+from gemini_fused import recognize_and_quantify, recognize_and_quantify_async, split_fused
+from gemini_client import summarize_usage
+from gemini_cascade import cascaded, acascaded
+from cancellation import in_context
 
 class S(TypedDict):
     image_paths: List[str]
     project: Optional[str]
     location: str
     model: str
+    use_cache: bool
+    variant: str
 
     dish: str
     ingredients: List[str]
@@ -31,6 +39,7 @@ class S(TypedDict):
     kcal_notes: Optional[str]
 
     timings: Dict[str, float]   # per-node ms
+    usage: List[Dict[str, Any]]  # per-pass token usage (see gemini_client.record_usage)
     total_ms: Optional[float]   # pipeline ms
 
     debug: Dict[str, Any]
@@ -39,9 +48,8 @@ class S(TypedDict):
 def _ms(t0: float) -> float:
     return round((time.perf_counter() - t0) * 1000.0, 2)
 
-def node_recognize(state: S) -> S:
-    t0 = time.perf_counter()
-    data = gemini_recognize_dish(state["project"], state["location"], state["model"], state["image_paths"])
+# Each stage = call + _apply_* (state update + log line). Sync and async nodes share _apply_*.
+def _apply_recognize(state: S, data: Dict, t0: float) -> S:
     state["timings"]["recognize_ms"] = _ms(t0)
 
     if "error" in data:
@@ -61,12 +69,7 @@ def node_recognize(state: S) -> S:
           f"took {state['timings']['recognize_ms']} ms")
     return state
 
-def node_ing_quant(state: S) -> S:
-    t0 = time.perf_counter()
-    res = ingredients_from_image(
-        state["project"], state["location"], state["model"], state["image_paths"],
-        dish_hint=state.get("dish",""), ing_hint=state.get("ingredients", [])
-    )
+def _apply_ing_quant(state: S, res: Dict, t0: float) -> S:
     state["timings"]["ing_quant_ms"] = _ms(t0)
 
     if "error" in res:
@@ -89,18 +92,31 @@ def node_ing_quant(state: S) -> S:
           f"took {state['timings']['ing_quant_ms']} ms")
     return state
 
-def node_calories(state: S) -> S:
-    t0 = time.perf_counter()
-    if not state.get("items"):
-        state["error"] = "No ingredient items."
-        state["timings"]["calories_ms"] = _ms(t0)
-        print(f"[calories] ❌ no items  in {state['timings']['calories_ms']} ms")
+def _apply_fused(state: S, res: Dict, t0: float) -> S:
+    if "error" in res:
+        state["timings"]["fused_ms"] = _ms(t0)
+        state["error"] = f"fused_failed: {res['error']}"
+        state["debug"]["fused_raw"] = res.get("raw")
+        print(f"[fused] ❌ error in {state['timings']['fused_ms']} ms")
         return state
+    rec, ing = split_fused(res)
+    _apply_recognize(state, rec, t0)
+    _apply_ing_quant(state, ing, t0)
+    # one call: report it once instead of as two overlapping stage times
+    state["timings"].pop("recognize_ms", None)
+    state["timings"].pop("ing_quant_ms", None)
+    state["timings"]["fused_ms"] = _ms(t0)
+    return state
 
-    res = calories_from_ingredients(
-        state["project"], state["location"], state["model"],
-        state.get("dish",""), state["items"]
-    )
+def _no_items(state: S, t0: float) -> bool:
+    if state.get("items"):
+        return False
+    state["error"] = "No ingredient items."
+    state["timings"]["calories_ms"] = _ms(t0)
+    print(f"[calories] ❌ no items  in {state['timings']['calories_ms']} ms")
+    return True
+
+def _apply_calories(state: S, res: Dict, t0: float) -> S:
     state["timings"]["calories_ms"] = _ms(t0)
 
     if "error" in res:
@@ -122,41 +138,397 @@ def node_calories(state: S) -> S:
           f"conf={state['kcal_conf']:.2f}  took {state['timings']['calories_ms']} ms")
     return state
 
-def build_graph():
+def node_recognize(state: S) -> S:
+    t0 = time.perf_counter()
+    data = cascaded("recognize", state["model"], lambda m: gemini_recognize_dish(
+        state["project"], state["location"], m, state["image_paths"],
+        timings=state["timings"], usage=state["usage"], use_cache=state["use_cache"]), state["timings"])
+    return _apply_recognize(state, data, t0)
+
+def node_ing_quant(state: S) -> S:
+    t0 = time.perf_counter()
+    res = cascaded("ing_quant", state["model"], lambda m: ingredients_from_image(
+        state["project"], state["location"], m, state["image_paths"],
+        dish_hint=state.get("dish",""), ing_hint=state.get("ingredients", []),
+        timings=state["timings"], usage=state["usage"], use_cache=state["use_cache"]
+    ), state["timings"])
+    return _apply_ing_quant(state, res, t0)
+
+def node_fused(state: S) -> S:
+    t0 = time.perf_counter()
+    res = cascaded("fused", state["model"], lambda m: recognize_and_quantify(
+        state["project"], state["location"], m, state["image_paths"],
+        timings=state["timings"], usage=state["usage"], use_cache=state["use_cache"]), state["timings"])
+    return _apply_fused(state, res, t0)
+
+def node_calories(state: S) -> S:
+    t0 = time.perf_counter()
+    if _no_items(state, t0):
+        return state
+    res = estimate_calories(
+        state["project"], state["location"], state["model"],
+        state.get("dish",""), state["items"],
+        timings=state["timings"], usage=state["usage"], use_cache=state["use_cache"]
+    )
+    return _apply_calories(state, res, t0)
+
+async def anode_recognize(state: S) -> S:
+    t0 = time.perf_counter()
+    data = await acascaded("recognize", state["model"], lambda m: gemini_recognize_dish_async(
+        state["project"], state["location"], m, state["image_paths"],
+        timings=state["timings"], usage=state["usage"], use_cache=state["use_cache"]), state["timings"])
+    return _apply_recognize(state, data, t0)
+
+async def anode_ing_quant(state: S) -> S:
+    t0 = time.perf_counter()
+    res = await acascaded("ing_quant", state["model"], lambda m: ingredients_from_image_async(
+        state["project"], state["location"], m, state["image_paths"],
+        dish_hint=state.get("dish",""), ing_hint=state.get("ingredients", []),
+        timings=state["timings"], usage=state["usage"], use_cache=state["use_cache"]
+    ), state["timings"])
+    return _apply_ing_quant(state, res, t0)
+
+async def anode_fused(state: S) -> S:
+    t0 = time.perf_counter()
+    res = await acascaded("fused", state["model"], lambda m: recognize_and_quantify_async(
+        state["project"], state["location"], m, state["image_paths"],
+        timings=state["timings"], usage=state["usage"], use_cache=state["use_cache"]), state["timings"])
+    return _apply_fused(state, res, t0)
+
+async def anode_calories(state: S) -> S:
+    t0 = time.perf_counter()
+    if _no_items(state, t0):
+        return state
+    res = await estimate_calories_async(
+        state["project"], state["location"], state["model"],
+        state.get("dish",""), state["items"],
+        timings=state["timings"], usage=state["usage"], use_cache=state["use_cache"]
+    )
+    return _apply_calories(state, res, t0)
+
+# ---------- Speculative recognize ‖ ing_quant ----------
+# Start the unhinted ingredients call alongside recognize instead of after it. When
+# recognize lands, keep the speculative grams if enough of the recognized ingredients
+# show up among the quantified items (SPEC_MIN_AGREEMENT); otherwise re-run only the
+# quantification with the usual hints. Saved time is judged against the sequential path.
+SPEC_MIN_AGREEMENT = float(os.getenv("SPEC_MIN_AGREEMENT", "0.6"))
+_SPEC_POOL = ThreadPoolExecutor(max_workers=int(os.getenv("SPEC_WORKERS", "16")), thread_name_prefix="speculate")
+_SPEC_LOCK = threading.Lock()
+_SPEC_STATS = {"runs": 0, "hits": 0, "misses": 0, "spec_errors": 0, "saved_ms_total": 0.0, "agreement_total": 0.0}
+_FILLER = {"cooked", "fried", "grilled", "steamed", "boiled", "raw", "fresh", "sliced", "chopped", "and", "with", "of"}
+
+def _tokens(name: str) -> set:
+    return {w.rstrip("s") for w in re.findall(r"[a-z]+", (name or "").lower()) if w not in _FILLER}
+
+def spec_agreement(ingredients: List[str], items: List[Dict[str, Any]]) -> float:
+    """Share of recognized ingredients that some quantified item names (word overlap)."""
+    if not ingredients:
+        return 1.0 if items else 0.0
+    item_tokens = [_tokens(it.get("name", "")) for it in items]
+    matched = sum(1 for ing in ingredients if any(_tokens(ing) & t for t in item_tokens))
+    return round(matched / len(ingredients), 3)
+
+def _spec_decide(rec: Dict, spec: Optional[Dict]) -> Tuple[bool, float]:
+    if not spec or "error" in spec:
+        return False, 0.0
+    agreement = spec_agreement(rec.get("ingredients") or [], spec.get("items") or [])
+    return agreement >= SPEC_MIN_AGREEMENT, agreement
+
+def _spec_finish(rec: Dict, spec: Optional[Dict], hit: bool, agreement: float,
+                 rec_ms: float, ing_ms: float, t0: float) -> Dict[str, float]:
+    wall = _ms(t0)
+    saved = round(rec_ms + ing_ms - wall, 2)   # vs recognize then ing_quant back to back
+    with _SPEC_LOCK:
+        _SPEC_STATS["runs"] += 1
+        _SPEC_STATS["hits" if hit else "misses"] += 1
+        _SPEC_STATS["spec_errors"] += 1 if (not spec or "error" in spec) else 0
+        _SPEC_STATS["saved_ms_total"] = round(_SPEC_STATS["saved_ms_total"] + saved, 2)
+        _SPEC_STATS["agreement_total"] = round(_SPEC_STATS["agreement_total"] + agreement, 3)
+    print(f"[speculate] {'✅ hit' if hit else '↻ miss'}  agreement={agreement:.2f}  "
+          f"saved {saved} ms  (recognize {rec_ms} ms, ing_quant {ing_ms} ms, wall {wall} ms)")
+    return {"recognize_ms": rec_ms, "ing_quant_ms": ing_ms, "speculate_ms": wall,
+            "spec_hit": 1.0 if hit else 0.0, "spec_agreement": agreement, "spec_saved_ms": saved}
+
+def run_speculative_stage(project: Optional[str], location: str, model: str, image_paths: List[str],
+                          timings: Dict[str, float], usage: List[Dict], use_cache: bool = True,
+                          on_recognize_partial: Optional[Callable] = None,
+                          on_ing_partial: Optional[Callable] = None) -> Tuple[Dict, Dict, Dict[str, float]]:
+    """
+    Returns (recognize result, ing_quant result, spec timings). on_ing_partial only
+    streams a re-run: speculative items may still be thrown away.
+    """
+    t0 = time.perf_counter()
+    def timed(stage, call):
+        t = time.perf_counter()
+        return cascaded(stage, model, call, timings), _ms(t)
+
+    # the speculative call records into its own timings/usage, merged only once this stage
+    # waits on it: after an early return it may still be running on _SPEC_POOL
+    spec_timings: Dict[str, float] = {}
+    spec_usage: List[Dict] = []
+    def speculate():
+        t = time.perf_counter()
+        return cascaded("ing_quant", model, lambda m: ingredients_from_image(
+            project, location, m, image_paths, dish_hint="", ing_hint=[],
+            timings=spec_timings, usage=spec_usage, use_cache=use_cache), spec_timings), _ms(t)
+
+    fut = _SPEC_POOL.submit(in_context(speculate))
+    rec, rec_ms = timed("recognize", lambda m: gemini_recognize_dish(
+        project, location, m, image_paths, timings=timings, usage=usage, use_cache=use_cache,
+        on_partial=on_recognize_partial))
+    if "error" in rec:
+        fut.cancel()   # no-op once started; its writes stay in spec_timings/spec_usage
+        return rec, {}, {"recognize_ms": rec_ms}
+    try:
+        spec, spec_ms = fut.result()
+    except Exception as e:
+        print(f"[speculate] speculative ing_quant failed: {e}")
+        spec, spec_ms = None, 0.0
+    timings.update(spec_timings)
+    usage.extend(spec_usage)
+    hit, agreement = _spec_decide(rec, spec)
+    if hit:
+        ing, ing_ms = spec, spec_ms
+    else:
+        ing, ing_ms = timed("ing_quant", lambda m: ingredients_from_image(
+            project, location, m, image_paths, dish_hint=rec.get("dish", ""), ing_hint=rec.get("ingredients", []),
+            timings=timings, usage=usage, use_cache=use_cache, on_partial=on_ing_partial))
+    return rec, ing, _spec_finish(rec, spec, hit, agreement, rec_ms, ing_ms, t0)
+
+async def run_speculative_stage_async(project: Optional[str], location: str, model: str, image_paths: List[str],
+                                      timings: Dict[str, float], usage: List[Dict],
+                                      use_cache: bool = True) -> Tuple[Dict, Dict, Dict[str, float]]:
+    t0 = time.perf_counter()
+    async def timed(stage, acall):
+        t = time.perf_counter()
+        return await acascaded(stage, model, acall, timings), _ms(t)
+
+    task = asyncio.ensure_future(timed("ing_quant", lambda m: ingredients_from_image_async(
+        project, location, m, image_paths, dish_hint="", ing_hint=[],
+        timings=timings, usage=usage, use_cache=use_cache)))
+    rec, rec_ms = await timed("recognize", lambda m: gemini_recognize_dish_async(
+        project, location, m, image_paths, timings=timings, usage=usage, use_cache=use_cache))
+    if "error" in rec:
+        task.cancel()
+        return rec, {}, {"recognize_ms": rec_ms}
+    try:
+        spec, spec_ms = await task
+    except Exception as e:
+        print(f"[speculate] speculative ing_quant failed: {e}")
+        spec, spec_ms = None, 0.0
+    hit, agreement = _spec_decide(rec, spec)
+    if hit:
+        ing, ing_ms = spec, spec_ms
+    else:
+        ing, ing_ms = await timed("ing_quant", lambda m: ingredients_from_image_async(
+            project, location, m, image_paths, dish_hint=rec.get("dish", ""),
+            ing_hint=rec.get("ingredients", []), timings=timings, usage=usage, use_cache=use_cache))
+    return rec, ing, _spec_finish(rec, spec, hit, agreement, rec_ms, ing_ms, t0)
+
+def speculation_stats() -> Dict:
+    with _SPEC_LOCK:
+        n = _SPEC_STATS["runs"]
+        return {
+            **_SPEC_STATS,
+            "hit_rate": round(_SPEC_STATS["hits"] / n, 4) if n else 0.0,
+            "avg_saved_ms": round(_SPEC_STATS["saved_ms_total"] / n, 2) if n else 0.0,
+            "avg_agreement": round(_SPEC_STATS["agreement_total"] / n, 3) if n else 0.0,
+            "min_agreement": SPEC_MIN_AGREEMENT,
+        }
+
+def _apply_speculate(state: S, rec: Dict, ing: Dict, spec_timings: Dict[str, float], t0: float) -> S:
+    _apply_recognize(state, rec, t0)
+    if "error" not in rec:
+        _apply_ing_quant(state, ing, t0)
+    state["timings"].update(spec_timings)   # real per-call times, not time-since-t0
+    return state
+
+def node_speculate(state: S) -> S:
+    t0 = time.perf_counter()
+    rec, ing, spec_timings = run_speculative_stage(state["project"], state["location"], state["model"],
+                                                   state["image_paths"], state["timings"], state["usage"],
+                                                   use_cache=state["use_cache"])
+    return _apply_speculate(state, rec, ing, spec_timings, t0)
+
+async def anode_speculate(state: S) -> S:
+    t0 = time.perf_counter()
+    rec, ing, spec_timings = await run_speculative_stage_async(state["project"], state["location"], state["model"],
+                                                               state["image_paths"], state["timings"], state["usage"],
+                                                               use_cache=state["use_cache"])
+    return _apply_speculate(state, rec, ing, spec_timings, t0)
+
+# ---------- Variant registry ----------
+# A variant is a linear chain of stages. Each one is compiled once per mode (sync/async)
+# and the compiled graph is shared by every request. Latency and cost are tracked per
+# variant so traffic can go to the cheapest one that is accurate enough.
+NODES: Dict[str, Tuple[Any, Any]] = {   # stage -> (sync node, async node)
+    "recognize": (node_recognize, anode_recognize),
+    "ing_quant": (node_ing_quant, anode_ing_quant),
+    "fused": (node_fused, anode_fused),
+    "speculate": (node_speculate, anode_speculate),
+    "calories": (node_calories, anode_calories),
+}
+VARIANTS: Dict[str, Tuple[str, ...]] = {
+    "full": ("recognize", "ing_quant", "calories"),
+    "recognize": ("recognize",),
+    "quantify": ("ing_quant",),    # grams only; optional dish/ingredients hints from the caller
+    "calories": ("calories",),     # kcal/macros for caller-supplied items [{name, grams}], no images
+    "fused": ("fused", "calories"),   # recognize + ing_quant in one multimodal call
+    "speculative": ("speculate", "calories"),   # recognize ‖ unhinted ing_quant, re-run on disagreement
+}
+IMAGE_STAGES = {"recognize", "ing_quant", "fused", "speculate"}
+INPUT_KEYS = ("dish", "ingredients", "items")
+
+_COMPILED: Dict[Tuple[str, bool], Any] = {}
+_VARIANT_LOCK = threading.Lock()
+_VARIANT_STATS: Dict[str, Dict[str, Any]] = {}
+
+def _compile(stages: Tuple[str, ...], nodes: Dict[str, Any]):
     g = StateGraph(S)
-    g.add_node("recognize", node_recognize)
-    g.add_node("ing_quant", node_ing_quant)
-    g.add_node("calories", node_calories)
-
-    g.set_entry_point("recognize")
-    g.add_edge("recognize", "ing_quant")
-    g.add_edge("ing_quant", "calories")
-    g.add_edge("calories", END)
+    for st in stages:
+        g.add_node(st, nodes[st])
+    g.set_entry_point(stages[0])
+    for a, b in zip(stages, stages[1:]):
+        g.add_edge(a, b)
+    g.add_edge(stages[-1], END)
     return g.compile()
 
-def run_pipeline(image_paths: List[str], project: Optional[str], location: str, model: str):
-    init: S = {
+def build_graph(nodes=(node_recognize, node_ing_quant, node_calories)):
+    return _compile(VARIANTS["full"], dict(zip(VARIANTS["full"], nodes)))
+
+def register_variant(name: str, stages: Tuple[str, ...], nodes: Optional[Dict[str, Tuple[Any, Any]]] = None):
+    """Add or replace a variant; `nodes` adds new stages as {stage: (sync_node, async_node)}."""
+    with _VARIANT_LOCK:
+        NODES.update(nodes or {})
+        VARIANTS[name] = tuple(stages)
+        for key in [k for k in _COMPILED if k[0] == name]:
+            del _COMPILED[key]
+
+def needs_images(variant: str) -> bool:
+    return any(st in IMAGE_STAGES for st in VARIANTS[variant])
+
+def get_graph(variant: str = "full", is_async: bool = False):
+    if variant not in VARIANTS:
+        raise ValueError(f"unknown variant '{variant}' (have: {', '.join(VARIANTS)})")
+    key = (variant, is_async)
+    graph = _COMPILED.get(key)
+    if graph is None:
+        with _VARIANT_LOCK:
+            graph = _COMPILED.get(key)
+            if graph is None:
+                stages = VARIANTS[variant]
+                graph = _compile(stages, {st: NODES[st][1 if is_async else 0] for st in stages})
+                _COMPILED[key] = graph
+    return graph
+
+def warm_variants() -> float:
+    """Compile every registered variant (sync + async) up front; returns ms spent."""
+    t0 = time.perf_counter()
+    for name in list(VARIANTS):
+        get_graph(name, False)
+        get_graph(name, True)
+    ms = _ms(t0)
+    print(f"[variants] compiled {len(VARIANTS)} variant(s) x2 in {ms} ms: {', '.join(VARIANTS)}")
+    return ms
+
+def record_variant(variant: str, total_ms: float, ok: bool, usage: Optional[List[Dict]] = None):
+    cost = summarize_usage(usage or [])["cost_usd"]
+    with _VARIANT_LOCK:
+        st = _VARIANT_STATS.setdefault(variant, {"runs": 0, "errors": 0, "cost_usd": 0.0, "ms": deque(maxlen=500)})
+        st["runs"] += 1
+        st["errors"] += 0 if ok else 1
+        st["cost_usd"] = round(st["cost_usd"] + cost, 6)
+        if ok:
+            st["ms"].append(total_ms)
+
+def variant_stats() -> Dict:
+    with _VARIANT_LOCK:
+        out = {}
+        for name, stages in VARIANTS.items():
+            st = _VARIANT_STATS.get(name, {"runs": 0, "errors": 0, "cost_usd": 0.0, "ms": ()})
+            xs = sorted(st["ms"])
+            out[name] = {
+                "stages": list(stages),
+                "compiled": sorted("async" if a else "sync" for (n, a) in _COMPILED if n == name),
+                "runs": st["runs"],
+                "errors": st["errors"],
+                "p50_ms": round(xs[len(xs) // 2], 1) if xs else None,
+                "p95_ms": round(xs[min(len(xs) - 1, int(0.95 * len(xs)))], 1) if xs else None,
+                "avg_cost_usd": round(st["cost_usd"] / st["runs"], 6) if st["runs"] else None,
+            }
+        return out
+
+def _init_state(image_paths: List[str], project: Optional[str], location: str, model: str,
+                use_cache: bool = True, variant: str = "full", inputs: Optional[Dict[str, Any]] = None) -> S:
+    state: S = {
         "image_paths": image_paths,
         "project": project,
         "location": location,
         "model": model,
+        "use_cache": use_cache,
+        "variant": variant,
         "dish": "", "ingredients": [], "gemini_conf": 0.0,
         "items": [], "total_grams": None, "ing_conf": None, "ing_notes": None,
         "nutr_items": [], "total_kcal": None, "total_protein_g": None, "total_carbs_g": None, "total_fat_g": None,
         "kcal_conf": None, "kcal_notes": None,
         "timings": {},
+        "usage": [],
         "total_ms": None,
         "debug": {}, "error": None
     }
+    # partial variants start from what the caller already knows
+    for k in INPUT_KEYS:
+        if (inputs or {}).get(k):
+            state[k] = inputs[k]
+    return state
+
+def _log_total(out: S):
+    stages = VARIANTS.get(out.get("variant") or "full", ())
+    per_stage = ", ".join(f"{st} {out['timings'].get(f'{st}_ms', '?')} ms" for st in stages)
+    print(f"[pipeline] ⏱ total {out['total_ms']} ms [{out.get('variant')}] ({per_stage})")
+
+def run_pipeline(image_paths: List[str], project: Optional[str], location: str, model: str,
+                 use_cache: bool = True, variant: str = "full", inputs: Optional[Dict[str, Any]] = None):
+    graph = get_graph(variant)
+    init = _init_state(image_paths, project, location, model, use_cache, variant, inputs)
 
     t0_total = time.perf_counter()
-    graph = build_graph()
     out = graph.invoke(init)
     out["total_ms"] = round((time.perf_counter() - t0_total) * 1000.0, 2)
+    record_variant(variant, out["total_ms"], not out.get("error"), out.get("usage"))
+    _log_total(out)
+    return out
 
-    print(f"[pipeline] ⏱ total {out['total_ms']} ms "
-          f"(recognize {out['timings'].get('recognize_ms','?')} ms, "
-          f"ing_quant {out['timings'].get('ing_quant_ms','?')} ms, "
-          f"calories {out['timings'].get('calories_ms','?')} ms)")
+async def run_pipeline_async(image_paths: List[str], project: Optional[str], location: str, model: str,
+                             use_cache: bool = True, variant: str = "full", inputs: Optional[Dict[str, Any]] = None):
+    """
+    Same graph with coroutine nodes (client.aio). Many pipelines can share one event loop,
+    so a single process holds many in-flight Gemini calls without a thread each.
+    """
+    graph = get_graph(variant, is_async=True)
+    init = _init_state(image_paths, project, location, model, use_cache, variant, inputs)
 
+    t0_total = time.perf_counter()
+    out = await graph.ainvoke(init)
+    out["total_ms"] = round((time.perf_counter() - t0_total) * 1000.0, 2)
+    record_variant(variant, out["total_ms"], not out.get("error"), out.get("usage"))
+    _log_total(out)
     return out
+
+async def run_image_stages_async(image_paths: List[str], project: Optional[str], location: str, model: str,
+                                 use_cache: bool = True, variant: str = "full") -> S:
+    """
+    The variant's stages up to 'calories' on the async nodes, for callers that price
+    calories themselves (meal_batch packs several meals into one calories call).
+    Finish with apply_calories().
+    """
+    state = _init_state(image_paths, project, location, model, use_cache, variant)
+    for st in VARIANTS[variant]:
+        if st == "calories" or state.get("error"):
+            break
+        state = await NODES[st][1](state)
+    return state
+
+def apply_calories(state: S, res: Dict, t0: float) -> S:
+    """Fold a calories result obtained outside the graph into the state, as node_calories would."""
+    return _apply_calories(state, res, t0)
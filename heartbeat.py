@@ -0,0 +1,87 @@
+# heartbeat.py
+import heapq, itertools, threading, time
+from collections import deque
+from typing import Any, Dict, List, Tuple
+
+# One timer thread serves the keepalives of every open stream. A stream registers its
+# inbox queue and gets `item` put on it every `interval` seconds until it unregisters;
+# the thread sleeps until the next beat is due, it never polls. Streams block on their
+# inbox, so stage completion, partial events and heartbeats all wake them the same way.
+# emit gaps = stage finished -> its stream woke up with the result (was up to 250 ms
+# with the old sleep(0.25) loop).
+
+class HeartbeatScheduler:
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._heap: List[Tuple[float, int]] = []          # (due, stream id)
+        self._subs: Dict[int, Tuple[Any, float, Any]] = {}  # id -> (inbox, interval, item)
+        self._ids = itertools.count(1)
+        self._thread = None
+        self.registered = 0
+        self.beats = 0
+
+    def register(self, inbox, interval: float, item: Any) -> int:
+        with self._cond:
+            sid = next(self._ids)
+            self._subs[sid] = (inbox, interval, item)
+            heapq.heappush(self._heap, (time.monotonic() + interval, sid))
+            self.registered += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True, name="heartbeats")
+                self._thread.start()
+            self._cond.notify()
+        return sid
+
+    def unregister(self, sid: int):
+        with self._cond:
+            self._subs.pop(sid, None)   # its heap entry is dropped when it comes up
+
+    def open_streams(self) -> int:
+        with self._cond:
+            return len(self._subs)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    while self._heap and self._heap[0][1] not in self._subs:
+                        heapq.heappop(self._heap)
+                    if not self._heap:
+                        self._cond.wait()
+                        continue
+                    due, sid = self._heap[0]
+                    delay = due - time.monotonic()
+                    if delay <= 0:
+                        break
+                    self._cond.wait(delay)
+                heapq.heappop(self._heap)
+                inbox, interval, item = self._subs[sid]
+                heapq.heappush(self._heap, (max(due + interval, time.monotonic()), sid))
+                self.beats += 1
+            inbox.put(item)
+
+HEARTBEATS = HeartbeatScheduler()
+
+_LOCK = threading.Lock()
+_GAPS: "deque[float]" = deque(maxlen=2000)
+_GAP_TOTAL = {"samples": 0, "ms_total": 0.0}
+
+def record_gap(ms: float):
+    with _LOCK:
+        _GAPS.append(ms)
+        _GAP_TOTAL["samples"] += 1
+        _GAP_TOTAL["ms_total"] += ms
+
+def _pct(xs: List[float], p: float):
+    return round(xs[min(len(xs) - 1, int(p * len(xs)))], 3) if xs else None
+
+def heartbeat_stats() -> Dict:
+    with _LOCK:
+        gaps = sorted(_GAPS)
+        n, total = _GAP_TOTAL["samples"], _GAP_TOTAL["ms_total"]
+    return {
+        "open_streams": HEARTBEATS.open_streams(), "registered": HEARTBEATS.registered, "beats": HEARTBEATS.beats,
+        "emit_gap_samples": n, "emit_gap_avg_ms": round(total / n, 3) if n else None,
+        "emit_gap_p50_ms": _pct(gaps, .5), "emit_gap_p95_ms": _pct(gaps, .95),
+        "emit_gap_max_ms": round(gaps[-1], 3) if gaps else None,
+    }
@@ -0,0 +1,362 @@
+# history_store.py
+import os, json, time, base64, sqlite3, threading
+from collections import deque
+from datetime import date, datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+# Index of analysis history. _persist_history still writes <image>.json next to the
+# upload; each record is also upserted here (summary columns + the full record), so
+# /history is an indexed range scan instead of listdir + sort-by-filename + parse-all.
+# Ordered by created_at (newest first) with a keyset cursor, so a page costs the same
+# at 1k or 500k records (kcal bounds filter that newest-first scan: an index on kcal
+# made SQLite sort the whole range instead). SQLite in WAL mode: every gunicorn worker
+# shares the file.
+# Existing <image>.json history in the upload dir is imported once, on first open.
+#
+# Rollups: per (period = day | week, user, period start) sums of meals / kcal / macros,
+# kept in the same transaction as each record write: a new record adds its numbers, a
+# re-analysis (same id) first takes the old ones out of their day/week, a delete takes
+# them out. Each write touches its user's day + week rows and the all-users ("*") ones:
+# O(1) per write, and /history/rollups reads one row per period whatever the number of
+# records or users. Days are UTC, weeks start on Monday. The table is built from the
+# records once, when it is first created.
+HISTORY_DB_PATH = os.path.abspath(os.getenv(
+    "HISTORY_DB_PATH", os.path.join(os.getenv("UPLOAD_DIR", "./uploads"), "history.sqlite")))
+PAGE_MAX = int(os.getenv("HISTORY_PAGE_MAX", "200"))
+ROLLUP_MAX_PERIODS = int(os.getenv("HISTORY_ROLLUP_MAX_PERIODS", "400"))
+PERIODS = ("day", "week")
+ALL_USERS = "*"
+
+# summary projection (/history default); `fields=` picks a subset, `full=1` adds the record
+SUMMARY_FIELDS = ("id", "dish", "dish_confidence", "total_kcal", "total_protein_g", "total_carbs_g",
+                  "total_fat_g", "created_at", "total_ms", "usage_total")
+_COLUMNS = {"dish": "dish", "dish_confidence": "dish_confidence", "total_kcal": "total_kcal",
+            "total_protein_g": "protein_g", "total_carbs_g": "carbs_g", "total_fat_g": "fat_g",
+            "total_ms": "total_ms"}
+
+_local = threading.local()
+_LOCK = threading.Lock()
+_STATS = {"writes": 0, "write_errors": 0, "deletes": 0, "queries": 0, "imported": 0,
+          "rollup_updates": 0, "rollup_queries": 0}
+_QUERY_MS: "deque[float]" = deque(maxlen=500)
+
+def _db() -> sqlite3.Connection:
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        os.makedirs(os.path.dirname(HISTORY_DB_PATH), exist_ok=True)
+        conn = sqlite3.connect(HISTORY_DB_PATH, timeout=5.0, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS records ("
+            " id TEXT PRIMARY KEY, created REAL, created_at TEXT, dish TEXT, dish_lc TEXT,"
+            " dish_confidence REAL, total_kcal REAL, protein_g REAL, carbs_g REAL, fat_g REAL,"
+            " total_ms REAL, usage_total TEXT, body TEXT, user TEXT NOT NULL DEFAULT '')"
+        )
+        if "user" not in [r[1] for r in conn.execute("PRAGMA table_info(records)")]:
+            conn.execute("ALTER TABLE records ADD COLUMN user TEXT NOT NULL DEFAULT ''")   # pre-rollup index
+        conn.execute("CREATE INDEX IF NOT EXISTS records_created ON records(created, id)")
+        conn.execute("CREATE INDEX IF NOT EXISTS records_dish ON records(dish_lc, created, id)")
+        conn.execute("CREATE INDEX IF NOT EXISTS records_user ON records(user, created, id)")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS rollups ("
+            " period TEXT, user TEXT, start TEXT, meals INTEGER, kcal REAL, protein_g REAL, carbs_g REAL,"
+            " fat_g REAL, PRIMARY KEY (period, user, start)) WITHOUT ROWID"
+        )
+        conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        _local.conn = conn
+        _import_dir(conn, os.path.dirname(HISTORY_DB_PATH))
+        _build_rollups(conn)
+    return conn
+
+def _num(v: Any) -> Optional[float]:
+    try:
+        return float(v) if v is not None else None
+    except (TypeError, ValueError):
+        return None
+
+def _epoch(created_at: Optional[str]) -> float:
+    # created_at is naive UTC isoformat (see app._persist_history)
+    if not created_at:
+        return time.time()
+    dt = datetime.fromisoformat(created_at)
+    return (dt if dt.tzinfo else dt.replace(tzinfo=timezone.utc)).timestamp()
+
+def _row(rec_id: str, rec: Dict[str, Any]) -> Tuple:
+    dish = rec.get("dish") or None
+    return (rec_id, _epoch(rec.get("created_at")), rec.get("created_at"), dish, (dish or "").lower().strip() or None,
+            _num(rec.get("dish_confidence")), _num(rec.get("total_kcal")), _num(rec.get("total_protein_g")),
+            _num(rec.get("total_carbs_g")), _num(rec.get("total_fat_g")), _num(rec.get("total_ms")),
+            json.dumps(rec.get("usage_total"), ensure_ascii=False) if rec.get("usage_total") is not None else None,
+            json.dumps(rec, ensure_ascii=False), str(rec.get("user") or "").replace(ALL_USERS, ""))
+
+_FIELDS = ("id", "created", "created_at", "dish", "dish_lc", "dish_confidence", "total_kcal", "protein_g",
+           "carbs_g", "fat_g", "total_ms", "usage_total", "body", "user")
+_VALUES = f"INTO records ({', '.join(_FIELDS)}) VALUES ({', '.join('?' * len(_FIELDS))})"
+_AGG = ("created", "user", "total_kcal", "protein_g", "carbs_g", "fat_g")   # what rollups sum
+
+def _period_starts(created: float) -> List[Tuple[str, str]]:
+    d = datetime.fromtimestamp(created, tz=timezone.utc).date()
+    return [("day", d.isoformat()), ("week", (d - timedelta(days=d.weekday())).isoformat())]
+
+def _rollup(conn: sqlite3.Connection, rec: Dict[str, Any], sign: int):
+    """Add (+1) or take out (-1) one record's numbers from its day and week (caller's transaction)."""
+    nums = [sign * (rec[k] or 0.0) for k in ("total_kcal", "protein_g", "carbs_g", "fat_g")]
+    for period, start in _period_starts(rec["created"]):
+        for user in (rec["user"], ALL_USERS):
+            conn.execute(
+                "INSERT INTO rollups VALUES (?,?,?,?,?,?,?,?) ON CONFLICT (period, user, start) DO UPDATE SET"
+                " meals = meals + excluded.meals, kcal = kcal + excluded.kcal, protein_g = protein_g + excluded.protein_g,"
+                " carbs_g = carbs_g + excluded.carbs_g, fat_g = fat_g + excluded.fat_g",
+                (period, user, start, sign, *nums))
+            if sign < 0:
+                conn.execute("DELETE FROM rollups WHERE period=? AND user=? AND start=? AND meals <= 0",
+                             (period, user, start))
+    with _LOCK:
+        _STATS["rollup_updates"] += 1
+
+def _build_rollups(conn: sqlite3.Connection):
+    """Fill the rollups from the records, once (new database or one from before rollups existed)."""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        if conn.execute("SELECT 1 FROM meta WHERE key='rollups'").fetchone():
+            conn.execute("COMMIT")
+            return
+        t0 = time.perf_counter()
+        conn.execute("DELETE FROM rollups")
+        # SQLite's 'weekday 0' moves to the Sunday on/after the day; -6 days is that week's Monday
+        for period, start in (("day", "date(created, 'unixepoch')"),
+                              ("week", "date(created, 'unixepoch', 'weekday 0', '-6 days')")):
+            for user, group in (("user", "user, "), (f"'{ALL_USERS}'", "")):
+                conn.execute(
+                    f"INSERT INTO rollups SELECT '{period}', {user}, {start}, COUNT(*), SUM(COALESCE(total_kcal, 0)),"
+                    " SUM(COALESCE(protein_g, 0)), SUM(COALESCE(carbs_g, 0)), SUM(COALESCE(fat_g, 0))"
+                    f" FROM records GROUP BY {group}{start}")
+        conn.execute("INSERT INTO meta VALUES ('rollups', ?)", (datetime.utcnow().isoformat(),))
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    n = conn.execute("SELECT COUNT(*) FROM rollups").fetchone()[0]
+    if n:
+        print(f"[history] 📊 built {n} rollup row(s) in {(time.perf_counter() - t0) * 1000.0:.1f} ms")
+
+def _import_dir(conn: sqlite3.Connection, upload_dir: str):
+    """One-time import of the <image>.json history written before this index existed."""
+    conn.execute("BEGIN IMMEDIATE")   # one gunicorn worker imports, the others then see the flag
+    try:
+        if conn.execute("SELECT 1 FROM meta WHERE key='imported'").fetchone():
+            conn.execute("COMMIT")
+            return
+        t0, n = time.perf_counter(), 0
+        for fname in os.listdir(upload_dir):
+            if not fname.endswith(".json") or fname.endswith((".job.json", ".ckpt.json")):
+                continue
+            try:
+                with open(os.path.join(upload_dir, fname), "r", encoding="utf-8") as f:
+                    rec = json.load(f)
+                if not (isinstance(rec, dict) and "total_kcal" in rec):
+                    continue
+                row = _row(fname, rec)
+            except Exception:
+                continue
+            conn.execute("INSERT OR IGNORE " + _VALUES, row)
+            n += 1
+        conn.execute("INSERT INTO meta VALUES ('imported', ?)", (datetime.utcnow().isoformat(),))
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    with _LOCK:
+        _STATS["imported"] += n
+    if n:
+        print(f"[history] 📥 imported {n} record(s) from {upload_dir} in {(time.perf_counter() - t0) * 1000.0:.1f} ms")
+
+def _old(conn: sqlite3.Connection, rec_id: str) -> Optional[Dict[str, Any]]:
+    row = conn.execute(f"SELECT {', '.join(_AGG)} FROM records WHERE id=?", (rec_id,)).fetchone()
+    return dict(zip(_AGG, row)) if row else None
+
+def record_history(rec_id: str, rec: Dict[str, Any]):
+    """Index one history record and fold it into the rollups (same id = re-analysis: replaces it)."""
+    try:
+        row = dict(zip(_FIELDS, _row(rec_id, rec)))
+        db = _db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            old = _old(db, rec_id)
+            if old:
+                _rollup(db, old, -1)
+            db.execute("INSERT OR REPLACE " + _VALUES, tuple(row.values()))
+            _rollup(db, row, +1)
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        with _LOCK:
+            _STATS["writes"] += 1
+    except Exception as e:
+        with _LOCK:
+            _STATS["write_errors"] += 1
+        print(f"[history] write failed: {e}")
+
+def delete_history(rec_id: str) -> bool:
+    """Drop one record and take it out of its day/week rollups; False if there was none."""
+    db = _db()
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        old = _old(db, rec_id)
+        if old:
+            _rollup(db, old, -1)
+            db.execute("DELETE FROM records WHERE id=?", (rec_id,))
+        db.execute("COMMIT")
+    except BaseException:
+        db.execute("ROLLBACK")
+        raise
+    if old:
+        with _LOCK:
+            _STATS["deletes"] += 1
+    return old is not None
+
+def _encode_cursor(created: float, rec_id: str) -> str:
+    return base64.urlsafe_b64encode(json.dumps([created, rec_id]).encode()).decode().rstrip("=")
+
+def _decode_cursor(cursor: str) -> Tuple[float, str]:
+    try:
+        created, rec_id = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        return float(created), str(rec_id)
+    except Exception:
+        raise ValueError("bad cursor")
+
+def _bound(s: str, end: bool) -> float:
+    # 'YYYY-MM-DD' covers the whole (UTC) day; a full ISO timestamp is used as is
+    ts = _epoch(s)
+    return ts + 86400.0 if end and len(s) == 10 else ts
+
+def query_history(limit: int = 20, cursor: Optional[str] = None, date_from: Optional[str] = None,
+          date_to: Optional[str] = None, dish: Optional[str] = None, min_kcal: Optional[float] = None,
+          max_kcal: Optional[float] = None, fields: Optional[List[str]] = None, full: bool = False,
+          user: Optional[str] = None) -> Dict[str, Any]:
+    """
+    One page of history, newest first: {"items": [...], "next_cursor": str | None}.
+    date_from/date_to: UTC 'YYYY-MM-DD' (inclusive) or ISO timestamps; dish: case-insensitive
+    exact name; user: one user's records; fields: subset of SUMMARY_FIELDS; full: add the
+    stored record as "record".
+    Raises ValueError on a bad cursor, date or field name.
+    """
+    t0 = time.perf_counter()
+    fields = list(fields or SUMMARY_FIELDS)
+    unknown = [f for f in fields if f not in SUMMARY_FIELDS]
+    if unknown:
+        raise ValueError(f"unknown field(s) {unknown}; pick from {list(SUMMARY_FIELDS)}")
+    limit = max(1, min(int(limit), PAGE_MAX))
+    where, args = [], []
+    try:
+        if date_from:
+            where.append("created >= ?")
+            args.append(_bound(date_from, end=False))
+        if date_to:
+            where.append("created < ?" if len(date_to) == 10 else "created <= ?")
+            args.append(_bound(date_to, end=True))
+    except ValueError:
+        raise ValueError("dates must be YYYY-MM-DD or ISO timestamps")
+    if user is not None:
+        where.append("user = ?")
+        args.append(user)
+    if dish:
+        where.append("dish_lc = ?")
+        args.append(dish.lower().strip())
+    if min_kcal is not None:
+        where.append("total_kcal >= ?")
+        args.append(float(min_kcal))
+    if max_kcal is not None:
+        where.append("total_kcal <= ?")
+        args.append(float(max_kcal))
+    if cursor:
+        c_created, c_id = _decode_cursor(cursor)
+        where.append("(created < ? OR (created = ? AND id < ?))")
+        args += [c_created, c_created, c_id]
+
+    cols = ["id", "created"] + [_COLUMNS[f] for f in fields if f in _COLUMNS]
+    cols += [f for f in ("created_at", "usage_total") if f in fields] + (["body"] if full else [])
+    sql = (f"SELECT {', '.join(cols)} FROM records" + (f" WHERE {' AND '.join(where)}" if where else "")
+           + " ORDER BY created DESC, id DESC LIMIT ?")
+    rows = _db().execute(sql, args + [limit + 1]).fetchall()
+
+    items = []
+    for row in rows[:limit]:
+        r = dict(zip(cols, row))
+        item = {f: r[_COLUMNS.get(f, f)] for f in fields}
+        if item.get("usage_total"):
+            item["usage_total"] = json.loads(item["usage_total"])
+        if full:
+            item["record"] = json.loads(r["body"])
+        items.append(item)
+    nxt = _encode_cursor(rows[limit - 1][1], rows[limit - 1][0]) if len(rows) > limit else None
+
+    with _LOCK:
+        _STATS["queries"] += 1
+        _QUERY_MS.append((time.perf_counter() - t0) * 1000.0)
+    return {"items": items, "next_cursor": nxt}
+
+def _day(s: str) -> date:
+    try:
+        return date.fromisoformat(s[:10])
+    except ValueError:
+        raise ValueError("dates must be YYYY-MM-DD")
+
+def query_rollups(period: str = "day", date_from: Optional[str] = None, date_to: Optional[str] = None,
+                  user: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Totals per day or week (UTC days, weeks from Monday) between date_from and date_to
+    (inclusive, default: the last 30 days / 12 weeks), one row per period, empty ones
+    included. user=None sums every user. Raises ValueError on a bad period or range.
+    """
+    if period not in PERIODS:
+        raise ValueError(f"period must be one of {list(PERIODS)}")
+    t0 = time.perf_counter()
+    step = timedelta(days=1 if period == "day" else 7)
+    end = _day(date_to) if date_to else datetime.utcnow().date()
+    start = _day(date_from) if date_from else end - step * (29 if period == "day" else 11)
+    if period == "week":
+        start, end = start - timedelta(days=start.weekday()), end - timedelta(days=end.weekday())
+    n = (end - start) // step + 1
+    if n < 1 or n > ROLLUP_MAX_PERIODS:
+        raise ValueError(f"range must cover 1..{ROLLUP_MAX_PERIODS} {period}s")
+
+    found = {r[0]: r[1:] for r in _db().execute(
+        "SELECT start, meals, kcal, protein_g, carbs_g, fat_g FROM rollups"
+        " WHERE period = ? AND user = ? AND start BETWEEN ? AND ?",
+        (period, ALL_USERS if user is None else user, start.isoformat(), end.isoformat()))}
+
+    keys = ("meals", "kcal", "protein_g", "carbs_g", "fat_g")
+    rows, totals = [], dict.fromkeys(keys, 0.0)
+    for i in range(n):
+        day = (start + step * i).isoformat()
+        vals = found.get(day, (0, 0.0, 0.0, 0.0, 0.0))
+        row = {"start": day, "meals": int(vals[0]), **{k: round(v, 1) for k, v in zip(keys[1:], vals[1:])}}
+        rows.append(row)
+        for k in keys:
+            totals[k] += row[k]
+    with_meals = sum(1 for r in rows if r["meals"])
+    with _LOCK:
+        _STATS["rollup_queries"] += 1
+    return {
+        "period": period, "from": start.isoformat(), "to": end.isoformat(), "user": user, "rows": rows,
+        "totals": {k: (int(v) if k == "meals" else round(v, 1)) for k, v in totals.items()},
+        f"{period}s_with_meals": with_meals,
+        f"avg_kcal_per_{period}": round(totals["kcal"] / with_meals, 1) if with_meals else None,
+        "query_ms": round((time.perf_counter() - t0) * 1000.0, 3),
+    }
+
+def history_stats() -> Dict:
+    with _LOCK:
+        out = dict(_STATS)
+        ms = sorted(_QUERY_MS)
+    out.update({"path": HISTORY_DB_PATH,
+                "query_p50_ms": round(ms[len(ms) // 2], 3) if ms else None,
+                "query_p95_ms": round(ms[min(len(ms) - 1, int(.95 * len(ms)))], 3) if ms else None})
+    try:
+        out["records"] = _db().execute("SELECT COUNT(*) FROM records").fetchone()[0]
+    except Exception:
+        pass
+    return out
@@ -0,0 +1,98 @@
+# image_prep.py
+import os, time, threading
+from typing import Dict, List, Tuple
+from PIL import Image, ImageOps
+
+# Normalize each upload ONCE per job: apply EXIF orientation, drop metadata, cap the
+# long edge and re-encode. Every stage then ships these smaller bytes to Gemini.
+ENABLED = os.getenv("IMG_NORMALIZE", "1") != "0"
+MAX_EDGE = int(os.getenv("IMG_MAX_EDGE", "1280"))
+PRIMARY_MAX_EDGE = int(os.getenv("IMG_PRIMARY_MAX_EDGE", "1600"))  # first angle; 0 = same as MAX_EDGE
+FORMAT = os.getenv("IMG_FORMAT", "jpeg").lower()                   # jpeg | webp
+QUALITY = int(os.getenv("IMG_QUALITY", "85"))
+
+_STATS = {"images": 0, "failed": 0, "bytes_in": 0, "bytes_out": 0, "ms_total": 0.0}
+_LOCK = threading.Lock()
+
+def _flatten(img: Image.Image) -> Image.Image:
+    if img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info):
+        img = img.convert("RGBA")
+        bg = Image.new("RGB", img.size, (255, 255, 255))
+        bg.paste(img, mask=img.getchannel("A"))
+        return bg
+    return img.convert("RGB") if img.mode != "RGB" else img
+
+def normalize_image(path: str, max_edge: int = MAX_EDGE) -> str:
+    """
+    Write '<name>_norm.jpg|webp' next to `path` and return its path.
+    Orientation is baked into the pixels; EXIF/ICC/XMP are not copied over.
+    """
+    ext = "webp" if FORMAT == "webp" else "jpg"
+    out = os.path.splitext(path)[0] + f"_norm.{ext}"
+    with Image.open(path) as src:
+        # Already the target format, no EXIF and no resize needed: re-encoding only grows it.
+        passthrough = (src.format == ("WEBP" if ext == "webp" else "JPEG")
+                       and not src.getexif() and (max_edge <= 0 or max(src.size) <= max_edge))
+        img = _flatten(ImageOps.exif_transpose(src))
+        if max_edge > 0 and max(img.size) > max_edge:
+            img.thumbnail((max_edge, max_edge), Image.LANCZOS)
+        if ext == "webp":
+            img.save(out, "WEBP", quality=QUALITY, method=4)
+        else:
+            img.save(out, "JPEG", quality=QUALITY, optimize=True, progressive=True)
+    if passthrough and os.path.getsize(out) >= os.path.getsize(path):
+        os.remove(out)
+        return path
+    return out
+
+def normalize_images(paths: List[str]) -> Tuple[List[str], Dict[str, float]]:
+    """
+    Normalize all angles of a job. The first angle may keep more pixels (PRIMARY_MAX_EDGE)
+    since it carries most of the detail. Falls back to the original file on any error.
+    Returns (paths_for_models, stats) where stats are merged into `timings`.
+    """
+    if not ENABLED:
+        return list(paths), {}
+    t0 = time.perf_counter()
+    out_paths: List[str] = []
+    bytes_in = bytes_out = failed = 0
+    for i, p in enumerate(paths):
+        edge = PRIMARY_MAX_EDGE if (i == 0 and PRIMARY_MAX_EDGE > 0) else MAX_EDGE
+        size_in = os.path.getsize(p)
+        try:
+            q = normalize_image(p, edge)
+        except Exception as e:
+            print(f"[image_prep] ⚠️ could not normalize {os.path.basename(p)}: {e}")
+            q = p
+            failed += 1
+        out_paths.append(q)
+        bytes_in += size_in
+        bytes_out += os.path.getsize(q)
+    ms = round((time.perf_counter() - t0) * 1000.0, 2)
+
+    with _LOCK:
+        _STATS["images"] += len(paths)
+        _STATS["failed"] += failed
+        _STATS["bytes_in"] += bytes_in
+        _STATS["bytes_out"] += bytes_out
+        _STATS["ms_total"] = round(_STATS["ms_total"] + ms, 2)
+
+    print(f"[image_prep] {len(paths)} image(s) {bytes_in/1024:.0f} KB → {bytes_out/1024:.0f} KB in {ms} ms")
+    return out_paths, {
+        "normalize_ms": ms,
+        "image_bytes_in": float(bytes_in),
+        "image_bytes_out": float(bytes_out),
+        "image_bytes_saved": float(bytes_in - bytes_out),
+    }
+
+def image_prep_stats() -> Dict:
+    with _LOCK:
+        n = _STATS["images"]
+        return {
+            **_STATS,
+            "bytes_saved": _STATS["bytes_in"] - _STATS["bytes_out"],
+            "avg_ratio": round(_STATS["bytes_out"] / _STATS["bytes_in"], 4) if _STATS["bytes_in"] else 0.0,
+            "avg_ms": round(_STATS["ms_total"] / n, 2) if n else 0.0,
+            "config": {"enabled": ENABLED, "max_edge": MAX_EDGE, "primary_max_edge": PRIMARY_MAX_EDGE,
+                       "format": FORMAT, "quality": QUALITY},
+        }
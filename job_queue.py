@@ -0,0 +1,158 @@
+# job_queue.py
+import os, math, time, threading, contextvars
+from collections import deque
+from typing import Any, Callable, Deque, Dict, List, Optional
+
+# Pipeline runs happen on a fixed pool of JOB_WORKERS threads, not on HTTP request
+# threads: routes enqueue a job and then only wait on / subscribe to its result. Two
+# lanes, each a bounded FIFO:
+#   - interactive (/upload, /analyze_sse, /analyze): always served first,
+#   - batch (/analyze_batch, lane=batch reprocessing): never holds more than
+#     JOB_BATCH_WORKERS workers, so interactive work keeps the rest of the pool.
+# A full lane rejects at once (QueueFull -> 429 + Retry-After) instead of stacking
+# blocked threads. Each job's queue wait is measured apart from its run time.
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "8"))
+BATCH_WORKERS = max(1, min(JOB_WORKERS - 1, int(os.getenv("JOB_BATCH_WORKERS", "2"))))   # ≥1 worker stays interactive
+LANES = ("interactive", "batch")
+QUEUE_MAX = {"interactive": int(os.getenv("JOB_QUEUE_MAX", "32")),
+             "batch": int(os.getenv("JOB_QUEUE_MAX_BATCH", "8"))}
+
+class QueueFull(RuntimeError):
+    def __init__(self, lane: str, retry_after: int):
+        super().__init__(f"{lane} queue full")
+        self.lane, self.retry_after = lane, retry_after
+
+class Job:
+    def __init__(self, lane: str, fn: Callable[[], Any], name: str = ""):
+        self.lane, self.fn, self.name = lane, fn, name
+        self.enqueued = time.perf_counter()
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+        self.ctx = contextvars.copy_context()   # caller's context (cancel token included)
+        self._done = threading.Event()
+
+    @property
+    def wait_ms(self) -> float:
+        end = self.started if self.started is not None else time.perf_counter()
+        return round((end - self.enqueued) * 1000.0, 2)
+
+    def wait(self, timeout: Optional[float] = None) -> Any:
+        """Block until the job ran; its result, or its exception re-raised."""
+        if not self._done.wait(timeout):
+            raise TimeoutError(f"job {self.name or self.lane} still queued/running")
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+_COND = threading.Condition()
+_QUEUES: Dict[str, Deque[Job]] = {lane: deque() for lane in LANES}
+_RUNNING = {lane: 0 for lane in LANES}
+_WORKERS: List[threading.Thread] = []
+_CURRENT: "contextvars.ContextVar[Optional[Job]]" = contextvars.ContextVar("queue_job", default=None)
+_STATS: Dict[str, Dict[str, Any]] = {lane: {"submitted": 0, "rejected": 0, "completed": 0, "failed": 0,
+                                             "wait_ms": deque(maxlen=500), "run_ms": deque(maxlen=500)}
+                                      for lane in LANES}
+
+def _ensure_workers():
+    if len(_WORKERS) >= JOB_WORKERS:
+        return
+    for i in range(len(_WORKERS), JOB_WORKERS):
+        t = threading.Thread(target=_worker, daemon=True, name=f"job-worker-{i}")
+        t.start()
+        _WORKERS.append(t)
+    print(f"[queue] 🧵 {JOB_WORKERS} workers (batch ≤ {BATCH_WORKERS}), "
+          f"queue max {QUEUE_MAX['interactive']} interactive / {QUEUE_MAX['batch']} batch")
+
+def _avg(xs) -> float:
+    return sum(xs) / len(xs) if xs else 0.0
+
+def _retry_after(lane: str) -> int:
+    # time for the queue ahead to drain at the lane's recent run time (caller holds _COND)
+    workers = BATCH_WORKERS if lane == "batch" else JOB_WORKERS
+    run_s = (_avg(_STATS[lane]["run_ms"]) or 5000.0) / 1000.0
+    return max(1, math.ceil(len(_QUEUES[lane]) * run_s / workers))
+
+def admit(lane: str):
+    """Raise QueueFull now if `lane` has no room (cheap check before accepting an upload)."""
+    with _COND:
+        if len(_QUEUES[lane]) >= QUEUE_MAX[lane]:
+            _STATS[lane]["rejected"] += 1
+            raise QueueFull(lane, _retry_after(lane))
+
+def submit(lane: str, fn: Callable[[], Any], name: str = "") -> Job:
+    """Queue fn() on `lane`; raises QueueFull when the lane is at JOB_QUEUE_MAX[_BATCH]."""
+    if lane not in LANES:
+        raise ValueError(f"unknown lane {lane!r}")
+    job = Job(lane, fn, name)
+    with _COND:
+        _ensure_workers()
+        if len(_QUEUES[lane]) >= QUEUE_MAX[lane]:
+            _STATS[lane]["rejected"] += 1
+            raise QueueFull(lane, _retry_after(lane))
+        _QUEUES[lane].append(job)
+        _STATS[lane]["submitted"] += 1
+        _COND.notify()
+    return job
+
+def run_job(lane: str, fn: Callable[[], Any], name: str = "", timeout: Optional[float] = None) -> Any:
+    """submit() and wait for the result (the caller's thread only waits)."""
+    return submit(lane, fn, name).wait(timeout)
+
+def _take() -> Optional[Job]:
+    if _QUEUES["interactive"]:
+        return _QUEUES["interactive"].popleft()
+    if _QUEUES["batch"] and _RUNNING["batch"] < BATCH_WORKERS:
+        return _QUEUES["batch"].popleft()
+    return None
+
+def _worker():
+    while True:
+        with _COND:
+            job = _take()
+            while job is None:
+                _COND.wait()
+                job = _take()
+            _RUNNING[job.lane] += 1
+        job.started = time.perf_counter()
+        try:
+            job.result = job.ctx.run(_run, job)
+        except BaseException as e:
+            job.error = e
+        job.finished = time.perf_counter()
+        with _COND:
+            _RUNNING[job.lane] -= 1
+            st = _STATS[job.lane]
+            st["completed" if job.error is None else "failed"] += 1
+            st["wait_ms"].append(job.wait_ms)
+            st["run_ms"].append((job.finished - job.started) * 1000.0)
+            _COND.notify_all()   # a batch slot may have opened
+        job._done.set()
+
+def _run(job: Job) -> Any:
+    _CURRENT.set(job)
+    return job.fn()
+
+def current_wait_ms() -> Optional[float]:
+    """Queue wait of the job running on this worker (None outside the pool)."""
+    job = _CURRENT.get()
+    return job.wait_ms if job is not None else None
+
+def _pct(xs, p: float) -> Optional[float]:
+    s = sorted(xs)
+    return round(s[min(len(s) - 1, int(p * len(s)))], 1) if s else None
+
+def queue_stats() -> Dict:
+    with _COND:
+        out: Dict[str, Any] = {"workers": JOB_WORKERS, "batch_workers": BATCH_WORKERS, "started": len(_WORKERS)}
+        for lane in LANES:
+            st = _STATS[lane]
+            out[lane] = {
+                "queued": len(_QUEUES[lane]), "running": _RUNNING[lane], "max_queued": QUEUE_MAX[lane],
+                **{k: st[k] for k in ("submitted", "rejected", "completed", "failed")},
+                "queue_wait_p50_ms": _pct(st["wait_ms"], .5), "queue_wait_p95_ms": _pct(st["wait_ms"], .95),
+                "run_p50_ms": _pct(st["run_ms"], .5), "run_p95_ms": _pct(st["run_ms"], .95),
+                "retry_after_s": _retry_after(lane),
+            }
+    return out
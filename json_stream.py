@@ -0,0 +1,120 @@
+# json_stream.py
+import json
+from typing import Any, Callable, List, Optional, Tuple
+
+Path = Tuple[Any, ...]
+
+class JsonStreamParser:
+    """
+    Incremental parser for ONE top-level JSON object arriving in text chunks.
+
+    feed() reports every string/object/array VALUE the moment it closes, as
+    (path, value): e.g. (("dish",), "fried rice"), (("items", 0), {...}).
+    Numbers/literals are only reported as part of their parent container.
+    Text before the first '{' (```json fences, prose) is skipped; `done` flips
+    as soon as the top-level object closes, so callers can stop the stream.
+    """
+
+    def __init__(self, on_value: Optional[Callable[[Path, Any], None]] = None):
+        self.on_value = on_value
+        self.buf = ""
+        self.pos = 0
+        self.started = False
+        self.done = False
+        self.result: Any = None
+        self._stack: List[dict] = []   # {"kind": "obj"|"arr", "start", "key", "index", "expect_key"}
+        self._in_str = False
+        self._esc = False
+        self._str_start = 0
+        self._str_is_key = False
+        self._completed: List[Tuple[Path, Any]] = []
+
+    def _path(self) -> Path:
+        out = []
+        for fr in self._stack:
+            out.append(fr["key"] if fr["kind"] == "obj" else fr["index"])
+        return tuple(out)
+
+    def _emit(self, path: Path, raw: str):
+        try:
+            self._completed.append((path, json.loads(raw)))
+        except Exception:
+            pass
+
+    def feed(self, chunk: str) -> List[Tuple[Path, Any]]:
+        """Consume more text. Returns the (path, value) pairs completed by this chunk."""
+        self._completed = []
+        self._scan(chunk)
+        if self.on_value is not None:
+            for p, v in self._completed:
+                self.on_value(p, v)
+        return self._completed
+
+    def _scan(self, chunk: str):
+        if self.done:
+            return
+        self.buf += chunk
+        buf = self.buf
+        i = self.pos
+        n = len(buf)
+        while i < n and not self.done:
+            c = buf[i]
+            if not self.started:
+                if c == "{":
+                    self.started = True
+                    self._stack.append({"kind": "obj", "start": i, "key": None, "index": 0, "expect_key": True})
+                i += 1
+                continue
+
+            if self._in_str:
+                if self._esc:
+                    self._esc = False
+                elif c == "\\":
+                    self._esc = True
+                elif c == '"':
+                    self._in_str = False
+                    raw = buf[self._str_start:i + 1]
+                    top = self._stack[-1]
+                    if self._str_is_key:
+                        try:
+                            top["key"] = json.loads(raw)
+                        except Exception:
+                            top["key"] = raw.strip('"')
+                    else:
+                        self._emit(self._path(), raw)
+                i += 1
+                continue
+
+            top = self._stack[-1] if self._stack else None
+            if c == '"':
+                self._in_str = True
+                self._str_start = i
+                self._str_is_key = bool(top and top["kind"] == "obj" and top["expect_key"])
+            elif c == ":":
+                if top and top["kind"] == "obj":
+                    top["expect_key"] = False
+            elif c == ",":
+                if top and top["kind"] == "obj":
+                    top["expect_key"] = True
+                elif top:
+                    top["index"] += 1
+            elif c in "{[":
+                self._stack.append({"kind": "obj" if c == "{" else "arr", "start": i,
+                                    "key": None, "index": 0, "expect_key": c == "{"})
+            elif c in "}]":
+                fr = self._stack.pop()
+                raw = buf[fr["start"]:i + 1]
+                if not self._stack:
+                    self.done = True
+                    try:
+                        self.result = json.loads(raw)
+                    except Exception:
+                        self.result = None
+                else:
+                    self._emit(self._path(), raw)
+            i += 1
+        self.pos = i
+
+    @property
+    def text(self) -> str:
+        return self.buf
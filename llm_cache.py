@@ -0,0 +1,183 @@
+# llm_cache.py
+import os, json, time, sqlite3, hashlib, threading, functools, inspect
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional
+
+# On-disk cache of stage results, keyed by model + prompt hash + image content hashes +
+# generation config. SQLite in WAL mode so every gunicorn worker shares one file safely.
+# Eviction is LRU (by last access) once the stored bytes exceed LLM_CACHE_MAX_BYTES.
+ENABLED = os.getenv("LLM_CACHE", "1") != "0"
+CACHE_PATH = os.path.abspath(os.getenv("LLM_CACHE_PATH", "./cache/llm_cache.sqlite"))
+MAX_BYTES = int(os.getenv("LLM_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+TTL_S = float(os.getenv("LLM_CACHE_TTL_S", str(30 * 24 * 3600)))
+SHA_MEMO_MAX = int(os.getenv("LLM_CACHE_SHA_MEMO_MAX", "4096"))
+
+_local = threading.local()
+_LOCK = threading.Lock()
+_STATS = {"hits": 0, "misses": 0, "bypass": 0, "writes": 0, "evicted": 0}
+_SHA_MEMO: "OrderedDict[tuple, str]" = OrderedDict()   # (path, size, mtime) -> sha256, LRU
+
+def _db() -> sqlite3.Connection:
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        os.makedirs(os.path.dirname(CACHE_PATH), exist_ok=True)
+        conn = sqlite3.connect(CACHE_PATH, timeout=5.0, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            " key TEXT PRIMARY KEY, stage TEXT, model TEXT, value TEXT,"
+            " size INTEGER, created REAL, accessed REAL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries(accessed)")
+        # running total of entries.size, kept by put() so a write doesn't SUM the table
+        conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER)")
+        if conn.execute("SELECT 1 FROM meta WHERE key='bytes'").fetchone() is None:
+            conn.execute("INSERT OR IGNORE INTO meta SELECT 'bytes', COALESCE(SUM(size),0) FROM entries")
+        _local.conn = conn
+    return conn
+
+def file_sha256(path: str) -> str:
+    st = os.stat(path)
+    memo_key = (path, st.st_size, st.st_mtime_ns)
+    with _LOCK:
+        sha = _SHA_MEMO.get(memo_key)
+        if sha is not None:
+            _SHA_MEMO.move_to_end(memo_key)
+            return sha
+    with open(path, "rb") as f:
+        sha = hashlib.sha256(f.read()).hexdigest()
+    with _LOCK:
+        _SHA_MEMO[memo_key] = sha
+        while len(_SHA_MEMO) > SHA_MEMO_MAX:
+            _SHA_MEMO.popitem(last=False)
+    return sha
+
+def config_fingerprint(cfg) -> str:
+    try:
+        return cfg.model_dump_json(exclude_none=True)
+    except Exception:
+        return repr(cfg)
+
+def make_key(stage: str, model: str, prompt: str, image_paths: List[str], configs: List, extra: Any = None) -> str:
+    blob = json.dumps({
+        "stage": stage,
+        "model": model,
+        "prompt": hashlib.sha256(prompt.encode("utf-8")).hexdigest(),
+        "images": [file_sha256(p) for p in (image_paths or [])],
+        "config": [config_fingerprint(c) for c in configs],
+        "extra": extra,
+    }, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+def get(key: str) -> Optional[Dict]:
+    now = time.time()
+    try:
+        row = _db().execute("SELECT value, created FROM entries WHERE key=?", (key,)).fetchone()
+        if row is None or now - row[1] > TTL_S:
+            return None
+        _db().execute("UPDATE entries SET accessed=? WHERE key=?", (now, key))
+        return json.loads(row[0])
+    except Exception as e:
+        print(f"[llm_cache] read failed: {e}")
+        return None
+
+def put(key: str, stage: str, model: str, value: Dict):
+    data = json.dumps(value, ensure_ascii=False)
+    now = time.time()
+    try:
+        db = _db()
+        evicted = 0
+        db.execute("BEGIN IMMEDIATE")   # the size delta and the total move together across workers
+        try:
+            old = db.execute("SELECT size FROM entries WHERE key=?", (key,)).fetchone()
+            db.execute("INSERT OR REPLACE INTO entries VALUES (?,?,?,?,?,?,?)",
+                       (key, stage, model, data, len(data), now, now))
+            db.execute("UPDATE meta SET value = value + ? WHERE key='bytes'", (len(data) - (old[0] if old else 0),))
+            total = db.execute("SELECT value FROM meta WHERE key='bytes'").fetchone()[0]
+            if total > MAX_BYTES:
+                # Drop least-recently-used rows until we're back to 90% of the budget.
+                over = total - int(MAX_BYTES * 0.9)
+                freed = 0
+                for k, size in db.execute("SELECT key, size FROM entries ORDER BY accessed").fetchall():
+                    if freed >= over:
+                        break
+                    db.execute("DELETE FROM entries WHERE key=?", (k,))
+                    freed += size
+                    evicted += 1
+                db.execute("UPDATE meta SET value = value - ? WHERE key='bytes'", (freed,))
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        with _LOCK:
+            _STATS["writes"] += 1
+            _STATS["evicted"] += evicted
+    except Exception as e:
+        print(f"[llm_cache] write failed: {e}")
+
+def cached_stage(stage: str, key_fn: Callable[[Dict[str, Any]], str]):
+    """
+    Put the disk cache in front of a stage function (sync or async).
+    key_fn receives the bound call arguments (defaults applied). The wrapped function
+    accepts `use_cache=False` to force a fresh run; hits are marked in the caller's
+    `timings` as '<stage>_cache_hit'. Error results are not stored.
+    """
+    def deco(fn):
+        sig = inspect.signature(fn)
+
+        def lookup(args, kwargs):
+            use_cache = kwargs.pop("use_cache", True)
+            bound = sig.bind(*args, **kwargs)
+            bound.apply_defaults()
+            a = bound.arguments
+            if not ENABLED:
+                return a, None, None
+            key = key_fn(a)
+            if not use_cache:
+                # forced fresh run; the new result still replaces the cached one
+                with _LOCK:
+                    _STATS["bypass"] += 1
+                return a, key, None
+            hit = get(key)
+            with _LOCK:
+                _STATS["hits" if hit is not None else "misses"] += 1
+            if hit is not None and a.get("timings") is not None:
+                a["timings"][f"{stage}_cache_hit"] = 1.0
+            return a, key, hit
+
+        def store(a, key, res):
+            if key and isinstance(res, dict) and "error" not in res:
+                put(key, stage, a.get("model", ""), res)
+            return res
+
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def awrapper(*args, **kwargs):
+                a, key, hit = lookup(args, kwargs)
+                if hit is not None:
+                    return hit
+                return store(a, key, await fn(*args, **kwargs))
+            return awrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            a, key, hit = lookup(args, kwargs)
+            if hit is not None:
+                return hit
+            return store(a, key, fn(*args, **kwargs))
+        return wrapper
+    return deco
+
+def cache_stats() -> Dict:
+    out = {**_STATS, "enabled": ENABLED, "path": CACHE_PATH, "max_bytes": MAX_BYTES, "sha_memo": len(_SHA_MEMO)}
+    try:
+        db = _db()
+        n = db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        size = db.execute("SELECT value FROM meta WHERE key='bytes'").fetchone()[0]
+        out.update({"entries": n, "bytes": size})
+    except Exception:
+        pass
+    lookups = _STATS["hits"] + _STATS["misses"]
+    out["hit_rate"] = round(_STATS["hits"] / lookups, 4) if lookups else 0.0
+    return out
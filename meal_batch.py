@@ -0,0 +1,214 @@
+# meal_batch.py
+import os, time, queue, asyncio, threading
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from graph_llm_ingredients import run_image_stages_async, apply_calories, record_variant
+from calorie_engine import estimate_calories_many_async, local_pass
+from gemini_client import summarize_usage
+from image_prep import normalize_images
+from cancellation import CancelToken, cancel_scope
+
+# Many meals in one request (backfilling a day's log). Each meal's image stages run on
+# the async pipeline with at most BATCH_CONCURRENCY meals in flight; meals that reach the
+# calories stage close together are priced together: local table per meal (a meal it
+# fully covers is done at once), then one packed LLM call for every meal's leftovers
+# (calorie_engine.estimate_calories_many_async).
+# A pack goes out once every meal still in flight is waiting for it, once it holds
+# BATCH_CALORIES_MAX meals, or BATCH_CALORIES_WAIT_MS after its first meal joined.
+# Each meal is handed back as soon as it is done; the batch ends with a summary.
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "4"))
+BATCH_MAX_MEALS = int(os.getenv("BATCH_MAX_MEALS", "50"))
+CALORIES_MAX = int(os.getenv("BATCH_CALORIES_MAX", "8"))
+CALORIES_WAIT_S = float(os.getenv("BATCH_CALORIES_WAIT_MS", "400")) / 1000.0
+KEEPALIVE_S = float(os.getenv("BATCH_KEEPALIVE_S", "15"))
+
+_LOCK = threading.Lock()
+_STATS = {"batches": 0, "meals": 0, "meals_ok": 0, "meals_failed": 0, "wall_s_total": 0.0,
+          "calorie_packs": 0, "cancelled": 0}
+_LAST: Dict[str, Any] = {}
+_LOOP: Optional[asyncio.AbstractEventLoop] = None
+
+def _loop() -> asyncio.AbstractEventLoop:
+    # one event loop thread for every batch: in-flight meals are coroutines, not threads
+    global _LOOP
+    with _LOCK:
+        if _LOOP is None:
+            _LOOP = asyncio.new_event_loop()
+            threading.Thread(target=_LOOP.run_forever, daemon=True, name="meal-batch").start()
+    return _LOOP
+
+def _ms(t0: float) -> float:
+    return round((time.perf_counter() - t0) * 1000.0, 2)
+
+class _CaloriePacker:
+    """Meals waiting for calories; each flush is one estimate_calories_many_async call."""
+    def __init__(self, project: Optional[str], location: str, model: str, use_cache: bool, meals: int,
+                 usage: List[Dict]):
+        self.project, self.location, self.model, self.use_cache = project, location, model, use_cache
+        self.open = meals            # meals that may still ask for calories
+        self.usage = usage
+        self.waiting: List[Tuple[Dict, asyncio.Future]] = []
+        self.timer: Optional[asyncio.TimerHandle] = None
+        self.packs = 0
+
+    async def price(self, meal: Dict) -> Dict:
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        self.waiting.append((meal, fut))
+        if len(self.waiting) >= min(CALORIES_MAX, self.open):
+            self._flush()
+        elif self.timer is None:
+            self.timer = loop.call_later(CALORIES_WAIT_S, self._flush)
+        return await fut
+
+    def leave(self):
+        """A meal that failed before calories: nobody should wait for it."""
+        self.open -= 1
+        if self.waiting and len(self.waiting) >= self.open:
+            self._flush()
+
+    def _flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        pack, self.waiting = self.waiting, []
+        if not pack:
+            return
+        self.open -= len(pack)
+        self.packs += 1
+        asyncio.ensure_future(self._run(pack))
+
+    async def _run(self, pack: List[Tuple[Dict, asyncio.Future]]):
+        try:
+            res = await estimate_calories_many_async(self.project, self.location, self.model, [m for m, _ in pack],
+                                                     usage=self.usage, use_cache=self.use_cache)
+        except Exception as e:
+            for _, fut in pack:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        for (_, fut), r in zip(pack, res):
+            if not fut.done():
+                fut.set_result(r)
+
+async def _run_meal(i: int, meal: Dict, packer: _CaloriePacker, sem: asyncio.Semaphore, project: Optional[str],
+                    location: str, model: str, variant: str, use_cache: bool) -> Tuple[int, Dict]:
+    t0 = time.perf_counter()
+    state: Dict[str, Any] = {"timings": {}, "usage": [], "error": None}
+    priced = False
+    try:
+        async with sem:
+            if meal.get("model_paths"):
+                model_paths, norm = meal["model_paths"], dict(meal.get("normalize") or {})
+            else:
+                model_paths, norm = await asyncio.to_thread(normalize_images, meal["paths"])
+            state = await run_image_stages_async(model_paths, project, location, model, use_cache, variant)
+            state["timings"] = {**norm, **state["timings"]}
+        if not state.get("error") and state.get("items"):
+            priced = True
+            t1 = time.perf_counter()
+            meal_in = {"dish": state.get("dish", ""), "items": state["items"], "timings": state["timings"]}
+            meal_in["local"] = local_pass(state["items"], state["timings"])
+            if meal_in["local"] is not None and not meal_in["local"][1]:
+                packer.leave()
+                res = (await estimate_calories_many_async(project, location, model, [meal_in]))[0]
+            else:
+                res = await packer.price(meal_in)
+            apply_calories(state, res, t1)    # calories_ms includes the wait for the pack
+        else:
+            state["error"] = state.get("error") or "No ingredient items."
+    except Exception as e:
+        state["error"] = f"pipeline_exception: {e}"
+    finally:
+        if not priced:
+            packer.leave()
+    state["total_ms"] = _ms(t0)
+    record_variant(variant, state["total_ms"], not state.get("error"), state.get("usage"))
+    return i, state
+
+def run_batch(meals: List[Dict], project: Optional[str], location: str, model: str, variant: str = "full",
+              use_cache: bool = True, token: Optional[CancelToken] = None) -> Iterator[Tuple[str, Optional[int], Any]]:
+    """
+    meals = [{paths} or {paths, model_paths, normalize} for already-normalized /upload jobs].
+    Yields ("meal", index, pipeline state) as each meal finishes, ("keepalive", None, None)
+    every BATCH_KEEPALIVE_S of silence, then ("summary", None, {...}). Closing the
+    iterator early (client gone) or cancelling `token` stops the meals still running.
+    """
+    q: "queue.Queue[Tuple[str, Optional[int], Any]]" = queue.Queue()
+    token = token or CancelToken()
+    shared_usage: List[Dict] = []
+    t0 = time.perf_counter()
+    packer = _CaloriePacker(project, location, model, use_cache, len(meals), shared_usage)
+
+    async def main():
+        with cancel_scope(token):
+            sem = asyncio.Semaphore(BATCH_CONCURRENCY)
+            tasks = [asyncio.ensure_future(_run_meal(i, m, packer, sem, project, location, model, variant, use_cache))
+                     for i, m in enumerate(meals)]
+            try:
+                for fut in asyncio.as_completed(tasks):
+                    i, state = await fut
+                    q.put(("meal", i, state))
+            finally:
+                for t in tasks:
+                    t.cancel()
+
+    done = asyncio.run_coroutine_threadsafe(main(), _loop())
+    done.add_done_callback(lambda f: q.put(("end", None, None if f.cancelled() else f.exception())))
+    ok = failed = 0
+    usage: List[Dict] = []
+    finished = False
+    try:
+        while True:
+            try:
+                kind, i, payload = q.get(timeout=KEEPALIVE_S)
+            except queue.Empty:
+                yield "keepalive", None, None
+                continue
+            if kind == "end":
+                if payload is not None:
+                    print(f"[batch] ❌ {payload}")
+                break
+            ok, failed = (ok, failed + 1) if payload.get("error") else (ok + 1, failed)
+            usage.extend(payload.get("usage") or [])
+            yield kind, i, payload
+        finished = True
+    finally:
+        if not finished:
+            # meals still running hit the token at their next Gemini call and end quickly
+            token.cancel("client_disconnected")
+        if token.cancelled:
+            with _LOCK:
+                _STATS["cancelled"] += 1
+
+    wall_s = time.perf_counter() - t0
+    summary = {
+        "meals": len(meals), "ok": ok, "failed": failed,
+        "wall_ms": round(wall_s * 1000.0, 1),
+        "meals_per_min": round(ok / wall_s * 60.0, 2) if wall_s > 0 else None,
+        "concurrency": BATCH_CONCURRENCY,
+        "calorie_packs": packer.packs,
+        "usage_total": summarize_usage(usage + shared_usage),
+        "packed_calories_usage": summarize_usage(shared_usage),
+    }
+    with _LOCK:
+        _STATS["batches"] += 1
+        _STATS["meals"] += len(meals)
+        _STATS["meals_ok"] += ok
+        _STATS["meals_failed"] += failed
+        _STATS["wall_s_total"] = round(_STATS["wall_s_total"] + wall_s, 3)
+        _STATS["calorie_packs"] += packer.packs
+        _LAST.clear()
+        _LAST.update({k: summary[k] for k in ("meals", "ok", "wall_ms", "meals_per_min", "calorie_packs")})
+    print(f"[batch] ✅ {ok}/{len(meals)} meals in {summary['wall_ms']} ms "
+          f"({summary['meals_per_min']} meals/min, {packer.packs} calorie pack(s))")
+    yield "summary", None, summary
+
+def batch_stats() -> Dict:
+    with _LOCK:
+        s = dict(_STATS)
+        last = dict(_LAST)
+    return {**s, "concurrency": BATCH_CONCURRENCY, "calories_max": CALORIES_MAX,
+            "calories_wait_ms": round(CALORIES_WAIT_S * 1000.0),
+            "meals_per_min": round(s["meals_ok"] / s["wall_s_total"] * 60.0, 2) if s["wall_s_total"] else None,
+            "last_batch": last or None}
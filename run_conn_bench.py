@@ -0,0 +1,184 @@
+# run_conn_bench.py
+import os, sys, json, time, signal, asyncio, argparse, tempfile, subprocess
+from typing import Dict, List, Optional
+
+import requests
+
+# Connection-capacity bench for /analyze_sse: start the server (gunicorn gthread as in
+# the Dockerfile, or uvicorn asgi_app), queue one slow job, then hold N SSE streams open
+# on it at once (single-flight: one pipeline run, N subscribers) and count how many get
+# their first byte, how many see 'done', and what the server process tree costs in
+# threads and RSS while the N streams sit idle.
+SERVERS = {
+    "flask": lambda a: ["gunicorn", "-w", "1", "-k", "gthread", "--threads", str(a.threads),
+                        "-b", f"127.0.0.1:{a.port}", "app:app", "--timeout", "120", "--log-level", "warning"],
+    "asgi": lambda a: ["uvicorn", "asgi_app:app", "--host", "127.0.0.1", "--port", str(a.port),
+                       "--log-level", "warning", "--backlog", "4096"],
+}
+
+def pct(xs: List[float], p: float) -> Optional[float]:
+    if not xs:
+        return None
+    s = sorted(xs)
+    return round(s[min(len(s) - 1, int(p * len(s)))], 1)
+
+def proc_tree(pid: int) -> List[int]:
+    kids: Dict[int, List[int]] = {}
+    for d in os.listdir("/proc"):
+        if d.isdigit():
+            try:
+                with open(f"/proc/{d}/stat") as f:
+                    ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            kids.setdefault(ppid, []).append(int(d))
+    out, todo = [], [pid]
+    while todo:
+        p = todo.pop()
+        out.append(p)
+        todo.extend(kids.get(p, []))
+    return out
+
+def proc_usage(pid: int) -> Dict[str, float]:
+    threads, rss_kb = 0, 0
+    for p in proc_tree(pid):
+        try:
+            with open(f"/proc/{p}/status") as f:
+                for line in f:
+                    if line.startswith("Threads:"):
+                        threads += int(line.split()[1])
+                    elif line.startswith("VmRSS:"):
+                        rss_kb += int(line.split()[1])
+        except OSError:
+            pass
+    return {"threads": threads, "rss_mb": round(rss_kb / 1024.0, 1)}
+
+async def one_stream(port: int, path: str, ttfb_timeout: float, hold_s: float, res: Dict[str, list]):
+    t0 = time.perf_counter()
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection("127.0.0.1", port), ttfb_timeout)
+    except (OSError, asyncio.TimeoutError):
+        res["refused"].append(1)
+        return
+    try:
+        writer.write(f"GET {path} HTTP/1.1\r\nHost: 127.0.0.1\r\nAccept: text/event-stream\r\n\r\n".encode())
+        await writer.drain()
+        buf = b""
+        try:
+            while b"\r\n\r\n" not in buf or buf.endswith(b"\r\n\r\n"):   # headers + first body bytes
+                chunk = await asyncio.wait_for(reader.read(4096), max(0.01, ttfb_timeout - (time.perf_counter() - t0)))
+                if not chunk:
+                    break
+                buf += chunk
+        except asyncio.TimeoutError:
+            res["no_first_byte"].append(1)
+            return
+        if not buf.startswith(b"HTTP/1.1 200"):
+            res["http_errors"].append(1)
+            return
+        res["ttfb"].append((time.perf_counter() - t0) * 1000.0)
+        deadline = t0 + hold_s
+        while b"event: done" not in buf[-4096:]:
+            left = deadline - time.perf_counter()
+            if left <= 0:
+                break
+            try:
+                chunk = await asyncio.wait_for(reader.read(65536), left)
+            except asyncio.TimeoutError:
+                break
+            if not chunk:
+                break
+            buf = buf[-4096:] + chunk
+        if b"event: done" in buf[-4096:]:
+            res["done"].append((time.perf_counter() - t0) * 1000.0)
+    finally:
+        writer.close()
+
+async def open_streams(args, job_id: str, pid: int) -> Dict:
+    path = f"/analyze_sse?job_id={job_id}&model={args.model}&variant={args.variant}"
+    res: Dict[str, list] = {k: [] for k in ("ttfb", "done", "refused", "no_first_byte", "http_errors")}
+    t0 = time.perf_counter()
+    tasks = [asyncio.ensure_future(one_stream(args.port, path, args.ttfb_timeout, args.hold, res))
+             for _ in range(args.connections)]
+    # sample the server once every stream has been given time to connect and get its first byte
+    peak = {"threads": 0, "rss_mb": 0.0}
+    while not all(t.done() for t in tasks) and time.perf_counter() - t0 < args.ttfb_timeout:
+        await asyncio.sleep(0.25)
+        u = proc_usage(pid)
+        peak = {k: max(peak[k], u[k]) for k in peak}
+    await asyncio.gather(*tasks)
+    return {"res": res, "peak": peak, "wall_s": time.perf_counter() - t0}
+
+def wait_ready(base: str, timeout: float = 30.0):
+    t_end = time.time() + timeout
+    while time.time() < t_end:
+        try:
+            if requests.get(base + "/health", timeout=1).ok:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"server at {base} not ready after {timeout:.0f} s")
+
+def bench(server: str, args) -> Dict:
+    env = {**os.environ, "SINGLE_FLIGHT": "1"}
+    if not args.real:
+        env.setdefault("GEMINI_BACKEND", "fake")
+        env["FAKE_TIME_SCALE"] = str(args.time_scale)
+        env.setdefault("UPLOAD_DIR", tempfile.mkdtemp(prefix="fta-conn-"))
+        env.setdefault("LLM_CACHE", "0")
+    proc = subprocess.Popen(SERVERS[server](args), env=env, start_new_session=True)
+    base = f"http://127.0.0.1:{args.port}"
+    try:
+        wait_ready(base)
+        idle = proc_usage(proc.pid)
+        with open(args.image, "rb") as f:
+            r = requests.post(base + "/upload", files={"image": (os.path.basename(args.image), f)},
+                              data={"model": args.model, "variant": args.variant, "nocache": "1"})
+        r.raise_for_status()
+        out = asyncio.run(open_streams(args, r.json()["job_id"], proc.pid))
+        stats = requests.get(base + "/stats", timeout=10).json()
+    finally:
+        os.killpg(proc.pid, signal.SIGTERM)
+        try:
+            proc.wait(10)
+        except subprocess.TimeoutExpired:
+            os.killpg(proc.pid, signal.SIGKILL)
+    res = out["res"]
+    return {
+        "server": server, "connections": args.connections,
+        "first_byte": len(res["ttfb"]), "done": len(res["done"]),
+        "no_first_byte": len(res["no_first_byte"]), "refused": len(res["refused"]), "http_errors": len(res["http_errors"]),
+        "ttfb_p50_ms": pct(res["ttfb"], .5), "ttfb_p95_ms": pct(res["ttfb"], .95),
+        "done_p50_ms": pct(res["done"], .5), "done_p95_ms": pct(res["done"], .95),
+        "threads_idle": idle["threads"], "threads_peak": out["peak"]["threads"],
+        "rss_idle_mb": idle["rss_mb"], "rss_peak_mb": out["peak"]["rss_mb"],
+        "flights": stats["single_flight"]["leaders"],   # >1: streams served after the run ended got a replay
+    }
+
+def main():
+    ap = argparse.ArgumentParser("How many idle /analyze_sse streams one server process holds (gunicorn vs ASGI)")
+    ap.add_argument("--server", choices=["flask", "asgi", "both"], default="both")
+    ap.add_argument("--connections", type=int, default=1000)
+    ap.add_argument("--threads", type=int, default=64, help="gunicorn gthread threads (Dockerfile: 64)")
+    ap.add_argument("--port", type=int, default=8765)
+    ap.add_argument("--image", type=str, default="images/img_1.jpg")
+    ap.add_argument("--model", type=str, default="gemini-2.5-flash")
+    ap.add_argument("--variant", type=str, default="full")
+    ap.add_argument("--time-scale", type=float, default=1.0, help="FAKE_TIME_SCALE: how long the shared run takes")
+    ap.add_argument("--ttfb-timeout", type=float, default=10.0, help="a stream with no byte by then counts as not served")
+    ap.add_argument("--hold", type=float, default=60.0, help="max seconds a stream waits for 'done'")
+    ap.add_argument("--real", action="store_true", help="call the real API instead of gemini_fake")
+    args = ap.parse_args()
+
+    rows = [bench(s, args) for s in (["flask", "asgi"] if args.server == "both" else [args.server])]
+    for row in rows:
+        print(json.dumps(row))
+    print(f"\n{'server':<7}{'conns':>7}{'1st byte':>10}{'done':>7}{'ttfb p50':>10}{'ttfb p95':>10}"
+          f"{'threads':>9}{'rss MB':>9}")
+    for r in rows:
+        print(f"{r['server']:<7}{r['connections']:>7}{r['first_byte']:>10}{r['done']:>7}{str(r['ttfb_p50_ms']):>10}"
+              f"{str(r['ttfb_p95_ms']):>10}{r['threads_peak']:>9}{r['rss_peak_mb']:>9}")
+
+if __name__ == "__main__":
+    sys.exit(main())
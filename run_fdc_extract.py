@@ -0,0 +1,86 @@
+# run_fdc_extract.py
+import os, sys, csv, time, argparse
+import requests
+from dotenv import load_dotenv
+
+# Refresh data/fdc_foods.csv (the calorie_engine table) from the FoodData Central API:
+# each row is looked up by its 'fdc_description' in SR Legacy / Foundation foods and gets
+# the real fdc_id and per-100 g kcal/protein/carbs/fat. Rows FDC can't find are kept as is.
+FDC_SEARCH = "https://api.nal.usda.gov/fdc/v1/foods/search"
+# search results carry both nutrientId (1008...) and the legacy nutrientNumber ("208"...);
+# Foundation foods report energy as Atwater factors (2047/2048) instead of 1008
+NUTRIENTS = {"kcal": ("1008", "2047", "2048", "208"), "protein_g": ("1003", "203"),
+             "carbs_g": ("1005", "205"), "fat_g": ("1004", "204")}
+FIELDS = ["name", "aliases", "fdc_id", "fdc_description", "kcal", "protein_g", "carbs_g", "fat_g", "absorbed_fat_g"]
+
+def fdc_lookup(api_key: str, description: str):
+    r = requests.get(FDC_SEARCH, params={"api_key": api_key, "query": description, "pageSize": 10,
+                                         "dataType": "SR Legacy,Foundation"}, timeout=30)
+    r.raise_for_status()
+    foods = r.json().get("foods") or []
+    if not foods:
+        return None
+    food = next((f for f in foods if f.get("description", "").lower() == description.lower()), foods[0])
+    by_id = {}
+    for n in food.get("foodNutrients") or []:
+        if n.get("value") is None or str(n.get("unitName", "")).upper() == "KJ":
+            continue
+        for k in (n.get("nutrientId"), n.get("nutrientNumber")):
+            if k is not None:
+                by_id.setdefault(str(k), n["value"])
+    out = {"fdc_id": food.get("fdcId"), "fdc_description": food.get("description")}
+    for col, ids in NUTRIENTS.items():
+        val = next((by_id[i] for i in ids if i in by_id), None)
+        out[col] = round(float(val), 2) if val is not None else None
+    return out
+
+def main():
+    ap = argparse.ArgumentParser("Refresh the offline FDC nutrient table used by calorie_engine")
+    ap.add_argument("--table", type=str, default=os.path.join("data", "fdc_foods.csv"))
+    ap.add_argument("--out", type=str, default=None, help="defaults to --table (in place)")
+    ap.add_argument("--add", action="append", default=[],
+                    help='new row as "name=FDC description", e.g. "quinoa=Quinoa, cooked"')
+    ap.add_argument("--env", type=str, default=None)
+    ap.add_argument("--sleep", type=float, default=0.2, help="pause between API calls (1000 req/h limit)")
+    args = ap.parse_args()
+
+    if args.env: load_dotenv(args.env)
+    else: load_dotenv()
+    api_key = os.getenv("FDC_API_KEY")
+    if not api_key:
+        print("[fdc] ❌ FDC_API_KEY not set (see env.prod.yaml)")
+        return 1
+
+    with open(args.table, newline="", encoding="utf-8") as f:
+        rows = list(csv.DictReader(f))
+    for spec in args.add:
+        name, _, desc = spec.partition("=")
+        rows.append({"name": name.strip().lower(), "aliases": "", "fdc_description": desc.strip() or name.strip(),
+                     "absorbed_fat_g": "0"})
+
+    updated, missing = 0, []
+    for r in rows:
+        try:
+            hit = fdc_lookup(api_key, r["fdc_description"])
+        except Exception as e:
+            print(f"[fdc] ⚠️ {r['name']}: {e}")
+            hit = None
+        if not hit or hit.get("kcal") is None:
+            missing.append(r["name"])
+        else:
+            r.update({k: v for k, v in hit.items() if v is not None})
+            updated += 1
+            print(f"[fdc] ✅ {r['name']:<20} fdc_id={hit['fdc_id']}  {hit['kcal']} kcal/100g  ({hit['fdc_description']})")
+        time.sleep(args.sleep)
+
+    with open(args.out or args.table, "w", newline="", encoding="utf-8") as f:
+        w = csv.DictWriter(f, fieldnames=FIELDS, extrasaction="ignore")
+        w.writeheader()
+        w.writerows(rows)
+    print(f"\n[fdc] updated {updated}/{len(rows)} rows → {args.out or args.table}")
+    if missing:
+        print("[fdc] not found (kept as is): " + ", ".join(missing))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,115 @@
+# run_history_bench.py
+import os, sys, json, time, random, argparse, tempfile
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List
+
+# /history latency as the history grows: seeds synthetic records into a scratch
+# history_store (and, up to --legacy-max, <image>.json files for the old listdir scan)
+# and times a few query shapes, the rollup reads and record writes (record + rollups) at
+# each size.
+DISHES = ["karaage bowl", "greek salad", "chicken fried rice", "margherita pizza", "beef pho", "caesar salad",
+          "pad thai", "oatmeal", "sushi platter", "burrito bowl"]
+
+def pct(xs: List[float], p: float) -> float:
+    s = sorted(xs)
+    return round(s[min(len(s) - 1, int(p * len(s)))], 3)
+
+def fake_record(rng: random.Random, when: datetime) -> Dict:
+    kcal = round(rng.uniform(150, 1400), 1)
+    return {"dish": rng.choice(DISHES), "dish_confidence": round(rng.uniform(.5, .99), 2), "total_kcal": kcal,
+            "total_protein_g": round(kcal * .05, 1), "total_carbs_g": round(kcal * .12, 1),
+            "total_fat_g": round(kcal * .035, 1), "total_ms": round(rng.uniform(800, 4000), 1),
+            "usage_total": {"calls": 3, "total_tokens": 2100}, "items_grams": [{"name": "rice", "grams": 180}],
+            "created_at": when.isoformat(), "user": f"user{rng.randrange(50)}"}
+
+def legacy_scan(upload_dir: str, limit: int = 20) -> List[Dict]:
+    # what /history did before history_store
+    files = [f for f in os.listdir(upload_dir) if f.lower().endswith(".json")]
+    files.sort(reverse=True)
+    out = []
+    for fname in files[:limit]:
+        with open(os.path.join(upload_dir, fname), "r", encoding="utf-8") as f:
+            out.append(json.load(f))
+    return out
+
+def timed(fn: Callable, reps: int) -> Dict[str, float]:
+    ms = []
+    for _ in range(reps):
+        t0 = time.perf_counter()
+        fn()
+        ms.append((time.perf_counter() - t0) * 1000.0)
+    return {"p50": pct(ms, .5), "p95": pct(ms, .95)}
+
+def main():
+    ap = argparse.ArgumentParser("history_store query latency vs number of records")
+    ap.add_argument("--sizes", type=str, default="1000,10000,100000,300000")
+    ap.add_argument("--reps", type=int, default=50)
+    ap.add_argument("--legacy-max", type=int, default=20000, help="also time the old listdir scan up to this size")
+    ap.add_argument("--days", type=int, default=365, help="spread records over this many days")
+    ap.add_argument("--seed", type=int, default=1)
+    args = ap.parse_args()
+
+    work = tempfile.mkdtemp(prefix="fta-history-")
+    os.environ["HISTORY_DB_PATH"] = os.path.join(work, "history.sqlite")
+    import history_store as hs
+
+    rng = random.Random(args.seed)
+    end = datetime.utcnow()
+    sizes = sorted(int(s) for s in args.sizes.split(","))
+    n = 0
+    print(f"{'records':>9} {'query':<26} {'p50 ms':>8} {'p95 ms':>8}")
+    for size in sizes:
+        t0 = time.perf_counter()
+        db = hs._db()
+        db.execute("BEGIN")
+        while n < size:
+            rec = fake_record(rng, end - timedelta(seconds=rng.uniform(0, args.days * 86400)))
+            rec_id = f"img-{n:08d}.jpg.json"
+            db.execute("INSERT OR REPLACE " + hs._VALUES, hs._row(rec_id, rec))
+            if n < args.legacy_max:
+                with open(os.path.join(work, rec_id), "w", encoding="utf-8") as f:
+                    json.dump(rec, f)
+            n += 1
+        db.execute("COMMIT")
+        db.execute("DELETE FROM meta WHERE key='rollups'")   # seeded around record_history: rebuild once
+        hs._build_rollups(db)
+        seed_s = time.perf_counter() - t0
+
+        page1 = hs.query_history(limit=20)
+        deep = page1
+        for _ in range(10):
+            deep = hs.query_history(limit=20, cursor=deep["next_cursor"])
+        month = (end - timedelta(days=30)).strftime("%Y-%m-%d")
+        shapes = {
+            "newest page": lambda: hs.query_history(limit=20),
+            "page 11 (cursor)": lambda: hs.query_history(limit=20, cursor=deep["next_cursor"]),
+            "last 30 days": lambda: hs.query_history(limit=20, date_from=month),
+            "dish=pad thai": lambda: hs.query_history(limit=20, dish="pad thai"),
+            "kcal 500-700": lambda: hs.query_history(limit=20, min_kcal=500, max_kcal=700),
+            "fields=dish,total_kcal": lambda: hs.query_history(limit=20, fields=["dish", "total_kcal"]),
+            "full=1": lambda: hs.query_history(limit=20, full=True),
+            "rollups 30 days": lambda: hs.query_rollups("day"),
+            "rollups 30 days, 1 user": lambda: hs.query_rollups("day", user="user7"),
+            "rollups 52 weeks": lambda: hs.query_rollups("week", date_from=(end - timedelta(weeks=51)).strftime("%Y-%m-%d")),
+        }
+        if size <= args.legacy_max:
+            shapes["legacy listdir scan"] = lambda: legacy_scan(work)
+        for name, fn in shapes.items():
+            t = timed(fn, args.reps)
+            print(f"{size:>9} {name:<26} {t['p50']:>8} {t['p95']:>8}")
+        # re-analysis of an existing record: old numbers out of their day/week, new ones in
+        ids = iter(rng.sample(range(n), args.reps))
+        t = timed(lambda: hs.record_history(f"img-{next(ids):08d}.jpg.json", fake_record(rng, end)), args.reps)
+        print(f"{size:>9} {'write (re-analysis)':<26} {t['p50']:>8} {t['p95']:>8}")
+        print(f"{'':>9} (seeded to {size} in {seed_s:.1f} s)")
+
+    # incremental rollups == rollups rebuilt from the records
+    db = hs._db()
+    cols = "period, user, start, meals, ROUND(kcal, 3), ROUND(fat_g, 3)"
+    kept = sorted(db.execute(f"SELECT {cols} FROM rollups"))
+    db.execute("DELETE FROM meta WHERE key='rollups'")
+    hs._build_rollups(db)
+    print(f"rollups consistent with a rebuild: {kept == sorted(db.execute(f'SELECT {cols} FROM rollups'))}")
+
+if __name__ == "__main__":
+    sys.exit(main())
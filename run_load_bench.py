@@ -0,0 +1,182 @@
+# run_load_bench.py
+import os, sys, json, time, asyncio, argparse, tempfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+def pct(xs: List[float], p: float) -> float:
+    if not xs:
+        return 0.0
+    s = sorted(xs)
+    return round(s[min(len(s) - 1, int(p * len(s)))], 1)
+
+def summary(name: str, xs: List[float]) -> str:
+    return f"{name:<14} n={len(xs):<4} p50={pct(xs, .5):>8} ms  p95={pct(xs, .95):>8} ms  p99={pct(xs, .99):>8} ms"
+
+def bench_pipeline(args, images) -> Dict[str, List[float]]:
+    from graph_llm_ingredients import run_pipeline
+    def one(_):
+        t0 = time.perf_counter()
+        try:
+            out = run_pipeline(images, args.project, args.location, args.model, use_cache=not args.nocache,
+                               variant=args.variant)
+            return (time.perf_counter() - t0) * 1000.0, out.get("error")
+        except Exception as e:
+            return (time.perf_counter() - t0) * 1000.0, str(e)
+    with ThreadPoolExecutor(max_workers=args.concurrency) as ex:
+        res = list(ex.map(one, range(args.jobs)))
+    return {"total": [ms for ms, err in res if not err], "errors": [1.0 for _, err in res if err]}
+
+def bench_async(args, images) -> Dict[str, List[float]]:
+    from graph_llm_ingredients import run_pipeline_async
+    async def main():
+        sem = asyncio.Semaphore(args.concurrency)
+        async def one():
+            async with sem:
+                t0 = time.perf_counter()
+                try:
+                    out = await run_pipeline_async(images, args.project, args.location, args.model,
+                                                   use_cache=not args.nocache, variant=args.variant)
+                    return (time.perf_counter() - t0) * 1000.0, out.get("error")
+                except Exception as e:
+                    return (time.perf_counter() - t0) * 1000.0, str(e)
+        return await asyncio.gather(*(one() for _ in range(args.jobs)))
+    res = asyncio.run(main())
+    return {"total": [ms for ms, err in res if not err], "errors": [1.0 for _, err in res if err]}
+
+def bench_sse(args, images) -> Dict[str, List[float]]:
+    import app as webapp
+    client = webapp.app.test_client()
+    def one(_):
+        files = [(open(p, "rb"), os.path.basename(p)) for p in images]
+        try:
+            # /upload queues the run; the SSE request below subscribes to it
+            form = {"images[]": files, "model": args.model, "variant": args.variant,
+                    **({"nocache": "1"} if args.nocache else {})}
+            r = client.post("/upload", data=form, content_type="multipart/form-data")
+        finally:
+            for f, _ in files:
+                f.close()
+        job_id = r.get_json()["job_id"]
+        t0 = time.perf_counter()
+        first, err = None, None
+        q = "&nocache=1" if args.nocache else ""
+        resp = client.get(f"/analyze_sse?job_id={job_id}&model={args.model}&variant={args.variant}{q}",
+                          buffered=False)
+        for chunk in resp.response:
+            txt = chunk.decode("utf-8") if isinstance(chunk, bytes) else chunk
+            if first is None and txt.startswith("event: ") and not txt.startswith("event: open"):
+                first = (time.perf_counter() - t0) * 1000.0
+            if txt.startswith("event: error"):
+                err = txt
+        return first, (time.perf_counter() - t0) * 1000.0, err
+    with ThreadPoolExecutor(max_workers=args.concurrency) as ex:
+        res = list(ex.map(one, range(args.jobs)))
+    return {"first_event": [f for f, _, _ in res if f is not None],
+            "total": [t for _, t, err in res if not err], "errors": [1.0 for _, _, err in res if err]}
+
+def bench_batch(args, images) -> Dict[str, List[float]]:
+    # one /analyze_batch request with --jobs meals (all the given images as angles),
+    # --concurrency meals in flight; latency = time until a meal's NDJSON line arrives
+    import app as webapp
+    client = webapp.app.test_client()
+    files = []
+    data = {"variant": args.variant, "model": args.model, **({"nocache": "1"} if args.nocache else {})}
+    for i in range(args.jobs):
+        data[f"meals[{i}]"] = [(open(p, "rb"), os.path.basename(p)) for p in images]
+        files.extend(f for f, _ in data[f"meals[{i}]"])
+    t0 = time.perf_counter()
+    try:
+        resp = client.post("/analyze_batch", data=data, content_type="multipart/form-data", buffered=False)
+        lines = []
+        for chunk in resp.response:
+            for line in (chunk.decode("utf-8") if isinstance(chunk, bytes) else chunk).splitlines():
+                if line.strip():
+                    lines.append(((time.perf_counter() - t0) * 1000.0, json.loads(line)))
+    finally:
+        for f in files:
+            f.close()
+    meals = [(ms, d) for ms, d in lines if "meal" in d]
+    for _, d in lines:
+        if "summary" in d:
+            print("batch          " + json.dumps({k: v for k, v in d["summary"].items() if "usage" not in k}))
+    return {"meal": [ms for ms, d in meals if not d.get("error")], "errors": [1.0 for _, d in meals if d.get("error")]}
+
+def main():
+    ap = argparse.ArgumentParser("Concurrent pipeline benchmark (offline Gemini stand-in by default)")
+    ap.add_argument("images", nargs="*", default=["images/img_1.jpg"])
+    ap.add_argument("--mode", choices=["pipeline", "async", "sse", "batch"], default="pipeline")
+    ap.add_argument("--variant", type=str, default="full", help="pipeline variant, e.g. full | fused | speculative")
+    ap.add_argument("--jobs", type=int, default=50)
+    ap.add_argument("--concurrency", type=int, default=10)
+    ap.add_argument("--model", type=str, default="gemini-2.5-flash", help='a model name or "cascade"')
+    ap.add_argument("--project", type=str, default=None)
+    ap.add_argument("--location", type=str, default="global")
+    ap.add_argument("--real", action="store_true", help="call the real API instead of gemini_fake")
+    ap.add_argument("--nocache", action="store_true", help="skip the on-disk LLM cache lookups")
+    ap.add_argument("--seed", type=str, default="1")
+    ap.add_argument("--time-scale", type=float, default=None, help="FAKE_TIME_SCALE, e.g. 0.05")
+    ap.add_argument("--error-rate", type=float, default=None, help="FAKE_ERROR_RATE")
+    ap.add_argument("--rate-429", type=float, default=None, help="FAKE_429_RATE")
+    ap.add_argument("--bad-json-rate", type=float, default=None, help="FAKE_BAD_JSON_RATE")
+    ap.add_argument("--dish-drift", type=float, default=None, help="FAKE_DISH_DRIFT (speculative misses)")
+    ap.add_argument("--low-conf-rate", type=float, default=None, help="FAKE_LOW_CONF_RATE (cascade escalations)")
+    ap.add_argument("--coalesce", action="store_true",
+                    help="sse mode: keep single-flight on (identical concurrent jobs share one pipeline run)")
+    args = ap.parse_args()
+
+    # every bench job uploads the same images, so single-flight would fold them into one run
+    os.environ["SINGLE_FLIGHT"] = "1" if args.coalesce else "0"
+    if args.mode == "batch":
+        os.environ.setdefault("BATCH_CONCURRENCY", str(args.concurrency))
+
+    # fake knobs are read at import time, so set them before importing the app modules
+    if not args.real:
+        os.environ.setdefault("GEMINI_BACKEND", "fake")
+        os.environ.setdefault("FAKE_SEED", args.seed)
+        for flag, env in (("time_scale", "FAKE_TIME_SCALE"), ("error_rate", "FAKE_ERROR_RATE"),
+                          ("rate_429", "FAKE_429_RATE"), ("bad_json_rate", "FAKE_BAD_JSON_RATE"),
+                          ("dish_drift", "FAKE_DISH_DRIFT"), ("low_conf_rate", "FAKE_LOW_CONF_RATE")):
+            if getattr(args, flag) is not None:
+                os.environ[env] = str(getattr(args, flag))
+        os.environ.setdefault("UPLOAD_DIR", tempfile.mkdtemp(prefix="fta-bench-"))
+        os.environ.setdefault("LLM_CACHE_PATH", os.path.join(os.environ["UPLOAD_DIR"], "llm_cache.sqlite"))
+
+    images = [os.path.abspath(p) for p in args.images]
+    t0 = time.perf_counter()
+    res = {"pipeline": bench_pipeline, "async": bench_async, "sse": bench_sse, "batch": bench_batch}[args.mode](args, images)
+    wall_s = time.perf_counter() - t0
+
+    from gemini_policy import call_policy_stats
+    from gemini_client import usage_stats
+    from gemini_fake import fake_stats
+    from graph_llm_ingredients import VARIANTS, speculation_stats
+    from gemini_cascade import cascade_stats
+    from single_flight import single_flight_stats
+
+    print(f"\n==== {args.mode}/{args.variant}: {args.jobs} jobs @ concurrency {args.concurrency} ====")
+    for k, xs in res.items():
+        if k != "errors":
+            print(summary(k, xs))
+    print(f"errors         {len(res['errors'])}")
+    print(f"throughput     {args.jobs / wall_s:.2f} jobs/s  ({wall_s:.1f} s wall)")
+    pol = call_policy_stats()
+    print("policy         " + json.dumps({k: v for k, v in pol.items() if not isinstance(v, dict)}))
+    print("usage          " + json.dumps(usage_stats()))
+    if args.model == "cascade":
+        print("cascade        " + json.dumps({st: {k: v for k, v in c.items() if k != "policy"}
+                                              for st, c in cascade_stats().items()}))
+    if "speculate" in VARIANTS.get(args.variant, ()):
+        print("speculation    " + json.dumps(speculation_stats()))
+    if args.coalesce:
+        print("single_flight  " + json.dumps(single_flight_stats()))
+    if args.mode in ("sse", "batch"):
+        from job_queue import queue_stats
+        print("job_queue      " + json.dumps(queue_stats()))
+    if args.mode == "sse":
+        from heartbeat import heartbeat_stats
+        print("heartbeat      " + json.dumps(heartbeat_stats()))
+    if not args.real:
+        print("fake           " + json.dumps(fake_stats()))
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,237 @@
+# single_flight.py
+import os, copy, json, time, asyncio, hashlib, threading
+from typing import Any, AsyncGenerator, Callable, Dict, Generator, Iterable, List, Optional, Tuple
+
+from llm_cache import file_sha256
+from cancellation import CancelToken
+
+# In-flight deduplication of identical analyses (double submit, two tabs, same photo).
+# Key = sha256 of the uploaded image bytes + model + variant + caller inputs. The first
+# request leads and runs the pipeline; identical requests that arrive while it runs
+# follow it instead of starting their own:
+#   - SSE: the leader's stream is driven by a job_queue worker (produce) and every chunk
+#     goes to a shared log; each subscriber (leader included) replays the log and then tails it.
+#   - /analyze: waits for the flight's final payload (an SSE flight counts too).
+# A flight leaves the registry once its pipeline ends, so later requests run fresh.
+# When its last subscriber disconnects, the flight's cancel token fires after
+# SSE_CANCEL_GRACE_S: an EventSource reconnecting after a network blip (browsers
+# retry after ~3 s) rejoins the running stage instead of paying for it again.
+ENABLED = os.getenv("SINGLE_FLIGHT", "1") != "0"
+HEARTBEAT_S = float(os.getenv("SINGLE_FLIGHT_HEARTBEAT_S", "15"))
+CANCEL_GRACE_S = float(os.getenv("SSE_CANCEL_GRACE_S", "5"))   # 0: cancel at once
+
+_LOCK = threading.Lock()
+_FLIGHTS: Dict[Tuple[str, str], "Flight"] = {}
+_STATS = {"leaders": 0, "followers": 0, "json_followers": 0, "sse_followers": 0, "follower_errors": 0,
+          "cancelled_flights": 0, "saved_ms_est_total": 0.0, "async_streams": 0, "async_streams_open": 0}
+
+def flight_key(image_paths: List[str], model: str, variant: str, inputs: Optional[Dict] = None,
+               use_cache: bool = True) -> str:
+    """
+    Content key: same bytes + model + variant + inputs -> same key, whatever the file names.
+    A nocache request only shares with other nocache requests: a cached run may answer from the cache.
+    """
+    h = hashlib.sha256()
+    for p in image_paths:
+        h.update(file_sha256(p).encode())
+    h.update(json.dumps([model, variant, inputs or {}, bool(use_cache)], sort_keys=True, ensure_ascii=False).encode())
+    return h.hexdigest()
+
+class Flight:
+    """One pipeline run shared by every identical request."""
+    def __init__(self, kind: str, key: str):
+        self.kind, self.key = kind, key
+        self.cond = threading.Condition()
+        self.log: List[str] = []
+        self.done = False
+        self.result: Optional[Dict[str, Any]] = None
+        self.error: Optional[str] = None
+        self.followers = 0
+        self.subscribers = 0
+        self.token: Optional[CancelToken] = None
+        self.t0 = time.perf_counter()
+        self._awaiting: List[Tuple[asyncio.AbstractEventLoop, asyncio.Event]] = []   # afollow() subscribers
+
+    def attach(self):
+        with self.cond:
+            self.subscribers += 1
+
+    def detach(self):
+        with self.cond:
+            self.subscribers -= 1
+            orphaned = self.subscribers <= 0 and not self.done and self.token is not None
+        if not orphaned:
+            return
+        if CANCEL_GRACE_S > 0:
+            t = threading.Timer(CANCEL_GRACE_S, self._cancel_if_orphaned)
+            t.daemon = True
+            t.start()
+        else:
+            self._cancel_if_orphaned()
+
+    def _cancel_if_orphaned(self):
+        with self.cond:
+            if self.subscribers > 0 or self.done:
+                return
+        if self.token.cancel("client_disconnected"):
+            with _LOCK:
+                _STATS["cancelled_flights"] += 1
+            print(f"[single_flight] ✋ no subscribers left, cancelling flight {self.key[:10]}")
+
+    @property
+    def live(self) -> bool:
+        """Still worth joining: not finished and not cancelled for lack of subscribers."""
+        return not self.done and not (self.token is not None and self.token.cancelled)
+
+    def _notify(self):
+        # caller holds self.cond
+        self.cond.notify_all()
+        for loop, ev in self._awaiting:
+            loop.call_soon_threadsafe(ev.set)
+
+    def publish(self, chunk: str):
+        with self.cond:
+            self.log.append(chunk)
+            self._notify()
+
+    def finish(self, result: Optional[Dict[str, Any]] = None, error: Optional[str] = None):
+        with self.cond:
+            self.result, self.error, self.done = result, error, True
+            self._notify()
+        ms = (time.perf_counter() - self.t0) * 1000.0
+        with _LOCK:
+            if _FLIGHTS.get((self.kind, self.key)) is self:
+                del _FLIGHTS[(self.kind, self.key)]
+            _STATS["saved_ms_est_total"] = round(_STATS["saved_ms_est_total"] + ms * self.followers, 1)
+            _STATS["follower_errors"] += self.followers if error else 0
+
+    def follow(self, heartbeat: Callable[[], str], interval: float = HEARTBEAT_S) -> Generator[str, None, None]:
+        """Replay what was already emitted, then tail the log until the flight ends."""
+        i = 0
+        self.attach()
+        try:
+            while True:
+                with self.cond:
+                    if i >= len(self.log) and not self.done:
+                        self.cond.wait(timeout=interval)
+                    new, i = self.log[i:], len(self.log)
+                    finished = self.done and i >= len(self.log)
+                if not new and not finished:
+                    yield heartbeat()
+                for chunk in new:
+                    yield chunk
+                if finished:
+                    return
+        finally:
+            # closed by the server when the client went away (or after the last event)
+            self.detach()
+
+    async def afollow(self, heartbeat: Callable[[], str], interval: float = HEARTBEAT_S
+                      ) -> AsyncGenerator[str, None]:
+        """follow() for an event loop: waiting costs a coroutine, not a thread."""
+        waiter = (asyncio.get_running_loop(), asyncio.Event())
+        i = 0
+        with self.cond:
+            self._awaiting.append(waiter)
+        with _LOCK:
+            _STATS["async_streams"] += 1
+            _STATS["async_streams_open"] += 1
+        self.attach()
+        try:
+            while True:
+                waiter[1].clear()
+                with self.cond:
+                    new, i = self.log[i:], len(self.log)
+                    finished = self.done and i >= len(self.log)
+                for chunk in new:
+                    yield chunk
+                if finished:
+                    return
+                if not new:
+                    try:
+                        await asyncio.wait_for(waiter[1].wait(), interval)
+                    except asyncio.TimeoutError:
+                        yield heartbeat()
+        finally:
+            with self.cond:
+                self._awaiting.remove(waiter)
+            with _LOCK:
+                _STATS["async_streams_open"] -= 1
+            self.detach()
+
+    def wait(self, timeout: Optional[float] = None) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+        with self.cond:
+            self.cond.wait_for(lambda: self.done, timeout=timeout)
+            if not self.done:
+                return None, "single_flight_timeout"
+            return self.result, self.error
+
+def join(kind: str, key: str, also: Iterable[str] = ()) -> Tuple[Optional[Flight], bool]:
+    """
+    (flight, is_leader). Joins a running flight of `kind` (or of one of `also`) if there is
+    one, else registers a new flight of `kind` that the caller must run and finish().
+    (None, True) when single-flight is disabled.
+    """
+    if not ENABLED:
+        return None, True
+    with _LOCK:
+        for k in (kind, *also):
+            f = _FLIGHTS.get((k, key))
+            if f is not None and f.live:
+                f.followers += 1
+                _STATS["followers"] += 1
+                _STATS["sse_followers" if kind == "sse" else "json_followers"] += 1
+                return f, False
+        # (a cancelled flight still winding down is replaced)
+        f = _FLIGHTS[(kind, key)] = Flight(kind, key)
+        _STATS["leaders"] += 1
+        return f, True
+
+def run_shared(key: str, fn: Callable[[], Dict[str, Any]], timeout: Optional[float] = None
+               ) -> Tuple[Dict[str, Any], bool]:
+    """(result, coalesced) for a blocking pipeline call; joins SSE flights of the same key too."""
+    flight, leader = join("json", key, also=("sse",))
+    if flight is None:
+        return fn(), False
+    if not leader:
+        print(f"[single_flight] 🔗 /analyze joined {flight.kind} flight {key[:10]}")
+        flight.attach()
+        try:
+            res, err = flight.wait(timeout)
+        finally:
+            flight.detach()
+        if res is None:
+            raise RuntimeError(err or "coalesced_pipeline_failed")
+        return copy.deepcopy(res), True
+    try:
+        res = fn()
+    except Exception as e:
+        flight.finish(error=str(e))
+        raise
+    flight.finish(result=copy.deepcopy(res))
+    return res, False
+
+def produce(flight: Flight, gen: Generator[str, None, None],
+            outcome: Callable[[], Tuple[Optional[Dict[str, Any]], Optional[str]]],
+            token: Optional[CancelToken] = None):
+    """
+    Drive the leader's generator to the end (run it as a job_queue job), publishing every
+    chunk to the flight; `token` is cancelled once nobody is subscribed any more.
+    """
+    flight.token = token
+    try:
+        for chunk in gen:
+            flight.publish(chunk)
+    except Exception as e:
+        flight.finish(error=str(e))
+        return
+    flight.finish(*outcome())
+
+def single_flight_stats() -> Dict:
+    with _LOCK:
+        s = dict(_STATS)
+        inflight = len(_FLIGHTS)
+    runs = s["leaders"] + s["followers"]
+    return {"enabled": ENABLED, **s, "inflight": inflight, "requests": runs,
+            "coalesced_rate": round(s["followers"] / runs, 4) if runs else 0.0,
+            "pipeline_runs_saved": s["followers"]}
@@ -0,0 +1,12 @@
+# tests/conftest.py
+import os, tempfile
+
+# set before any repo module is imported: they read their config at module top
+_TMP = tempfile.mkdtemp(prefix="food-tracker-tests-")
+os.environ.setdefault("GEMINI_BACKEND", "fake")
+os.environ["LLM_CACHE"] = "0"
+os.environ["LLM_CACHE_PATH"] = os.path.join(_TMP, "llm_cache.sqlite")
+os.environ["DENSITY_MEMO_PATH"] = os.path.join(_TMP, "density_memo.sqlite")
+os.environ["UPLOAD_DIR"] = os.path.join(_TMP, "uploads")
+os.environ["HISTORY_DB_PATH"] = os.path.join(_TMP, "uploads", "history.sqlite")
+os.makedirs(os.environ["UPLOAD_DIR"], exist_ok=True)
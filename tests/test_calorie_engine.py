@@ -0,0 +1,96 @@
+# tests/test_calorie_engine.py
+import pytest
+import calorie_engine as ce
+
+FIELDS = "name,aliases,fdc_id,fdc_description,kcal,protein_g,carbs_g,fat_g,absorbed_fat_g\n"
+
+def _row_name(name):
+    r, _ = ce.match_food(name)
+    return None if r is None else ce.load_table()["rows"][r]["name"]
+
+@pytest.fixture(autouse=True)
+def default_table():
+    ce.load_table()
+    yield
+    ce.load_table()                                  # a test may have swapped the cached table
+
+@pytest.mark.parametrize("name, food", [
+    ("cooked rice", "cooked rice"),
+    ("White Rice", "cooked rice"),                   # alias, case
+    ("boiled egg", "egg"),                           # prep word dropped
+    ("boiled potatoes", "boiled potato"),            # plural
+    ("olive oil", "olive oil"),
+])
+def test_exact(name, food):
+    assert _row_name(name) == food
+    assert ce.match_food(name)[1] == 1.0
+
+@pytest.mark.parametrize("name, food", [
+    ("fried rice", "cooked rice"),
+    ("deep fried rice", "cooked rice"),
+])
+def test_subset_frying_words(name, food):
+    assert _row_name(name) == food
+
+def test_subset_other_words_go_to_llm():
+    assert _row_name("pork belly") is None
+
+@pytest.mark.parametrize("name, food", [
+    ("brocoli", "broccoli"),
+    ("mozarella", "mozzarella"),
+    ("cucumbr", "cucumber"),
+    ("chiken breast", "chicken breast"),
+    ("chickn thigh", "chicken thigh"),
+])
+def test_fuzzy_typos(name, food):
+    assert _row_name(name) == food
+    score = ce.match_food(name)[1]
+    assert ce.MATCH_CUTOFF <= score < 1.0
+
+@pytest.mark.parametrize("name", [
+    "rice vinegar",                                  # rice + a different food
+    "rice wine",                                     # close to "white rice" letter-wise only
+    "pear",                                          # one letter off "pea"
+    "ham",
+    "lamb",
+    "spinach leaf",
+    "",
+])
+def test_non_matches(name):
+    assert _row_name(name) is None
+
+def test_ambiguous_goes_to_llm(tmp_path):
+    path = tmp_path / "foods.csv"
+    path.write_text(FIELDS + "mango chutney,,,a,200,1,50,0,0\nmango chutnee,,,b,100,1,25,0,0\n")
+    t = ce.load_table(str(path))
+    assert ce.match_food("mango chutney", t) == (0, 1.0)
+    r, score = ce.match_food("mango chutnex", t)     # equally close to both rows
+    assert r is None and score >= ce.MATCH_CUTOFF
+
+def test_ambiguity_ignores_aliases_of_one_food(tmp_path):
+    path = tmp_path / "foods.csv"
+    path.write_text(FIELDS + "mango chutney,mango chutnee,,a,200,1,50,0,0\n")
+    t = ce.load_table(str(path))
+    assert ce.match_food("mango chutnex", t)[0] == 0
+
+def test_local_calories_unmatched_and_oil():
+    items = [{"name": "white rice", "grams": 200}, {"name": "rice vinegar", "grams": 10},
+             {"name": "fried rice", "grams": 100}, {"name": "boiled egg", "grams": 50}]
+    out = ce.local_calories(items)
+    assert out["unmatched"] == [1]
+    assert out["items"][1] is None
+    assert out["items"][0]["kcal"] == pytest.approx(260.0)
+    # no oil item: the fried row carries LOCAL_FRIED_OIL_PCT g absorbed oil per 100 g
+    fat = ce.FRIED_OIL_PCT / 100.0 * 100
+    assert out["items"][2]["fat_g"] == pytest.approx(0.3 + fat, abs=0.1)
+    assert out["items"][2]["kcal"] == pytest.approx(130 + fat * ce.OIL_KCAL_PER_G, abs=0.1)
+
+def test_local_calories_oil_item_takes_the_fat():
+    items = [{"name": "fried rice", "grams": 100}, {"name": "olive oil", "grams": 10},
+             {"name": "boiled egg", "grams": 50}]
+    out = ce.local_calories(items)
+    assert out["unmatched"] == []
+    assert out["notes"] == "added oil counted on the oil item only"
+    assert out["items"][0]["kcal"] == pytest.approx(130.0)
+    # "boiled" is not an oil: without the olive oil there is no oil item
+    assert ce.local_calories(items[::2])["notes"].startswith("no oil item")
@@ -0,0 +1,146 @@
+# tests/test_history_store.py
+import sqlite3
+from datetime import date, datetime, timedelta, timezone
+import pytest
+import history_store
+
+@pytest.fixture
+def hs(tmp_path, monkeypatch):
+    monkeypatch.setattr(history_store, "HISTORY_DB_PATH", str(tmp_path / "history.sqlite"))
+    history_store._local.conn = None
+    yield history_store
+    if history_store._local.conn is not None:
+        history_store._local.conn.close()
+        history_store._local.conn = None
+
+def _rec(created_at, kcal, user="", **kw):
+    return {"dish": "soup", "created_at": created_at, "total_kcal": kcal, "total_protein_g": kcal / 10,
+            "total_carbs_g": kcal / 20, "total_fat_g": kcal / 40, "user": user, **kw}
+
+def _rollups(hs):
+    return {r[:3]: (r[3], *(round(v, 6) for v in r[4:]))
+            for r in hs._db().execute("SELECT * FROM rollups ORDER BY period, user, start")}
+
+def _rebuilt(hs):
+    """What _build_rollups makes of the same records (the SQL week start)."""
+    db = hs._db()
+    db.execute("DELETE FROM meta WHERE key='rollups'")
+    hs._build_rollups(db)
+    return _rollups(hs)
+
+def test_record_adds_to_day_week_and_all_users(hs):
+    hs.record_history("a", _rec("2026-10-14T12:00:00", 500, user="ann"))     # Wednesday
+    hs.record_history("b", _rec("2026-10-14T19:00:00", 300, user="bob"))
+    got = _rollups(hs)
+    assert got[("day", "ann", "2026-10-14")] == (1, 500.0, 50.0, 25.0, 12.5)
+    assert got[("week", "bob", "2026-10-12")] == (1, 300.0, 30.0, 15.0, 7.5)
+    assert got[("day", "*", "2026-10-14")] == (2, 800.0, 80.0, 40.0, 20.0)
+    assert got[("week", "*", "2026-10-12")] == (2, 800.0, 80.0, 40.0, 20.0)
+    assert got == _rebuilt(hs)
+
+def test_reanalysis_moves_record_to_other_day_and_user(hs):
+    hs.record_history("a", _rec("2026-10-18T23:30:00", 500, user="ann"))     # Sunday
+    hs.record_history("b", _rec("2026-10-18T08:00:00", 200, user="ann"))
+    hs.record_history("a", _rec("2026-10-19T00:30:00", 450, user="bob"))     # same id: Monday, other user
+    got = _rollups(hs)
+    assert got[("day", "ann", "2026-10-18")][:2] == (1, 200.0)
+    assert got[("week", "ann", "2026-10-12")][:2] == (1, 200.0)
+    assert got[("day", "bob", "2026-10-19")][:2] == (1, 450.0)
+    assert got[("week", "bob", "2026-10-19")][:2] == (1, 450.0)
+    assert got[("week", "*", "2026-10-12")][:2] == (1, 200.0)
+    assert got[("week", "*", "2026-10-19")][:2] == (1, 450.0)
+    assert ("day", "ann", "2026-10-19") not in got and ("day", "bob", "2026-10-18") not in got
+    assert got == _rebuilt(hs)
+
+def test_reanalysis_same_day_replaces_numbers(hs):
+    hs.record_history("a", _rec("2026-10-14T12:00:00", 500))
+    hs.record_history("a", _rec("2026-10-14T12:00:00", 650))
+    assert _rollups(hs)[("day", "*", "2026-10-14")][:2] == (1, 650.0)
+    assert _rollups(hs) == _rebuilt(hs)
+
+def test_delete_takes_record_out(hs):
+    hs.record_history("a", _rec("2026-10-14T12:00:00", 500, user="ann"))
+    hs.record_history("b", _rec("2026-10-15T12:00:00", 300, user="ann"))
+    assert hs.delete_history("a") is True
+    assert hs.delete_history("a") is False
+    got = _rollups(hs)
+    assert ("day", "ann", "2026-10-14") not in got and ("day", "*", "2026-10-14") not in got
+    assert got[("week", "ann", "2026-10-12")][:2] == (1, 300.0)
+    assert got == _rebuilt(hs)
+    hs.delete_history("b")
+    assert _rollups(hs) == {} == _rebuilt(hs)
+
+def test_missing_numbers_count_as_zero(hs):
+    hs.record_history("a", {"dish": "tea", "created_at": "2026-10-14T09:00:00", "total_kcal": None})
+    assert _rollups(hs)[("day", "*", "2026-10-14")] == (1, 0.0, 0.0, 0.0, 0.0)
+    assert _rollups(hs) == _rebuilt(hs)
+
+def test_week_start_python_matches_sqlite():
+    # incremental writes use _period_starts, the one-time build uses SQLite's
+    # 'weekday 0', '-6 days': both must put every instant in the same Monday week
+    db = sqlite3.connect(":memory:")
+    day0 = datetime(2025, 12, 20, tzinfo=timezone.utc)      # across a year end and a month end
+    for h in range(0, 24 * 80, 7):
+        for edge in (0.0, 1.0, 86399.0):
+            ts = (day0 + timedelta(hours=h)).timestamp() + edge
+            py = dict(history_store._period_starts(ts))
+            sql_day, sql_week = db.execute("SELECT date(?, 'unixepoch'), date(?, 'unixepoch', 'weekday 0', '-6 days')",
+                                           (ts, ts)).fetchone()
+            assert (py["day"], py["week"]) == (sql_day, sql_week)
+            assert date.fromisoformat(py["week"]).weekday() == 0
+
+@pytest.mark.parametrize("created_at, week", [
+    ("2026-10-18T23:59:59", "2026-10-12"),       # Sunday: still the week before
+    ("2026-10-19T00:00:00", "2026-10-19"),       # Monday midnight UTC
+    ("2026-10-19T23:59:59", "2026-10-19"),
+    ("2026-10-25T12:00:00", "2026-10-19"),
+    ("2027-01-01T12:00:00", "2026-12-28"),       # Friday, week started the year before
+])
+def test_week_start_is_monday(hs, created_at, week):
+    hs.record_history("a", _rec(created_at, 100))
+    assert ("week", "*", week) in _rollups(hs)
+    assert _rollups(hs) == _rebuilt(hs)
+    rows = hs.query_rollups("week", date_from=created_at[:10], date_to=created_at[:10])["rows"]
+    assert rows == [{"start": week, "meals": 1, "kcal": 100.0, "protein_g": 10.0, "carbs_g": 5.0, "fat_g": 2.5}]
+
+def test_query_rollups_fills_empty_periods(hs):
+    hs.record_history("a", _rec("2026-10-14T12:00:00", 500, user="ann"))
+    hs.record_history("b", _rec("2026-10-16T12:00:00", 300, user="bob"))
+    out = hs.query_rollups("day", date_from="2026-10-13", date_to="2026-10-17")
+    assert [r["meals"] for r in out["rows"]] == [0, 1, 0, 1, 0]
+    assert out["totals"]["kcal"] == 800.0 and out["avg_kcal_per_day"] == 400.0
+    ann = hs.query_rollups("day", date_from="2026-10-13", date_to="2026-10-17", user="ann")
+    assert [r["kcal"] for r in ann["rows"]] == [0.0, 500.0, 0.0, 0.0, 0.0]
+
+def test_cursor_paging_returns_every_record_once_in_order(hs):
+    base = datetime(2026, 10, 1, 8, 0)
+    expected = []
+    for i in range(23):
+        # pairs share a timestamp: the id breaks the tie, so a page edge can fall between them
+        created = (base + timedelta(hours=i // 2)).isoformat()
+        hs.record_history(f"r{i:02d}", _rec(created, 100 + i, user="ann" if i % 3 else "bob"))
+        expected.append((created, f"r{i:02d}"))
+    expected.sort(reverse=True)
+
+    for limit in (1, 2, 4, 5, 23, 50):
+        seen, cursor = [], None
+        while True:
+            page = hs.query_history(limit=limit, cursor=cursor, fields=["id", "created_at"])
+            assert len(page["items"]) <= limit
+            seen += [(it["created_at"], it["id"]) for it in page["items"]]
+            cursor = page["next_cursor"]
+            if cursor is None:
+                break
+        assert seen == expected
+
+    seen, cursor = [], None
+    while True:
+        page = hs.query_history(limit=3, cursor=cursor, user="bob", fields=["id"])
+        seen += [it["id"] for it in page["items"]]
+        if not (cursor := page["next_cursor"]):
+            break
+    assert seen == [rid for _, rid in expected if int(rid[1:]) % 3 == 0]
+
+def test_bad_cursor(hs):
+    with pytest.raises(ValueError):
+        hs.query_history(cursor="not-a-cursor")
@@ -0,0 +1,99 @@
+# tests/test_json_stream.py
+import json
+import random
+import pytest
+from json_stream import JsonStreamParser
+
+DOC = ('```json\n{"dish": "caf\\u00e9 \\"special\\"", "items": [{"name": "rice", "grams": 1.5e-3, '
+       '"tags": [["a", "b"], []]}, {"name": "egg\\\\yolk", "grams": -2E+2, "ok": true}], '
+       '"notes": null, "grid": [[1, 2], [3e1]]}\n```')
+
+# every string/object/array value, in the order it closes
+EXPECTED = [
+    (("dish",), 'café "special"'),
+    (("items", 0, "name"), "rice"),
+    (("items", 0, "tags", 0, 0), "a"),
+    (("items", 0, "tags", 0, 1), "b"),
+    (("items", 0, "tags", 0), ["a", "b"]),
+    (("items", 0, "tags", 1), []),
+    (("items", 0, "tags"), [["a", "b"], []]),
+    (("items", 0), {"name": "rice", "grams": 0.0015, "tags": [["a", "b"], []]}),
+    (("items", 1, "name"), "egg\\yolk"),
+    (("items", 1), {"name": "egg\\yolk", "grams": -200.0, "ok": True}),
+    (("items",), [{"name": "rice", "grams": 0.0015, "tags": [["a", "b"], []]},
+                  {"name": "egg\\yolk", "grams": -200.0, "ok": True}]),
+    (("grid", 0), [1, 2]),
+    (("grid", 1), [30.0]),
+    (("grid",), [[1, 2], [30.0]]),
+]
+
+def _run(chunks):
+    seen = []
+    p = JsonStreamParser(lambda path, value: seen.append((path, value)))
+    returned = []
+    for c in chunks:
+        returned += p.feed(c)
+    return p, seen, returned
+
+def _split(text, cuts):
+    cuts = sorted(set(cuts))
+    return [text[a:b] for a, b in zip([0] + cuts, cuts + [len(text)])]
+
+def test_whole_document():
+    p, seen, returned = _run([DOC])
+    assert seen == EXPECTED
+    assert returned == EXPECTED
+    assert p.done
+    assert p.result == json.loads(DOC[DOC.index("{"):DOC.rindex("}") + 1])
+
+def test_byte_by_byte():
+    p, seen, _ = _run(list(DOC))
+    assert seen == EXPECTED
+    assert p.result == json.loads(DOC[DOC.index("{"):DOC.rindex("}") + 1])
+
+@pytest.mark.parametrize("i", range(1, len(DOC)))
+def test_every_two_way_split(i):
+    # covers a cut inside each escape (é, \", \\), exponent (1.5e-3, -2E+2) and bracket run
+    assert _run([DOC[:i], DOC[i:]])[1] == EXPECTED
+
+def test_random_splits():
+    rnd = random.Random(7)
+    for _ in range(200):
+        cuts = [rnd.randrange(1, len(DOC)) for _ in range(rnd.randrange(1, 12))]
+        assert _run(_split(DOC, cuts))[1] == EXPECTED
+
+def test_values_reported_by_the_chunk_that_closes_them():
+    p = JsonStreamParser()
+    assert p.feed('{"dish": "fri') == []
+    assert p.feed('ed rice", "items": [{"n') == [(("dish",), "fried rice")]
+    assert p.feed('ame": "rice"}') == [(("items", 0, "name"), "rice"), (("items", 0), {"name": "rice"})]
+    assert not p.done
+
+def test_escaped_quote_in_key():
+    p, seen, _ = _run(['{"a\\', '"b": ["', 'x"]}'])
+    assert seen == [(('a"b', 0), "x"), (('a"b',), ["x"])]
+    assert p.result == {'a"b': ["x"]}
+
+def test_brackets_inside_strings_ignored():
+    p, seen, _ = _run(['{"s": "}]{[", "t": ', '"\\\\"}'])
+    assert seen == [(("s",), "}]{["), (("t",), "\\")]
+    assert p.result == {"s": "}]{[", "t": "\\"}
+
+def test_done_as_soon_as_top_level_closes():
+    p = JsonStreamParser()
+    p.feed('Sure! {"a": [1]')
+    assert not p.done
+    assert p.feed('} and then {"b": "late"}') == []
+    assert p.done
+    assert p.result == {"a": [1]}
+    assert p.feed('{"c": "more"}') == []           # later chunks are ignored
+    assert p.result == {"a": [1]}
+
+def test_scalars_only_reported_with_their_parent():
+    _, seen, _ = _run(['{"n": 1.5e', '-3, "b": fal', 'se, "z": nu', 'll}'])
+    assert seen == []
+
+def test_unfinished_stream():
+    p, seen, _ = _run(['{"dish": "soup", "items": [{"name": "le'])
+    assert seen == [(("dish",), "soup")]
+    assert not p.done and p.result is None